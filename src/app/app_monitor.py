@@ -81,6 +81,11 @@ class Monitor():
     self.drone_data = {}
     self.drone_data_locks = {}
     self.battery_data = {}
+    # One thread receives the info streams of all clients
+    self._hub = dss.auxiliaries.zmq_lib.SubscriberHub(_context)
+    self._hub.register(self._on_state, topic='STATE')
+    self._hub.register(self._on_battery, topic='battery')
+    self._hub.start()
     self.mqtt_agent = mqtt_agent
     self._mqtt_threads = {}
     # Use pre-allocated IDs to remove ghost problem in mqtt
@@ -98,8 +103,9 @@ class Monitor():
 
 #--------------------------------------------------------------------#
   def kill(self):
-    # Clean the clients list to stop subscription threads and closing sockets.
+    # Clean the clients list and close the subscription sockets.
     self.clients = {}
+    self._hub.close()
 
     # Unregister APP from CRM
     _logger.info("Unregister from CRM")
@@ -188,12 +194,14 @@ class Monitor():
     rate: float = 1.0 / mqtt_agent.logic.rate #1.0
     while self.client_in_dict(drone_id, self.clients):
       drone_data = None
-      self.drone_data_locks[drone_id].acquire()
-      try:
-        drone_data = self.drone_data[drone_id]
-      except KeyError:
+      # The lock is removed with the client
+      lock = self.drone_data_locks.get(drone_id)
+      if lock is None:
+        break
+      with lock:
+        drone_data = self.drone_data.get(drone_id)
+      if drone_data is None:
         _logger.warning("No data received from drone with with ID %s" % drone_id)
-      self.drone_data_locks[drone_id].release()
       if drone_data :
         mqtt_agent.set_lla(drone_data['lat'], drone_data['lon'], drone_data['alt'])
         mqtt_agent.set_heading(drone_data['heading'])
@@ -213,7 +221,7 @@ class Monitor():
       time.sleep(rate)
 
 #--------------------------------------------------------------------#
-  # An subscribe thread. One per client will be launched. Thread is killed when client is removed from list
+  # A setup thread. One per client will be launched, it enables the STATE stream and adds the client to the subscriber hub
   def _subscriber_thread(self, client_id):
     drone_id = client_id
     ip = self.clients[drone_id]['ip']
@@ -222,42 +230,51 @@ class Monitor():
 
     # Connect the Request socket to enable the STATE stream
     req_socket = dss.auxiliaries.zmq_lib.Req(_context, ip, port, label=drone_id, timeout=2000)
-    # Enable stream
-    stream = 'STATE'
-    self.enable_stream(stream,req_socket)
-    # Get info port from DSS
-    sub_port = self.get_port(req_socket, 'info_pub_port')
-
-    # Create subscription socket and start listening thread
-    sub_socket = dss.auxiliaries.zmq_lib.Sub(_context, ip, sub_port, drone_id)
-    sub_socket.subscribe(stream)
-
-    if self.mqtt_agent:
-      self.setup_mqtt_client(client_id)
-
-    while self.client_in_dict(drone_id, self.clients):
-      try:
-        (topic, msg) = sub_socket.recv()
-        if topic == stream:
-          self.drone_data_locks[drone_id].acquire()
-          self.drone_data[drone_id] = msg
-          self.drone_data_locks[drone_id].release()
-        elif topic == 'battery':
-          self.battery_data[drone_id] = msg
-        else:
-          pass
-      except:
-        pass
-    #Remove the drone from the map
-    self.drone_data_locks[drone_id].acquire()
-    try :
-      self.drone_data.pop(drone_id)
-      self.battery_data.pop(drone_id)
-    except KeyError :
-      _logger.info("Not all data received from client with ID %s" % drone_id)
-    self.drone_data_locks[drone_id].release()
-    self.drone_data_locks.pop(drone_id)
-    _logger.info("Stopped thread and closed socket for client: %s" % drone_id)
+    try:
+      # Enable stream
+      stream = 'STATE'
+      self.enable_stream(stream,req_socket)
+      # Get info port from DSS
+      sub_port = self.get_port(req_socket, 'info_pub_port')
+    except dss.auxiliaries.exception.NoAnswer:
+      _logger.error("Client %s did not answer, not subscribing" % drone_id)
+      return
+    finally:
+      req_socket.close()
+
+    # Subscribe, unless the client was removed meanwhile
+    if self.client_in_dict(drone_id, self.clients):
+      self._hub.add(drone_id, ip, sub_port, topics=['STATE', 'battery'])
+
+      if self.mqtt_agent:
+        self.setup_mqtt_client(client_id)
+
+  # Called from the subscriber hub thread
+  def _on_state(self, drone_id, topic, msg):
+    lock = self.drone_data_locks.get(drone_id)
+    if lock is None:
+      return
+    with lock:
+      self.drone_data[drone_id] = msg
+
+  def _on_battery(self, drone_id, topic, msg):
+    if self.client_in_dict(drone_id, self.clients):
+      self.battery_data[drone_id] = msg
+
+  # Unsubscribe and remove the drone from the map
+  def remove_client(self, client_id):
+    drone_id = client_id
+    self._hub.remove(drone_id)
+    # The subscription may never have been set up
+    lock = self.drone_data_locks.pop(drone_id, None)
+    if lock is None:
+      return
+    with lock:
+      drone_data = self.drone_data.pop(drone_id, None)
+      battery_data = self.battery_data.pop(drone_id, None)
+      if drone_data is None or battery_data is None:
+        _logger.info("Not all data received from client with ID %s" % drone_id)
+    _logger.info("Stopped subscription for client: %s" % drone_id)
 
 #--------------------------------------------------------------------#
   # Call the DSS reply socket using the req_socket to enable a stream
@@ -344,6 +361,7 @@ class Monitor():
         # Pop clients from client list, subscription will be ended and socket closed
         for client_id in clients_to_pop:
           self.clients.pop(client_id)
+          self.remove_client(client_id)
           current_idx = self.allocated_idxs[client_id]
           self.available_idxs.append(current_idx)
           self.allocated_idxs.pop(client_id)
@@ -333,7 +333,7 @@ class AppSkara():
       #Request socket to another application (assumed LLA stream already started)
       req_socket = dss.auxiliaries.zmq_lib.Req(_context, self.her['ip'], self.her['port'], label='her-req', timeout=2000)
       info_pub_port = self._get_info_port(req_socket)
-    self._her_lla_subscriber = dss.auxiliaries.zmq_lib.Sub(_context, self.her['ip'], info_pub_port, "her-info")
+    self._her_lla_subscriber = dss.auxiliaries.zmq_lib.Sub(_context, self.her['ip'], info_pub_port, "her-info", conflate=True)
 
   def _above_drone_lla_listener(self):
     while self.alive:
@@ -496,7 +496,7 @@ class AppSkara():
       if role == "Above":
         info_port = drone.get_port('info_pub_port')
         drone.enable_data_stream('LLA')
-        self._above_drone_lla_subscriber = dss.auxiliaries.zmq_lib.Sub(_context, answer['ip'], info_port, "info above")
+        self._above_drone_lla_subscriber = dss.auxiliaries.zmq_lib.Sub(_context, answer['ip'], info_port, "info above", conflate=True)
 
   def release_drones(self):
     #Disconnect the drones
@@ -1,7 +1,9 @@
 #!/usr/bin/env python3
 
 import argparse
+import concurrent.futures
 import datetime
+import heapq
 import json
 import logging
 import subprocess
@@ -9,6 +11,8 @@ import traceback
 import psutil
 import re
 import os
+import sys
+import threading
 
 import dss.auxiliaries
 from dss.auxiliaries.config import config
@@ -20,9 +24,431 @@ __version__ = '1.2.8'
 __copyright__ = 'Copyright (c) 2021-2022, RISE'
 __status__ = 'development'
 
+STALE_TIME = 15 # [s] clients that are not heard of are deleted
+
+# Requests that are slow and do not change the clients, they are handled by the worker pool
+WORKER_REQUESTS = ('kill_process',)
+
+SAMPLE_INTERVAL = 2.0 # [s] refresh of the process table and the host metrics
+
 #--------------------------------------------------------------------#
 
 
+class ClientRegistry:
+  '''The registered clients with secondary indexes
+
+  The clients are kept as dicts, as exported to clients.json. All changes
+  go through the registry, it keeps the indexes by type, by owner and of
+  the free clients up to date. Capabilities are casefolded and interned
+  as bits, the free clients of each type are grouped by capability mask.
+  find_free() hence visits the distinct capability sets, not the clients.
+  The leases are kept in a heap with one entry per client, ordered by the
+  timestamp when the entry was pushed. A heartbeat (touch) only sets the
+  timestamp, the entry is moved when it reaches the top of the heap.
+  Changes are appended to the journal, if any, heartbeats (touch) are not.
+  '''
+  def __init__(self, journal=None):
+    self._bits = {}       # casefolded capability -> bit
+    self._by_owner = {}   # owner -> {id}
+    self._by_type = {}    # type -> {id}
+    self._clients = {}
+    self._free = {}       # type -> {mask -> {id: None}}, in the order the clients got free
+    self._journal = journal
+    self._leased = set()  # ids with an entry in the heap
+    self._leases = []     # heap of (timestamp, id)
+    self._masks = {}      # id -> capability mask
+    self._mutex = threading.RLock()
+
+  def __contains__(self, id_):
+    return id_ in self._clients
+
+  def __getitem__(self, id_) -> dict:
+    return self._clients[id_]
+
+  def __len__(self):
+    return len(self._clients)
+
+  def items(self) -> list:
+    with self._mutex:
+      return list(self._clients.items())
+
+  def as_dict(self) -> dict:
+    '''A copy of all clients'''
+    with self._mutex:
+      return {id_: dict(client) for (id_, client) in self._clients.items()}
+
+  def load(self, clients: dict, records=()):
+    '''Restores a snapshot of the clients and replays the journal records on top'''
+    with self._mutex:
+      self.clear()
+      for (id_, client) in clients.items():
+        self._add(id_, client)
+      # The records may already be in the snapshot, replaying them again is harmless
+      for record in records:
+        if record['op'] == 'add':
+          self._add(record['id'], record['client'])
+        elif record['op'] == 'update' and record['id'] in self._clients:
+          self._update(record['id'], record['fields'])
+        elif record['op'] == 'remove' and record['id'] in self._clients:
+          self._remove(record['id'])
+
+  def clear(self):
+    with self._mutex:
+      self._by_owner.clear()
+      self._by_type.clear()
+      self._clients.clear()
+      self._free.clear()
+      self._leased.clear()
+      self._leases.clear()
+      self._masks.clear()
+
+  def add(self, id_, client: dict):
+    with self._mutex:
+      self._add(id_, client)
+      if self._journal:
+        self._journal.append({'op': 'add', 'id': id_, 'client': client})
+
+  def remove(self, id_) -> dict:
+    with self._mutex:
+      client = self._remove(id_)
+      if self._journal:
+        self._journal.append({'op': 'remove', 'id': id_})
+      return client
+
+  def update(self, id_, **fields):
+    '''Sets the fields of a client, the indexes follow'''
+    with self._mutex:
+      self._update(id_, fields)
+      if self._journal:
+        self._journal.append({'op': 'update', 'id': id_, 'fields': fields})
+
+  def _add(self, id_, client):
+    if id_ in self._clients:
+      self._remove(id_)
+    self._clients[id_] = client
+    self._masks[id_] = self._mask(client.get('capabilities', []), intern=True)
+    self._by_type.setdefault(client['type'], set()).add(id_)
+    self._by_owner.setdefault(client['owner'], set()).add(id_)
+    self._add_free(id_)
+    # a client that was removed and added again may still have its entry
+    if id_ not in self._leased:
+      self._leased.add(id_)
+      heapq.heappush(self._leases, (client['timestamp'], id_))
+
+  def _remove(self, id_) -> dict:
+    self._remove_free(id_)
+    client = self._clients.pop(id_)
+    del self._masks[id_]
+    self._discard(self._by_type, client['type'], id_)
+    self._discard(self._by_owner, client['owner'], id_)
+    return client
+
+  def _update(self, id_, fields):
+    client = self._clients[id_]
+    self._remove_free(id_)
+    if 'owner' in fields and fields['owner'] != client['owner']:
+      self._discard(self._by_owner, client['owner'], id_)
+      self._by_owner.setdefault(fields['owner'], set()).add(id_)
+    client.update(fields)
+    if 'capabilities' in fields:
+      self._masks[id_] = self._mask(fields['capabilities'], intern=True)
+    self._add_free(id_)
+
+  def touch(self, id_, now):
+    client = self._clients.get(id_)
+    if client is not None:
+      client['timestamp'] = now
+
+  def expired(self, now, max_age) -> list:
+    '''Ids of the clients not heard of for more than max_age seconds, only entries at the top of the heap are visited'''
+    with self._mutex:
+      ids = []
+      while self._leases and now - self._leases[0][0] > max_age:
+        (_, id_) = heapq.heappop(self._leases)
+        client = self._clients.get(id_)
+        if client is not None and now - client['timestamp'] <= max_age:
+          # heard of since the entry was pushed
+          heapq.heappush(self._leases, (client['timestamp'], id_))
+          continue
+        self._leased.discard(id_)
+        if client is not None:
+          ids.append(id_)
+      return ids
+
+  def next_expiry(self, max_age) -> float:
+    '''Time stamp when the oldest entry expires, None if there are no clients'''
+    with self._mutex:
+      return self._leases[0][0] + max_age if self._leases else None
+
+  def owned_by(self, owner) -> list:
+    with self._mutex:
+      return list(self._by_owner.get(owner, ()))
+
+  def of_type(self, type_) -> list:
+    with self._mutex:
+      return list(self._by_type.get(type_, ()))
+
+  def filter(self, filter='') -> dict:
+    '''Clients bound to an endpoint whose id contains filter'''
+    with self._mutex:
+      # ids start with the type, a type as filter is an index lookup
+      ids = self._by_type.get(filter, ()) if filter in self._by_type else self._clients
+      return {id_: self._clients[id_] for id_ in ids if filter in id_ and self._clients[id_]['ip'] and self._clients[id_]['port']}
+
+  def find_free(self, type_, capabilities, now, max_age) -> str:
+    '''The free client of type_ with the fewest capabilities that satisfies capabilities, None if there is none'''
+    with self._mutex:
+      required = self._mask(capabilities)
+      if required is None:
+        return None
+      candidates = [mask for mask in self._free.get(type_, {}) if mask & required == required]
+      for mask in sorted(candidates, key=lambda mask: bin(mask).count('1')):
+        for id_ in self._free[type_][mask]:
+          if now - self._clients[id_]['timestamp'] < max_age:
+            return id_
+      return None
+
+  def _mask(self, capabilities, intern=False) -> int:
+    # None if a capability is unknown and hence can not be satisfied
+    mask = 0
+    for capa in capabilities or ():
+      capa = capa.casefold()
+      if capa not in self._bits:
+        if not intern:
+          return None
+        self._bits[sys.intern(capa)] = len(self._bits)
+      mask |= 1 << self._bits[capa]
+    return mask
+
+  def _add_free(self, id_):
+    client = self._clients[id_]
+    if client['owner'] == 'crm':
+      self._free.setdefault(client['type'], {}).setdefault(self._masks[id_], {})[id_] = None
+
+  def _remove_free(self, id_):
+    client = self._clients[id_]
+    masks = self._free.get(client['type'], {})
+    bucket = masks.get(self._masks[id_])
+    if bucket is not None and id_ in bucket:
+      del bucket[id_]
+      if not bucket:
+        del masks[self._masks[id_]]
+
+  @staticmethod
+  def _discard(index, key, id_):
+    ids = index.get(key)
+    if ids is not None:
+      ids.discard(id_)
+      if not ids:
+        del index[key]
+
+
+class ClientJournal:
+  '''Write-behind persistence of the registry
+
+  The state is a snapshot, clients.json, followed by a journal of JSON
+  lines. Changes are serialised when they happen and queued in memory, a
+  background thread appends them to the journal when there are any. When
+  the journal has grown to compact_size records the thread writes a new
+  snapshot and restarts the journal.
+  '''
+  def __init__(self, snapshot, filename='clients.json', journal_filename='clients.journal', interval=1.0, compact_size=1000):
+    self._compact_size = compact_size
+    self._dirty = threading.Event()
+    self._filename = filename
+    self._interval = interval
+    self._journal_filename = journal_filename
+    self._logger = logging.getLogger('dss.CRM.journal')
+    self._mutex = threading.Lock()
+    self._n_records = 0
+    self._pending = []
+    self._seq = 0              # sequence number of the last change
+    self._snapshot = snapshot  # returns the state to save in the snapshot
+    self._stop = threading.Event()
+    self._thread = None
+
+  def append(self, record: dict):
+    '''Queues a change, serialised right away since the client dicts change later'''
+    with self._mutex:
+      self._seq += 1
+      self._pending.append(json.dumps(dict(record, seq=self._seq)) + '\n')
+    self._dirty.set()
+
+  def load(self) -> tuple:
+    '''The snapshot and the journal records that are newer'''
+    with open(self._filename) as file:
+      backup = json.load(file)
+    seq = backup.get('journal_seq', 0)
+    records = []
+    if os.path.isfile(self._journal_filename):
+      records = [record for record in dss.auxiliaries.recorder.read_jsonl(self._journal_filename) if record['seq'] > seq]
+    with self._mutex:
+      self._seq = max([seq] + [record['seq'] for record in records])
+    return (backup, records)
+
+  def start(self):
+    self._thread = threading.Thread(target=self._main, daemon=True)
+    self._thread.start()
+
+  def stop(self):
+    '''Stops the thread and writes the pending changes'''
+    self._stop.set()
+    self._dirty.set()
+    if self._thread:
+      self._thread.join()
+      self._thread = None
+    self._write()
+
+  def compact(self):
+    '''Writes a snapshot of the current state and restarts the journal'''
+    with self._mutex:
+      # The pending changes are part of the state
+      self._pending.clear()
+      seq = self._seq
+    # Changes after seq may also be part of the state, they are replayed again. The
+    # journal is not locked here, the registry calls append with its own lock taken.
+    backup = self._snapshot()
+    backup['journal_seq'] = seq
+    tmp_filename = self._filename + '.tmp'
+    with open(tmp_filename, 'w') as file:
+      json.dump(backup, file, indent=2)
+    os.replace(tmp_filename, self._filename)
+    with open(self._journal_filename, 'w'):
+      pass
+    self._n_records = 0
+
+  def _write(self):
+    with self._mutex:
+      (lines, self._pending) = (self._pending, [])
+    if lines:
+      with open(self._journal_filename, 'a') as file:
+        file.writelines(lines)
+      self._n_records += len(lines)
+    if self._n_records >= self._compact_size:
+      self.compact()
+
+  def _main(self):
+    while not self._stop.is_set():
+      self._dirty.wait()
+      self._dirty.clear()
+      try:
+        self._write()
+      except OSError:
+        self._logger.error(f'writing the journal failed\n{traceback.format_exc()}')
+      # Collect the changes of one interval in one write
+      self._stop.wait(self._interval)
+
+
+class ProcessSampler:
+  '''Process table and host metrics, refreshed by a background thread
+
+  The psutil handles of the processes are kept between samples, the CPU
+  usage is measured over the interval and the static properties, e.g.
+  the command line and the project, are read once per process. The
+  requests are answered from the latest snapshot.
+  '''
+  def __init__(self, subnets: dict, interval=SAMPLE_INTERVAL):
+    self._interval = interval
+    self._logger = logging.getLogger('dss.CRM.sampler')
+    self._performance = None
+    self._processes = []
+    # pid -> (handle, static info), None for processes that are not listed
+    self._procs = dict()
+    self._stop = threading.Event()
+    self._thread = None
+
+    # project -> (ip regexp, port regexp), compiled once
+    self._patterns = dict()
+    for (project, subnet) in subnets.items():
+      port_three_first = str(subnet['crm_port'])[:3]
+      self._patterns[project] = (re.compile(f'^.*[:=]{subnet["ip"]}[0-9][0-9].*$'), re.compile(f'^.*[=:]{port_three_first}[0-9][0-9]'))
+
+  @property
+  def performance(self) -> str:
+    return self._performance
+
+  @property
+  def processes(self) -> list:
+    '''[{pid, name, cpu_percent, memory_percent, create_time, cmdline, cmd, project, created}], not to be modified'''
+    return self._processes
+
+  def start(self):
+    self.sample()
+    self._thread = threading.Thread(target=self._main, daemon=True, name='crm_sampler')
+    self._thread.start()
+
+  def stop(self):
+    self._stop.set()
+    if self._thread is not None and self._thread is not threading.current_thread():
+      self._thread.join()
+
+  def sample(self):
+    self._processes = self._sample_processes()
+    self._performance = self._sample_performance()
+
+  def _classify(self, cmd) -> str:
+    for (project, (regexp_ip, regexp_port)) in self._patterns.items():
+      if regexp_ip.match(cmd) or regexp_port.match(cmd):
+        return project
+    return 'unknown'
+
+  def _new_proc(self, pid):
+    proc = psutil.Process(pid)
+    name = proc.name()
+    if 'python' not in name.lower() and 'arducopter' not in name and 'mavproxy' not in name:
+      return None
+    info = proc.as_dict(attrs=['pid', 'name', 'create_time', 'cmdline'])
+    info['cmd'] = ' '.join(info['cmdline'])
+    if not info['cmd']:
+      return None
+    info['project'] = self._classify(info['cmd'])
+    info['created'] = datetime.datetime.fromtimestamp(info['create_time']).strftime('%Y-%m-%d %H:%M:%S')
+    # the first CPU measurement starts now
+    proc.cpu_percent()
+    return (proc, info)
+
+  def _sample_processes(self) -> list:
+    pids = set(psutil.pids())
+    for pid in self._procs.keys() - pids:
+      del self._procs[pid]
+
+    processes = list()
+    for pid in pids:
+      try:
+        if pid not in self._procs:
+          self._procs[pid] = self._new_proc(pid)
+        if self._procs[pid] is None:
+          continue
+        (proc, static) = self._procs[pid]
+        info = dict(static)
+        with proc.oneshot():
+          info['cpu_percent'] = proc.cpu_percent()
+          info['memory_percent'] = str(round(proc.memory_percent(), 1))
+        processes.append(info)
+      except (psutil.NoSuchProcess, psutil.ZombieProcess):
+        self._procs.pop(pid, None)
+      except psutil.AccessDenied:
+        self._procs[pid] = None
+    return processes
+
+  def _sample_performance(self) -> str:
+    current_time = datetime.datetime.now().strftime("%H:%M:%S")
+    # CPU usage since the previous sample
+    cpu = str(psutil.cpu_percent(interval=None)).zfill(5)
+    memory = psutil.virtual_memory()
+    mem = str(memory.percent).zfill(5)
+    load = [str(round(x*100)).zfill(3) + '%' for x in os.getloadavg()]
+    load = '(' + ', '.join(load) + ')'
+    return f'{cpu}% @ {psutil.cpu_freq().current}MHz x {psutil.cpu_count(logical=True)} {load} - {mem}% of {memory.total // 2**20}MB - time {current_time}'
+
+  def _main(self):
+    while not self._stop.wait(self._interval):
+      try:
+        self.sample()
+      except:
+        self._logger.error(f'sampling failed\n{traceback.format_exc()}')
+
+
 class CRM:
   def __init__(self, ip: str, port: int, virgin=True):
     self._logger = logging.getLogger('dss.CRM')
@@ -30,6 +456,7 @@ class CRM:
     assert dss.auxiliaries.zmq_lib.valid_ip(ip), f'bad ip address: {ip}'
 
     self._commands = {'app_lost':            self._request_app_lost,
+                      'batch':               self._request_batch,
                       'clients':             self._request_clients,
                       'delStaleClients':     self._request_delStaleClients,
                       'get_drone':           self._request_get_drone,
@@ -53,7 +480,9 @@ class CRM:
     self._types = ('dss', 'da', 'dsa','sen')
 
     self._alive = True
-    self._clients = {}
+    # registry changes are persisted by the journal thread, heartbeats are not
+    self._journal = ClientJournal(self._backup)
+    self._clients = ClientRegistry(self._journal)
     self._context = dss.auxiliaries.zmq_lib.Context()
     self._ip = ip
     self._nextIndex = 1
@@ -64,15 +493,28 @@ class CRM:
     self._git_branch = dss.auxiliaries.git.branch()
     self._git_version = dss.auxiliaries.git.describe()
 
+    # sockets to the clients, reused by the tasks
+    self._pool = dss.auxiliaries.zmq_lib.ConnectionPool(self._context, timeout=2000)
+
+    # requests and stale client deletion are events of the main thread, it is
+    # the only thread that changes the clients. Slow requests go to the workers.
+    self._reactor = dss.auxiliaries.Reactor(self._context)
+    self._workers = concurrent.futures.ThreadPoolExecutor(max_workers=4, thread_name_prefix='crm_worker')
+    self._worker_futures = set() # queued or running, cancelled by kill
+
     self._task_queue = dss.auxiliaries.TaskQueue()
     self._task_queue.start()
 
-    if virgin:
-      self._export_clients()
-    else:
+    # get_processes and get_performance are answered from its snapshot
+    self._sampler = ProcessSampler(config['zeroMQ']['subnets'])
+    self._sampler.start()
+
+    if not virgin:
       self._import_clients()
+    self._journal.compact()
+    self._journal.start()
 
-    self._socket = dss.auxiliaries.zmq_lib.Rep(self._context, port=port, label='crm')
+    self._socket = dss.auxiliaries.zmq_lib.Router(self._context, port=port, label='crm')
     self._pub_socket = dss.auxiliaries.zmq_lib.Pub(self._context, port=port+1, label='crm')
 
   @property
@@ -82,7 +524,15 @@ class CRM:
 
   def kill(self):
     self._task_queue.stop()
+    self._sampler.stop()
+    # shutdown(cancel_futures=True) requires python 3.9
+    for future in list(self._worker_futures):
+      future.cancel()
+    self._workers.shutdown(wait=False)
+    self._pool.close()
+    self._journal.stop()
     self._alive = False
+    self._reactor.stop()
 
 #.-.-.-.-.-.-.-.-.-.-.-.-.-.-.-.-.-.-.-.-.-.-.-.-.-.-.-.-.-.-.-.-.-.-#
 # TASKS that the CRM will handle asynchronously
@@ -93,14 +543,12 @@ class CRM:
     ip = self._clients[client_name]['ip']
     port = self._clients[client_name]['port']
 
-    socket = dss.auxiliaries.zmq_lib.Req(self._context, ip=ip, port=port, label=client_name, timeout=2000)
-
     for x in range(3):
       self._logger.info(f'task_set_owner, try {x}')
       try:
-        answer = socket.send_and_receive({'fcn': 'set_owner', 'id': 'crm', 'owner': new_owner})
+        answer = self._pool.send_and_receive(ip, port, {'fcn': 'set_owner', 'id': 'crm', 'owner': new_owner}, label=client_name)
         if dss.auxiliaries.zmq_lib.is_ack(answer):
-          self._clients[client_name]['owner'] = new_owner
+          self._reactor.call_soon(lambda: self._set_owner(client_name, new_owner))
           return
       except dss.auxiliaries.exception.NoAnswer:
         self._logger.warning('NoAnswer sending set_owner')
@@ -112,15 +560,10 @@ class CRM:
     port = self._clients[client_name]['port']
 
     # RTL only if drone is armed!
-    socket = dss.auxiliaries.zmq_lib.Req(self._context, ip=ip, port=port, label=client_name)
-
-    answer = socket.send_and_receive({'fcn': 'get_armed', 'id': 'crm'})
+    answer = self._pool.send_and_receive(ip, port, {'fcn': 'get_armed', 'id': 'crm'}, label=client_name)
     if dss.auxiliaries.zmq_lib.is_ack(answer):
       if bool(answer['armed']):
-        id_app = '{type}{index:03d}'.format(type='da', index=self._nextIndex)
-        self._nextIndex += 1
-        self._clients[id_app] = {'name': 'SRTL', 'desc': 'landing a drone', 'type': 'da', 'owner': 'crm', 'ip': '', 'port': '', 'timestamp': self._now}
-        dss.auxiliaries.spawnDaemon.spawnDaemon('./app_srtl.py', 'app_srtl.py', f'--id={id_app}', f'--ip={self._ip}', f'--port={self._socket.port}', f'--dss={client_name}')
+        self._reactor.call_soon(lambda: self._launch_srtl(client_name))
 
   def task_start_battery_stream(self, client_name):
     self._logger.info('task_start_battery_stream')
@@ -128,95 +571,124 @@ class CRM:
     ip = self._clients[client_name]['ip']
     port = self._clients[client_name]['port']
 
-    socket = dss.auxiliaries.zmq_lib.Req(self._context, ip=ip, port=port, label=client_name, timeout=2000)
     for x in range(3):
       self._logger.info(f'enable battery stream, try {x}')
       try:
-        answer = socket.send_and_receive({'fcn': 'data_stream', 'id': 'crm', 'stream': 'battery', 'enable': True})
+        answer = self._pool.send_and_receive(ip, port, {'fcn': 'data_stream', 'id': 'crm', 'stream': 'battery', 'enable': True}, label=client_name)
         if dss.auxiliaries.zmq_lib.is_ack(answer):
           return
       except dss.auxiliaries.exception.NoAnswer:
         self._logger.warning('NoAnswer sending battery stream')
         pass
 
+  # The tasks change the clients through the main thread
+  def _set_owner(self, client_name, new_owner):
+    if client_name in self._clients:
+      self._clients.update(client_name, owner=new_owner)
+
+  def _launch_srtl(self, client_name):
+    id_app = self._new_id('da')
+    self._clients.add(id_app, {'name': 'SRTL', 'desc': 'landing a drone', 'type': 'da', 'owner': 'crm', 'ip': '', 'port': '', 'timestamp': self._now})
+    dss.auxiliaries.spawnDaemon.spawnDaemon('./app_srtl.py', 'app_srtl.py', f'--id={id_app}', f'--ip={self._ip}', f'--port={self._socket.port}', f'--dss={client_name}')
+
 #.-.-.-.-.-.-.-.-.-.-.-.-.-.-.-.-.-.-.-.-.-.-.-.-.-.-.-.-.-.-.-.-.-.-#
   def _get_clients(self, filter='') -> dict:
-    client_list = {}
-    for id_, client in self._clients.items():
-      if filter in id_ and client['ip'] and client['port']:
-        client_list[id_] = client
-    return client_list
+    return self._clients.filter(filter)
 
   def main(self):
     self._logger.info('CRM is listening on {ip}:{port}'.format(ip=self._ip, port=self._socket.port))
 
-    while self._alive:
-      self._now = datetime.datetime.now().timestamp()
+    self._reactor.add_socket(self._socket, self._on_request)
+    self._reactor.call_soon(self._on_expiry)
+    self._reactor.run()
 
-      try:
-        msg = self._socket.recv_json()
-      except dss.auxiliaries.exception.Again as error:
-        self.delStaleClients()
-        continue # timeout: no message received; try again
-
-      msg = json.loads(msg)
-
-      fcn = dss.auxiliaries.zmq_lib.get_fcn(msg)
-      if fcn in self._commands:
-        if 'id' in msg:
-          id_ = msg['id']
-          if id_ in self._clients:
-            self._clients[id_]['timestamp'] = self._now
-
-        try:
-          answer = self._commands[fcn](msg)
-          self._export_clients()
-        except:
-          self._logger.error(f'unexpected exception\n{traceback.format_exc()}')
-          answer = dss.auxiliaries.zmq_lib.nack(fcn, 'unexpected exception')
-      else:
-        answer = dss.auxiliaries.zmq_lib.nack(fcn, 'request is not supported')
+    self._main_thread = None
 
-      answer = json.dumps(answer)
-      self._socket.send_json(answer)
+  def _on_request(self):
+    self._now = datetime.datetime.now().timestamp()
 
-    self._main_thread = None
+    try:
+      (envelope, msg) = self._socket.recv_request()
+    except dss.auxiliaries.exception.Again:
+      return
+
+    fcn = dss.auxiliaries.zmq_lib.get_fcn(msg)
+    if fcn in self._commands:
+      if 'id' in msg:
+        self._clients.touch(msg['id'], self._now)
+
+      if fcn in WORKER_REQUESTS:
+        # the worker replies through the main thread, the socket is not thread safe
+        future = self._workers.submit(self._on_worker_request, fcn, msg, envelope)
+        self._worker_futures.add(future)
+        future.add_done_callback(self._worker_futures.discard)
+        return
+      answer = self._handle(fcn, msg)
+    else:
+      answer = dss.auxiliaries.zmq_lib.nack(fcn, 'request is not supported')
+
+    self._socket.send(answer, envelope)
+
+  def _on_worker_request(self, fcn, msg, envelope):
+    answer = self._handle(fcn, msg)
+    self._reactor.call_soon(lambda: self._socket.send(answer, envelope))
+
+  def _handle(self, fcn, msg) -> dict:
+    try:
+      return self._commands[fcn](msg)
+    except:
+      self._logger.error(f'unexpected exception\n{traceback.format_exc()}')
+      return dss.auxiliaries.zmq_lib.nack(fcn, 'unexpected exception')
+
+  # Stale clients are deleted when their lease expires, the timer follows the oldest lease
+  def _on_expiry(self):
+    self._now = datetime.datetime.now().timestamp()
+    self.delStaleClients()
+    deadline = self._clients.next_expiry(STALE_TIME)
+    delay = STALE_TIME if deadline is None else deadline - self._now
+    # expiry is strictly after the deadline
+    self._reactor.call_later(min(max(delay, 0.0) + 0.01, STALE_TIME), self._on_expiry)
 
   def delStaleClients(self) -> list:
-    clientsToDelete = list()
-    for id_, client in self._clients.items():
-      if self._now - client['timestamp'] > 15: #seconds
-        clientsToDelete.append(id_)
+    clientsToDelete = self._clients.expired(self._now, STALE_TIME)
 
     for id_ in clientsToDelete:
       timestamp = self._clients[id_]["timestamp"]
       self._logger.warning(f'deleting {id_} {self._clients[id_]}')
 
       # If id_ (to be deleted) is owner of other client, something is wrong, write to log
-      for all_id, all_client in self._clients.items():
-        if all_client['owner'] == id_:
-         self._logger.warning(f'CRM is deleting app {id_} that is owner of dss {all_client}')
+      for owned_id in self._clients.owned_by(id_):
+        self._logger.warning(f'CRM is deleting app {id_} that is owner of dss {self._clients[owned_id]}')
 
-      del self._clients[id_]
+      self._clients.remove(id_)
       self._logger.info(f'client {id_} got removed - it was inactive for {self._now - timestamp} seconds')
 
     return clientsToDelete
 
-  def _export_clients(self):
-    backup = {'nextIndex': self._nextIndex, 'clients': self._clients}
-    with open('clients.json', 'w') as file:
-      json.dump(backup, file, indent=2)
+  def _new_id(self, type_) -> str:
+    id_ = '{type}{index:03d}'.format(type=type_, index=self._nextIndex)
+    self._nextIndex += 1
+    self._journal.append({'op': 'next_index', 'next_index': self._nextIndex})
+    return id_
+
+  def _backup(self) -> dict:
+    # the state saved by the journal
+    return {'nextIndex': self._nextIndex, 'clients': self._clients.as_dict()}
 
   def _import_clients(self):
     try:
-      with open('clients.json') as file:
-        backup = json.load(file)
-      self._nextIndex = backup['nextIndex']
-      self._clients = backup['clients']
+      (backup, records) = self._journal.load()
+      self._nextIndex = max([backup['nextIndex']] + [record['next_index'] for record in records if record['op'] == 'next_index'])
+      self._clients.load(backup['clients'], records)
     except:
-      self._logger.error("backup file 'clients.json' couldn't be loaded")
+      self._logger.error(f"backup file 'clients.json' couldn't be loaded\n{traceback.format_exc()}")
       self._nextIndex = 1
-      self._clients = {}
+      self._clients.clear()
+      return
+    # the clients could not reach the CRM while it was down, start their leases now
+    now = datetime.datetime.now().timestamp()
+    for id_, _ in self._clients.items():
+      self._clients.touch(id_, now)
 
 #.-.-.-.-.-.-.-.-.-.-.-.-.-.-.-.-.-.-.-.-.-.-.-.-.-.-.-.-.-.-.-.-.-.-#
 # REQUESTS that the CRM will handle synchronously
@@ -243,6 +715,33 @@ class CRM:
 
     return dss.auxiliaries.zmq_lib.ack(fcn)
 
+  def _request_batch(self, msg: dict) -> dict:
+    fcn = dss.auxiliaries.zmq_lib.get_fcn(msg)
+
+    # check arguments
+    if not all(key in msg for key in ['id', 'requests']) or not isinstance(msg['requests'], list):
+      return dss.auxiliaries.zmq_lib.nack(fcn, 'bad arguments: {id, requests} are mandatory')
+
+    answers = list()
+    for request in msg['requests']:
+      sub_fcn = dss.auxiliaries.zmq_lib.get_fcn(request) if isinstance(request, dict) else ''
+      if sub_fcn not in self._commands or sub_fcn == fcn:
+        answers.append(dss.auxiliaries.zmq_lib.nack(sub_fcn, 'request is not supported'))
+        continue
+
+      request = dict(request)
+      request.setdefault('id', msg['id'])
+      self._clients.touch(request['id'], self._now)
+
+      # one failing request must not take the rest of the batch with it
+      try:
+        answers.append(self._commands[sub_fcn](request))
+      except:
+        self._logger.error(f'unexpected exception\n{traceback.format_exc()}')
+        answers.append(dss.auxiliaries.zmq_lib.nack(sub_fcn, 'unexpected exception'))
+
+    return dss.auxiliaries.zmq_lib.ack(fcn, {'answers': answers})
+
   def _request_clients(self, msg: dict) -> dict:
     fcn = dss.auxiliaries.zmq_lib.get_fcn(msg)
 
@@ -296,18 +795,9 @@ class CRM:
       self._task_queue.add(self.task_set_owner, force, requester_id)
       return dss.auxiliaries.zmq_lib.ack(fcn, {'id': force, 'ip': self._clients[force]['ip'], 'port': self._clients[force]['port']})
     else:
-      #Get capabilities as a set for easy comparison. The casefold makes sure that the comparison is not case sensitive
-      capabilities = set({capa.casefold(): capa for capa in msg['capabilities']})
-      drone_found = False
-      n_capabilities = 100
-      for id_, client in self._clients.items():
-        client_capabilities = set({capa.casefold(): capa for capa in client['capabilities']})
-        # Try to find a suitable drone. Pick the one with least amount of total capabilities that satisfies the requirements.
-        if client['owner'] == 'crm' and client['type'] == 'dss' and capabilities.issubset(client_capabilities) and len(client_capabilities) < n_capabilities and (self._now - client['timestamp']) < 20:
-          drone_found = True
-          n_capabilities = len(client_capabilities)
-          dss_id = id_
-      if drone_found:
+      # Pick the free drone with least amount of total capabilities that satisfies the requirements, the comparison is not case sensitive
+      dss_id = self._clients.find_free('dss', msg['capabilities'], self._now, 20)
+      if dss_id is not None:
         self._task_queue.add(self.task_set_owner, dss_id, requester_id)
         return dss.auxiliaries.zmq_lib.ack(fcn, {'id': dss_id, 'ip': self._clients[dss_id]['ip'], 'port': self._clients[dss_id]['port']})
 
@@ -340,18 +830,9 @@ class CRM:
       self._task_queue.add(self.task_set_owner, force, requester_id)
       return dss.auxiliaries.zmq_lib.ack(fcn, {'id': force, 'ip': self._clients[force]['ip'], 'port': self._clients[force]['port']})
     else:
-      #Get capabilities as a set for easy comparison. The casefold makes sure that the comparison is not case sensitive
-      capabilities = set({capa.casefold(): capa for capa in msg['capabilities']})
-      sensor_found = False
-      n_capabilities = 100
-      for id_, client in self._clients.items():
-        client_capabilities = set({capa.casefold(): capa for capa in client['capabilities']})
-        # Try to find a suitable drone. Pick the one with least amount of total capabilities that satisfies the requirements.
-        if client['owner'] == 'crm' and client['type'] == 'sen' and capabilities.issubset(client_capabilities) and len(client_capabilities) < n_capabilities and (self._now - client['timestamp']) < 20:
-          sensor_found = True
-          n_capabilities = len(client_capabilities)
-          sen_id = id_
-      if sensor_found:
+      # Pick the free sensor with least amount of total capabilities that satisfies the requirements, the comparison is not case sensitive
+      sen_id = self._clients.find_free('sen', msg['capabilities'], self._now, 20)
+      if sen_id is not None:
         self._task_queue.add(self.task_set_owner, sen_id, requester_id)
         return dss.auxiliaries.zmq_lib.ack(fcn, {'id': sen_id, 'ip': self._clients[sen_id]['ip'], 'port': self._clients[sen_id]['port']})
 
@@ -369,7 +850,7 @@ class CRM:
     if requester not in self._clients and requester != 'root':
       return dss.auxiliaries.zmq_lib.nack(fcn, 'unknown client id')
 
-    return dss.auxiliaries.zmq_lib.ack(fcn, {'info_pub_port': self._pub_socket.port, 'data_pub_port': None, 'version': __version__, 'git_version': self._git_version, 'git_branch': self._git_branch})
+    return dss.auxiliaries.zmq_lib.ack(fcn, {'info_pub_port': self._pub_socket.port, 'data_pub_port': None, 'version': __version__, 'git_version': self._git_version, 'git_branch': self._git_branch, 'codecs': dss.auxiliaries.zmq_lib.available_codecs()})
 
   def _request_get_processes(self, msg: dict) -> dict:
     fcn = dss.auxiliaries.zmq_lib.get_fcn(msg)
@@ -383,33 +864,8 @@ class CRM:
     if requester not in self._clients and requester != 'root':
       return dss.auxiliaries.zmq_lib.nack(fcn, 'unknown client id')
 
-    #List all processes
-    processes = list()
-    for proc in psutil.process_iter():
-      try:
-        if 'python' not in proc.name().lower() and 'arducopter' not in proc.name() and 'mavproxy' not in proc.name():
-          continue
-        # get process detail as dictionary
-        info = proc.as_dict(attrs=['pid', 'name', 'cpu_percent', 'memory_percent', 'create_time', 'cmdline'])
-        info['cmd'] = ' '.join(info['cmdline'])
-        if not info['cmd']:
-          continue
-        info['project'] = 'unknown'
-        for _project in config["zeroMQ"]["subnets"]:
-          regexp_ip = re.compile(f'^.*[:=]{config["zeroMQ"]["subnets"][_project]["ip"]}[0-9][0-9].*$')
-          port_three_first = str(config["zeroMQ"]["subnets"][_project]["crm_port"])[:3]
-          regexp_port = re.compile(f'^.*[=:]{port_three_first}[0-9][0-9]')         
-
-          if regexp_ip.match(info['cmd']) or regexp_port.match(info['cmd']):
-            info['project'] = _project
-            break
-        info['killable'] = 'crm.py' not in info['cmd'] and project == info['project']
-        info['memory_percent'] = str(round(info['memory_percent'], 1))
-        info['created'] = datetime.datetime.fromtimestamp(info['create_time']).strftime('%Y-%m-%d %H:%M:%S')
-
-        processes.append(info)
-      except (psutil.NoSuchProcess, psutil.AccessDenied, psutil.ZombieProcess):
-        pass
+    #List all processes, from the latest sample
+    processes = [dict(info, killable='crm.py' not in info['cmd'] and project == info['project']) for info in self._sampler.processes]
     msg = dss.auxiliaries.zmq_lib.ack(fcn)
     msg['processes'] = processes
     return msg
@@ -420,14 +876,8 @@ class CRM:
     if not all(key in msg for key in ['id']):
       return dss.auxiliaries.zmq_lib.nack(fcn, 'bad arguments: {id} is mandatory')
 
-    now = datetime.datetime.now()
-    current_time = now.strftime("%H:%M:%S")
-    cpu = str(psutil.cpu_percent(interval=0.1)).zfill(5)
-    mem = str(psutil.virtual_memory().percent).zfill(5)
-    load = [str(round(x*100)).zfill(3) + '%' for x in os.getloadavg()]
-    load = '(' + ', '.join(load) + ')'
     msg = dss.auxiliaries.zmq_lib.ack(fcn)
-    msg['performance'] = f'{cpu}% @ {psutil.cpu_freq().current}MHz x {psutil.cpu_count(logical=True)} {load} - {mem}% of {psutil.virtual_memory().total // 2**20}MB - time {current_time}'
+    msg['performance'] = self._sampler.performance
     return msg
 
   def _request_kill_process(self, msg: dict) -> dict:
@@ -485,10 +935,9 @@ class CRM:
 
     app = msg['app']
 
-    id_app = '{type}{index:03d}'.format(type='da', index=self._nextIndex)
-    self._nextIndex += 1
+    id_app = self._new_id('da')
 
-    self._clients[id_app] = {'name': app, 'desc': '', 'type': 'da', 'owner': owner, 'ip': '', 'port': '', 'timestamp': self._now}
+    self._clients.add(id_app, {'name': app, 'desc': '', 'type': 'da', 'owner': owner, 'ip': '', 'port': '', 'timestamp': self._now})
 
     launch = msg['launch'] if 'launch' in msg else True
     if launch:
@@ -518,9 +967,8 @@ class CRM:
     subprocess.Popen(['build/sitl/bin/arducopter', '-S', '--model', '+', '--speedup', '1', '--home', f'{config["CRM"]["SITL"]["drone_1"]["lat"]},{config["CRM"]["SITL"]["drone_1"]["lon"]},{config["CRM"]["SITL"]["drone_1"]["alt"]},{config["CRM"]["SITL"]["drone_1"]["heading"]}', f'--defaults={config["CRM"]["SITL"]["ardupilot_dir"]}Tools/autotest/default_params/copter.parm', f'--base-port={port+56}', '-I0', '--sysid', '1'], cwd=f'{config["CRM"]["SITL"]["ardupilot_dir"]}', shell=False)
     subprocess.Popen([config["CRM"]["SITL"]["pythonPATH"], config["CRM"]["SITL"]["mavproxyPATH"], f'--master=tcp:127.0.0.1:{port+56}', f'--out=tcpin:0.0.0.0:{port+87}', f'--out=tcpin:0.0.0.0:{port+88}', '--daemon'], cwd=f'{config["CRM"]["SITL"]["ardupilot_dir"]}', shell=False)
 
-    dss_id = '{type}{index:03d}'.format(type='dss', index=self._nextIndex)
-    self._nextIndex += 1
-    self._clients[dss_id] = {'name': 'crm_dss.py', 'desc': '', 'type': 'dss', 'owner': 'crm', 'ip': '', 'port': '', 'timestamp': self._now}
+    dss_id = self._new_id('dss')
+    self._clients.add(dss_id, {'name': 'crm_dss.py', 'desc': '', 'type': 'dss', 'owner': 'crm', 'ip': '', 'port': '', 'timestamp': self._now})
     dss.auxiliaries.spawnDaemon.spawnDaemon('./crm_dss.py', 'crm_dss.py', f'--dss_id={dss_id}', f'--crm={self._ip}:{self._socket.port}', f'--drone={self._ip}:{port+88}', f'--dss_ip={self._ip}', '--descr=dss->port 88 [SIM]', '--without-clearance-check', '--without-midstick-check', '--capabilities', 'C0', 'RTK', 'LMD', 'RGB', 'VIDEO', 'SIM')
     return dss.auxiliaries.zmq_lib.ack(fcn)
 
@@ -547,19 +995,16 @@ class CRM:
     subprocess.Popen(['build/sitl/bin/arducopter', '-S', '--model', '+', '--speedup', '1', '--home', f'{config["CRM"]["SITL"]["drone_4"]["lat"]},{config["CRM"]["SITL"]["drone_4"]["lon"]},{config["CRM"]["SITL"]["drone_4"]["alt"]},{config["CRM"]["SITL"]["drone_4"]["heading"]}', f'--defaults={config["CRM"]["SITL"]["ardupilot_dir"]}Tools/autotest/default_params/copter.parm', f'--base-port={port+71}', '-I2', '--sysid', '3'], cwd=f'{config["CRM"]["SITL"]["ardupilot_dir"]}', shell=False)
     subprocess.Popen([config["CRM"]["SITL"]["pythonPATH"], config["CRM"]["SITL"]["mavproxyPATH"], f'--master=tcp:127.0.0.1:{port+71}', f'--out=tcpin:0.0.0.0:{port+85}', f'--out=tcpin:0.0.0.0:{port+86}', '--daemon'], cwd=f'{config["CRM"]["SITL"]["ardupilot_dir"]}', shell=False)
 
-    dss_id = '{type}{index:03d}'.format(type='dss', index=self._nextIndex)
-    self._nextIndex += 1
-    self._clients[dss_id] = {'name': 'crm_dss.py', 'desc': '', 'type': 'dss', 'owner': 'crm', 'ip': '', 'port': '', 'timestamp': self._now}
+    dss_id = self._new_id('dss')
+    self._clients.add(dss_id, {'name': 'crm_dss.py', 'desc': '', 'type': 'dss', 'owner': 'crm', 'ip': '', 'port': '', 'timestamp': self._now})
     dss.auxiliaries.spawnDaemon.spawnDaemon('./crm_dss.py', 'crm_dss.py', f'--dss_id={dss_id}', f'--crm={self._ip}:{self._socket.port}', f'--drone={self._ip}:{port+82}', f'--dss_ip={self._ip}', '--descr=dss->port 82 [SIM]', '--without-clearance-check', '--without-midstick-check', '--capabilities', 'C0', 'RGB', 'SIM')
 
-    dss_id = '{type}{index:03d}'.format(type='dss', index=self._nextIndex)
-    self._nextIndex += 1
-    self._clients[dss_id] = {'name': 'crm_dss.py', 'desc': '', 'type': 'dss', 'owner': 'crm', 'ip': '', 'port': '', 'timestamp': self._now}
+    dss_id = self._new_id('dss')
+    self._clients.add(dss_id, {'name': 'crm_dss.py', 'desc': '', 'type': 'dss', 'owner': 'crm', 'ip': '', 'port': '', 'timestamp': self._now})
     dss.auxiliaries.spawnDaemon.spawnDaemon('./crm_dss.py', 'crm_dss.py', f'--dss_id={dss_id}', f'--crm={self._ip}:{self._socket.port}', f'--drone={self._ip}:{port+84}', f'--dss_ip={self._ip}', '--descr=dss->port 84 [SIM]', '--without-clearance-check', '--without-midstick-check', '--capabilities', 'RTK',  'RGB', 'VIDEO', 'SPOTLIGHT', 'SIM')
 
-    dss_id = '{type}{index:03d}'.format(type='dss', index=self._nextIndex)
-    self._nextIndex += 1
-    self._clients[dss_id] = {'name': 'crm_dss.py', 'desc': '', 'type': 'dss', 'owner': 'crm', 'ip': '', 'port': '', 'timestamp': self._now}
+    dss_id = self._new_id('dss')
+    self._clients.add(dss_id, {'name': 'crm_dss.py', 'desc': '', 'type': 'dss', 'owner': 'crm', 'ip': '', 'port': '', 'timestamp': self._now})
     dss.auxiliaries.spawnDaemon.spawnDaemon('./crm_dss.py', 'crm_dss.py', f'--dss_id={dss_id}', f'--crm={self._ip}:{self._socket.port}', f'--drone={self._ip}:{port+86}', f'--dss_ip={self._ip}', '--descr=dss->port 86 [SIM]', '--without-clearance-check', '--without-midstick-check', '--capabilities', 'LMD', 'RTK', 'SIM')
 
     return dss.auxiliaries.zmq_lib.ack(fcn)
@@ -592,27 +1037,22 @@ class CRM:
       if not all(msg[key] == self._clients[id_][key] for key in ['name', 'type']):
         return dss.auxiliaries.zmq_lib.nack(fcn, 'unexpected name or type')
 
-      self._clients[id_]['ip'] = msg['ip']
-      self._clients[id_]['port'] = msg['port']
-      self._clients[id_]['desc'] = msg['desc']
-      #Store capabilities as a set for easy comparison. The casefold makes sure that the comparison is not case sensitive
-      self._clients[id_]['capabilities'] = msg['capabilities']
-      self._clients[id_]['timestamp'] = self._now
+      self._clients.update(id_, ip=msg['ip'], port=msg['port'], desc=msg['desc'], capabilities=msg['capabilities'], timestamp=self._now)
     else:
       # delete dss if one with same ip exists
       if msg['type'] == 'dss':
-        for client_id, client in self._clients.items():
-          if client['ip'] == msg['ip'] and client['type'] == msg['type']:
+        for client_id in self._clients.of_type(msg['type']):
+          client = self._clients[client_id]
+          if client['ip'] == msg['ip']:
             if self._now - client['timestamp'] < 20:
               return dss.auxiliaries.zmq_lib.nack(fcn, 'dss with same ip found')
             else:
               self._logger.warning('stale dss with same ip found and replaced')
-              self._logger.warning(f'deleting {client_id} {self._clients[client_id]}')
-              del self._clients[client_id]
+              self._logger.warning(f'deleting {client_id} {client}')
+              self._clients.remove(client_id)
 
-      id_ = '{type}{index:03d}'.format(type=msg['type'], index=self._nextIndex)
-      self._nextIndex += 1
-      self._clients[id_] = {'name': msg['name'], 'type': msg['type'], 'capabilities': msg['capabilities'], 'desc': msg['desc'], 'owner': 'crm', 'ip': msg['ip'], 'port': msg['port'], 'timestamp': self._now}
+      id_ = self._new_id(msg['type'])
+      self._clients.add(id_, {'name': msg['name'], 'type': msg['type'], 'capabilities': msg['capabilities'], 'desc': msg['desc'], 'owner': 'crm', 'ip': msg['ip'], 'port': msg['port'], 'timestamp': self._now})
     #Publish that a new client has been added to the list
     client_list = self._get_clients()
     self._pub_socket.publish('clients', client_list)
@@ -693,12 +1133,12 @@ class CRM:
     if id_ not in self._clients:
       return dss.auxiliaries.zmq_lib.nack(fcn, 'unknown client id')
 
-    for client_id, client in self._clients.items():
-      if client['owner'] == id_ and client['type'] == 'dss':
+    for client_id in self._clients.owned_by(id_):
+      if self._clients[client_id]['type'] == 'dss':
         self._task_queue.add(self.task_set_owner, client_id, 'crm')
 
     self._logger.warning(f'deleting {id_} {self._clients[id_]}')
-    del self._clients[id_]
+    self._clients.remove(id_)
     client_list = self._get_clients()
     self._pub_socket.publish('clients', client_list)
     return dss.auxiliaries.zmq_lib.ack(fcn)
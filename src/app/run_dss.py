@@ -28,6 +28,7 @@ def _main():
   parser.add_argument('--stdout', action='store_true', help='enables logging to stdout', required=False)
   parser.add_argument('--virgin', action='store_true', help='defines if to start from a backup or not', required=False)
   parser.add_argument('--with-autogain', action='store_true', help='Request GLANA to adjust the gain on every wp', required=False)
+  parser.add_argument('--with-flight-recorder', action='store_true', help='Records the vehicle attributes to log/<timestamp>_flight-data.fdr', required=False)
   parser.add_argument('--with-gcs', action='store_true', help='If used, flight requires connection to gcs', required=False)
   parser.add_argument('--with-photo', action='store_true', help='Specifies if dss server should connect to photo server', required=False)
   parser.add_argument('--with-rangefinder', action='store_true', help='Rangefinder is used for mission flights', required=False)
@@ -39,7 +40,7 @@ def _main():
 
   # start dss
   try:
-    server = Server(dss_ip=args.dss_ip, drone=args.drone, baud=args.baud, with_gcs=args.with_gcs, gcs_address=args.gcs_address, rangefinder=args.with_rangefinder, autogain=args.with_autogain, midstick_check=not args.without_midstick_check, clearance_check=not args.without_clearance_check, photo=args.with_photo)
+    server = Server(dss_ip=args.dss_ip, drone=args.drone, baud=args.baud, with_gcs=args.with_gcs, gcs_address=args.gcs_address, rangefinder=args.with_rangefinder, autogain=args.with_autogain, midstick_check=not args.without_midstick_check, clearance_check=not args.without_clearance_check, photo=args.with_photo, flight_recorder=args.with_flight_recorder)
   except dss.auxiliaries.exception.Error as error:
     logging.critical(str(error))
     sys.exit()
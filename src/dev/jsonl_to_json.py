@@ -0,0 +1,58 @@
+#!/usr/bin/python3
+
+import argparse
+import json
+
+import dss.auxiliaries
+
+#--------------------------------------------------------------------#
+
+__author__ = 'Lennart Ochel <>, Andreas Gising <andreas.gising@ri.se>, Kristoffer Bergman <kristoffer.bergman@ri.se>, Hanna Müller <hanna.muller@ri.se>, Joel Nordahl'
+__version__ = '1.0.0'
+__copyright__ = 'Copyright (c) 2023, RISE'
+__status__ = 'development'
+
+#--------------------------------------------------------------------#
+
+'''Converts a JSON lines record, e.g. the DSS network log, to a pretty printed JSON file.
+
+The samples are streamed, the record is never loaded as a whole. The
+default output is a list of the samples, --numbered gives the legacy
+network log format, {"static_info": {..}, "0": {..}, "1": {..}, ..}.
+'''
+
+def convert(infile, outfile, numbered=False, indent=4):
+  samples = dss.auxiliaries.recorder.read_jsonl(infile)
+  with open(outfile, 'w', encoding='utf-8') as out:
+    out.write('{' if numbered else '[')
+    index = 0
+    for (n, sample) in enumerate(samples):
+      out.write(',\n' if n else '\n')
+      if numbered:
+        # Samples that wrap a dict under a single key, e.g. static_info, keep their key
+        if len(sample) == 1 and isinstance(next(iter(sample.values())), dict):
+          (key, sample) = next(iter(sample.items()))
+        else:
+          key = str(index)
+          index += 1
+        out.write(json.dumps(key) + ': ')
+      out.write(json.dumps(sample, indent=indent))
+    out.write('\n}\n' if numbered else '\n]\n')
+
+#--------------------------------------------------------------------#
+def _main():
+  parser = argparse.ArgumentParser(description='Convert a JSON lines record to JSON', allow_abbrev=False)
+  parser.add_argument('infile', type=str, help='JSON lines file')
+  parser.add_argument('outfile', type=str, nargs='?', help='JSON file, default infile with extension .json')
+  parser.add_argument('--numbered', action='store_true', help='numbered dict instead of a list')
+  args = parser.parse_args()
+
+  outfile = args.outfile
+  if outfile is None:
+    outfile = args.infile[:-len('.jsonl')] if args.infile.endswith('.jsonl') else args.infile
+    outfile += '.json'
+  convert(args.infile, outfile, numbered=args.numbered)
+
+#--------------------------------------------------------------------#
+if __name__ == '__main__':
+  _main()
@@ -9,10 +9,13 @@ from . import (
     kalman,
     logging,
     math_lib,
+    recorder,
     spawnDaemon,
     zmq_lib,
 )
 from .getch import getch
+from .loop import RateLoop
+from .reactor import Reactor
 from .task_queue import TaskQueue
 
 __author__ = 'Lennart Ochel <>, Andreas Gising <andreas.gising@ri.se>, Kristoffer Bergman <kristoffer.bergman@ri.se>, Hanna Müller <hanna.muller@ri.se>, Joel Nordahl'
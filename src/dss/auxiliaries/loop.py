@@ -0,0 +1,104 @@
+'''Fixed-rate loop scheduler
+
+The loop keeps absolute deadlines on the monotonic clock, hence the
+period does not drift with the time spent in the loop body. A deadline
+that is already passed when the body is done counts as an overrun, the
+schedule then restarts from now instead of running the missed iterations
+back to back.
+
+Example:
+  loop = RateLoop(20, abort_event)
+  while not done:
+    control()
+    loop.sleep()
+  print(loop.stats)
+
+sleep() waits on the abort event, an abort interrupts the wait right
+away and raises AbortTask.
+'''
+
+import logging
+import math
+import threading
+import time
+
+import dss.auxiliaries.exception
+
+__author__ = 'Lennart Ochel <>, Andreas Gising <andreas.gising@ri.se>, Kristoffer Bergman <kristoffer.bergman@ri.se>, Hanna Müller <hanna.muller@ri.se>, Joel Nordahl'
+__version__ = '1.0.0'
+__copyright__ = 'Copyright (c) 2023, RISE'
+__status__ = 'development'
+
+_logger = logging.getLogger(__name__)
+
+class RateLoop:
+  '''Fixed-rate loop scheduler'''
+  def __init__(self, rate, abort_event=None, label='loop'):
+    if rate <= 0:
+      raise dss.auxiliaries.exception.InputError(rate, 'rate must be positive')
+    self._abort_event = abort_event if abort_event else threading.Event()
+    self._label = label
+    self._period = 1.0/rate
+    self.reset()
+
+  @property
+  def period(self) -> float:
+    return self._period
+
+  @property
+  def stats(self) -> dict:
+    '''Iterations, overruns, measured period and wake-up jitter [s]'''
+    n = self._n_periods
+    mean = self._sum_period/n if n else None
+    std = math.sqrt(max(0.0, self._sum_period_sq/n - mean**2)) if n else None
+    return {'iterations': self._iterations,
+            'overruns': self._overruns,
+            'period': self._period,
+            'period_mean': mean,
+            'period_std': std,
+            'period_max': self._max_period if n else None,
+            'jitter_max': self._max_jitter}
+
+  def reset(self):
+    '''Restarts the schedule and the statistics'''
+    self._deadline = time.monotonic() + self._period
+    self._iterations = 0
+    self._overruns = 0
+    self._t_wakeup = None
+    self._n_periods = 0
+    self._sum_period = 0.0
+    self._sum_period_sq = 0.0
+    self._max_period = 0.0
+    self._max_jitter = 0.0
+
+  def sleep(self):
+    '''Waits for the next deadline, raises AbortTask if the abort event is set'''
+    self._iterations += 1
+    now = time.monotonic()
+    if now > self._deadline:
+      self._overruns += 1
+      _logger.debug('%s overrun by %.1f ms', self._label, (now - self._deadline)*1000)
+      self._deadline = now
+    elif self._abort_event.wait(self._deadline - now):
+      raise dss.auxiliaries.exception.AbortTask()
+    if self._abort_event.is_set():
+      raise dss.auxiliaries.exception.AbortTask()
+
+    now = time.monotonic()
+    self._max_jitter = max(self._max_jitter, now - self._deadline)
+    if self._t_wakeup is not None:
+      period = now - self._t_wakeup
+      self._n_periods += 1
+      self._sum_period += period
+      self._sum_period_sq += period*period
+      self._max_period = max(self._max_period, period)
+    self._t_wakeup = now
+    self._deadline += self._period
+
+  def log_stats(self, logger=_logger):
+    stats = self.stats
+    if stats['period_mean'] is None:
+      return
+    logger.info('%s: %d iterations, %d overruns, period %.1f ms (std %.1f, max %.1f), max jitter %.1f ms',
+                self._label, stats['iterations'], stats['overruns'], stats['period_mean']*1000,
+                stats['period_std']*1000, stats['period_max']*1000, stats['jitter_max']*1000)
@@ -0,0 +1,171 @@
+'''Event Reactor
+
+The reactor runs socket handlers and timers in a single thread. Sockets
+are watched with a zmq.Poller and timers are kept in a heap ordered by
+deadline. The poll timeout is the time left to the next deadline, hence
+an idle reactor sleeps until there is something to do and a request is
+handled as soon as it arrives.
+
+Example:
+  reactor = Reactor(context)
+  reactor.add_socket(socket, on_request)
+  reactor.call_every(1.0, print_status)
+  reactor.run()
+
+call_soon, call_later, call_every, cancel and stop may be called from any
+thread, the handlers and timers always run in the reactor thread.
+'''
+
+import collections
+import heapq
+import itertools
+import logging
+import threading
+import time
+
+import zmq
+
+__author__ = 'Lennart Ochel <>, Andreas Gising <andreas.gising@ri.se>, Kristoffer Bergman <kristoffer.bergman@ri.se>, Hanna Müller <hanna.muller@ri.se>, Joel Nordahl'
+__version__ = '1.0.0'
+__copyright__ = 'Copyright (c) 2023, RISE'
+__status__ = 'development'
+
+_logger = logging.getLogger(__name__)
+
+class Reactor:
+  '''Event Reactor'''
+  def __init__(self, context, max_wait=1.0, exception_handler=None):
+    self._alive = True
+    self._calls = collections.deque()
+    self._counter = itertools.count()
+    self._exception_handler = exception_handler
+    self._handlers = dict()  # zmq socket -> callback
+    self._max_wait = max_wait
+    self._mutex = threading.Lock()
+    self._poller = zmq.Poller()
+    self._thread_id = None
+    self._timers = list()  # heap of [deadline, count, interval, callback, cancelled]
+
+    # other threads wake up the poller through an inproc pipe
+    address = f'inproc://reactor-{id(self):x}'
+    self._wakeup_pull = context.socket(zmq.PULL)
+    self._wakeup_pull.bind(address)
+    self._wakeup_push = context.socket(zmq.PUSH)
+    self._wakeup_push.SNDHWM = 1
+    self._wakeup_push.connect(address)
+    self._poller.register(self._wakeup_pull, zmq.POLLIN)
+
+  @property
+  def alive(self):
+    '''Returns true until the reactor is stopped'''
+    return self._alive
+
+  def add_socket(self, socket, callback):
+    '''Calls callback() whenever the socket is readable, socket is a zmq_lib
+    socket or a plain zmq socket. Must be called from the reactor thread
+    once it is running.'''
+    zmq_socket = getattr(socket, '_socket', socket)
+    self._handlers[zmq_socket] = callback
+    self._poller.register(zmq_socket, zmq.POLLIN)
+
+  def remove_socket(self, socket):
+    zmq_socket = getattr(socket, '_socket', socket)
+    if self._handlers.pop(zmq_socket, None):
+      self._poller.unregister(zmq_socket)
+
+  def call_soon(self, callback):
+    '''Calls callback() in the reactor thread as soon as possible'''
+    with self._mutex:
+      self._calls.append(callback)
+    self._wakeup()
+
+  def call_later(self, delay, callback):
+    '''Calls callback() once after delay seconds, returns a handle for cancel()'''
+    return self._add_timer(delay, None, callback)
+
+  def call_every(self, interval, callback):
+    '''Calls callback() every interval seconds, returns a handle for cancel()'''
+    return self._add_timer(interval, interval, callback)
+
+  def cancel(self, handle):
+    with self._mutex:
+      handle[4] = True
+
+  def stop(self):
+    '''Makes run() return after the current event'''
+    self._alive = False
+    self._wakeup()
+
+  def run(self):
+    '''Dispatches events until stop() is called, then closes the wakeup pipe'''
+    self._thread_id = threading.get_ident()
+    try:
+      while self._alive:
+        self.run_once()
+    finally:
+      self._poller.unregister(self._wakeup_pull)
+      with self._mutex:
+        self._wakeup_push.close(linger=0)
+      self._wakeup_pull.close(linger=0)
+
+  def run_once(self):
+    '''Waits for the next event and dispatches all events that are due'''
+    with self._mutex:
+      timeout = 0 if self._calls else self._max_wait
+      if self._timers:
+        timeout = max(0.0, min(timeout, self._timers[0][0] - time.monotonic()))
+
+    for zmq_socket, _ in self._poller.poll(timeout*1000):
+      if zmq_socket is self._wakeup_pull:
+        while self._wakeup_pull.poll(0):
+          self._wakeup_pull.recv()
+      else:
+        self._call(self._handlers[zmq_socket])
+
+    with self._mutex:
+      calls = list(self._calls)
+      self._calls.clear()
+    for callback in calls:
+      self._call(callback)
+
+    now = time.monotonic()
+    while True:
+      with self._mutex:
+        if not self._timers or self._timers[0][0] > now:
+          break
+        timer = heapq.heappop(self._timers)
+        if timer[4]:
+          continue
+        if timer[2] is not None:
+          # keep the phase, but skip deadlines that were missed entirely
+          timer[0] = max(timer[0] + timer[2], now)
+          timer[1] = next(self._counter)
+          heapq.heappush(self._timers, timer)
+      self._call(timer[3])
+
+  def _add_timer(self, delay, interval, callback):
+    timer = [time.monotonic() + delay, None, interval, callback, False]
+    with self._mutex:
+      timer[1] = next(self._counter)
+      heapq.heappush(self._timers, timer)
+    if threading.get_ident() != self._thread_id:
+      self._wakeup()
+    return timer
+
+  def _call(self, callback):
+    try:
+      callback()
+    except Exception as error:
+      if self._exception_handler:
+        self._exception_handler(error)
+      else:
+        raise
+
+  def _wakeup(self):
+    with self._mutex:
+      if self._wakeup_push.closed:
+        return
+      try:
+        self._wakeup_push.send(b'', zmq.NOBLOCK)
+      except zmq.error.Again:
+        pass # a wakeup is already pending
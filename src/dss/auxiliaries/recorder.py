@@ -0,0 +1,99 @@
+'''Streaming JSON lines recorder
+
+Each sample is written as one JSON object per line to a buffered file
+handle that stays open, a background thread flushes the buffer at a fixed
+interval. Writing a sample does not depend on the size of the file and a
+crash loses at most the samples since the last flush.
+
+Example:
+  with JsonlRecorder('log/network-log.jsonl') as recorder:
+    recorder.write({'static_info': static})
+    while flying:
+      recorder.write(sample)
+
+Convert to a pretty printed JSON file afterwards, e.g. with
+dev/jsonl_to_json.py, read_jsonl() streams the samples back.
+'''
+
+import json
+import logging
+import threading
+
+import dss.auxiliaries
+
+__author__ = 'Lennart Ochel <>, Andreas Gising <andreas.gising@ri.se>, Kristoffer Bergman <kristoffer.bergman@ri.se>, Hanna Müller <hanna.muller@ri.se>, Joel Nordahl'
+__version__ = '1.0.0'
+__copyright__ = 'Copyright (c) 2023, RISE'
+__status__ = 'development'
+
+_logger = logging.getLogger(__name__)
+
+class JsonlRecorder:
+  '''Buffered JSON lines writer with a background flush'''
+  def __init__(self, filename, flush_interval=1.0, mode='w'):
+    try:
+      self._file = open(filename, mode, encoding='utf-8')
+    except OSError as exc:
+      raise dss.auxiliaries.exception.Error(f'Opening the record file "{filename}" failed') from exc
+    self._filename = filename
+    self._flush_interval = flush_interval
+    self._mutex = threading.Lock()
+    self._n_samples = 0
+    self._stop = threading.Event()
+    self._thread = threading.Thread(target=self._main, daemon=True)
+    self._thread.start()
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, exc_type, exc_value, traceback):
+    self.close()
+
+  @property
+  def filename(self) -> str:
+    return self._filename
+
+  @property
+  def n_samples(self) -> int:
+    return self._n_samples
+
+  def write(self, sample: dict):
+    '''Appends one sample to the buffer'''
+    line = json.dumps(sample) + '\n'
+    with self._mutex:
+      if self._file.closed:
+        raise dss.auxiliaries.exception.Error(f'Record file "{self._filename}" is closed')
+      self._file.write(line)
+      self._n_samples += 1
+
+  def flush(self):
+    with self._mutex:
+      if not self._file.closed:
+        self._file.flush()
+
+  def close(self):
+    '''Stops the flush thread, flushes and closes the file'''
+    self._stop.set()
+    if self._thread is not threading.current_thread():
+      self._thread.join()
+    with self._mutex:
+      if not self._file.closed:
+        self._file.close()
+
+  def _main(self):
+    while not self._stop.wait(self._flush_interval):
+      try:
+        self.flush()
+      except OSError:
+        _logger.exception('Flushing the record file %s failed', self._filename)
+
+def read_jsonl(filename):
+  '''Generator of the samples in a JSON lines file, a truncated last line is skipped'''
+  with open(filename, 'r', encoding='utf-8') as infile:
+    for line in infile:
+      if not line.strip():
+        continue
+      try:
+        yield json.loads(line)
+      except json.JSONDecodeError:
+        _logger.warning('Skipping a faulty line in %s', filename)
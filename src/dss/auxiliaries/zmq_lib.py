@@ -1,18 +1,32 @@
 '''zmq auxiliaries'''
 
+import asyncio
 import base64
+import collections.abc
+import hashlib
 import ipaddress
+import itertools
 import json
 import logging
+import os
 import socket
 import threading
+import time
 import traceback
 import typing
+import zlib
 import zmq
+import zmq.asyncio
+
+try:
+  import msgpack
+except ImportError:
+  msgpack = None
 
 from netifaces import AF_INET, ifaddresses, interfaces
 
 import dss.auxiliaries
+from dss.auxiliaries.reactor import Reactor
 
 #--------------------------------------------------------------------#
 
@@ -30,6 +44,13 @@ _logger = logging.getLogger(__name__)
 def Context() -> zmq.Context:
   return zmq.Context()
 
+def AsyncContext(context: typing.Optional[zmq.Context] = None) -> zmq.asyncio.Context:
+  '''Returns a context for the Async* sockets, optionally sharing the
+  io threads of an existing context (which must be kept alive)'''
+  if context is not None:
+    return zmq.asyncio.Context.shadow(context.underlying)
+  return zmq.asyncio.Context()
+
 def get_subnet(ip: typing.Optional[str] = None, port: typing.Optional[int] = None) -> str:
   if ip:
     for subnet in dss.auxiliaries.config.config['zeroMQ']['subnets']:
@@ -154,6 +175,44 @@ def demogrify(msg: str) -> typing.Tuple[str, dict]:
 
   return topic, message
 
+class LazyMessage(collections.abc.Mapping):
+  '''Read-only dict view of a published json payload that is decoded on
+  first access. Use dict(msg) to get a plain dictionary.'''
+  __slots__ = ('_payload', '_msg')
+
+  def __init__(self, payload) -> None:
+    self._payload = payload
+    self._msg = None
+
+  @property
+  def payload(self) -> bytes:
+    '''Returns the raw, undecoded payload'''
+    return bytes(self._payload)
+
+  @property
+  def msg(self) -> dict:
+    '''Returns the decoded message'''
+    if self._msg is None:
+      try:
+        self._msg = json.loads(bytes(self._payload)) if self._payload else {}
+      except:
+        self._msg = {}
+        _logger.error(traceback.format_exc())
+      self._payload = None
+    return self._msg
+
+  def __getitem__(self, key):
+    return self.msg[key]
+
+  def __iter__(self):
+    return iter(self.msg)
+
+  def __len__(self) -> int:
+    return len(self.msg)
+
+  def __repr__(self) -> str:
+    return repr(self.msg)
+
 def image_to_bytes(filename: str) -> bytes:
   '''t.ex. filename="test.jpg"'''
   with open(filename, "rb") as fh:
@@ -175,6 +234,75 @@ def save_json(filename: str, data: dict) -> None:
   with open(filename, "w") as fh:
     fh.write(json.dumps(data, indent=4))
 
+#--------------------------------------------------------------------#
+# Codecs used to put request and reply dictionaries on the wire
+
+class JsonCodec:
+  '''Legacy codec, a json string wrapped in json (as send_json(json.dumps(msg)))
+
+  Encoding is kept wire compatible with peers that still use
+  send_json/recv_json, decoding also accepts plain json objects.'''
+  name = 'json'
+
+  @staticmethod
+  def encode(msg: dict) -> bytes:
+    return json.dumps(json.dumps(msg)).encode('utf-8')
+
+  @staticmethod
+  def decode(data: bytes) -> dict:
+    msg = json.loads(data)
+    if isinstance(msg, str):
+      msg = json.loads(msg)
+    return msg
+
+class MsgpackCodec:
+  '''Compact binary codec, requires the msgpack package'''
+  name = 'msgpack'
+
+  @staticmethod
+  def encode(msg: dict) -> bytes:
+    return msgpack.packb(msg, use_bin_type=True)
+
+  @staticmethod
+  def decode(data: bytes) -> dict:
+    return msgpack.unpackb(data, raw=False, strict_map_key=False)
+
+# codecs in order of preference, json is always available
+_codecs = {'json': JsonCodec}
+if msgpack is not None:
+  _codecs['msgpack'] = MsgpackCodec
+_codec_preference = ('msgpack', 'json')
+
+def available_codecs() -> list:
+  '''Returns the names of the codecs supported by this host, as announced in get_info'''
+  return [name for name in _codec_preference if name in _codecs]
+
+def get_codec(name: str):
+  '''Returns the codec for name
+
+  :raises dss.auxiliaries.exception.InputError: if the codec is not available
+  '''
+  if name not in _codecs:
+    raise dss.auxiliaries.exception.InputError(name, 'codec not available')
+  return _codecs[name]
+
+def negotiate_codec(codecs: typing.Optional[list]) -> str:
+  '''Returns the preferred codec supported by both this host and a peer
+  that announced codecs, falls back to json for legacy peers'''
+  for name in available_codecs():
+    if codecs and name in codecs:
+      return name
+  return 'json'
+
+def sniff_codec(data: bytes):
+  '''Determines the codec of a received frame.
+
+  A msgpack encoded dict starts with a map marker (0x80-0x8f, 0xde or
+  0xdf), which is never the first byte of a json document.'''
+  if data and (0x80 <= data[0] <= 0x8f or data[0] in (0xde, 0xdf)) and 'msgpack' in _codecs:
+    return _codecs['msgpack']
+  return JsonCodec
+
 #--------------------------------------------------------------------#
 class _Socket:
   def __init__(self, context, ip, port, label, timeout, socket_type=None, self_id=None) -> None:
@@ -193,10 +321,23 @@ class _Socket:
     self._port = port
     self._socket = None
     self._timeout = timeout  #in milliseconds
+    self._codec = JsonCodec  # rep sockets reply with the codec of the latest request
 
   def __del__(self) -> None:
     self.close()
 
+  @property
+  def codec(self) -> str:
+    '''Returns the name of the codec used to encode messages'''
+    return self._codec.name
+
+  @codec.setter
+  def codec(self, name: str) -> None:
+    codec = get_codec(name)
+    if codec is not self._codec:
+      _logger.info(f'{self._label} using codec {name}')
+      self._codec = codec
+
   @property
   def ip(self) -> str:
     '''Returns the ip number'''
@@ -224,21 +365,16 @@ class Req(_Socket):
   def __init__(self, context, ip, port, label=None, timeout=1000, self_id=None) -> None:
     _Socket.__init__(self, context, ip, port, label, timeout, socket_type='req', self_id=self_id)
 
-    self._alive = False
-    self._event = threading.Event()
+    self._heartbeat = None  # state owned by the heartbeat scheduler
     self._heartbeat_msg = None
+    self._last_activity = time.monotonic()
     self._mutex = threading.Lock()
-    self._thread = None
 
     self.connect()
 
   def close(self) -> None:
-    if self._thread:
-      # stop heartbeat thread
-      self._alive = False
-      self._event.set()
-      self._thread.join()
-      self._thread = None
+    if self._heartbeat:
+      _heartbeat_scheduler().unregister(self)
 
     _Socket.close(self)
 
@@ -250,19 +386,28 @@ class Req(_Socket):
     self._socket.RCVTIMEO = self._timeout
     _logger.debug(f'{self._label} Connected to tcp://{self._ip}:{self._port} with timeout {self._timeout}')
 
+  @property
+  def heartbeat_active(self) -> bool:
+    '''Returns true if heartbeats are scheduled for this socket'''
+    return self._heartbeat is not None
+
+  def negotiate_codec(self, codecs: typing.Optional[list]) -> str:
+    '''Selects the codec given the list announced by the peer in get_info'''
+    self.codec = negotiate_codec(codecs)
+    return self.codec
+
   def start_heartbeat(self, client_id=None) -> None:
     # update heartbeat message
     if client_id:
       self._heartbeat_msg = {'fcn': 'heart_beat', 'id': client_id}
 
-    # thread is already running
-    if self._thread:
+    # already scheduled
+    if self._heartbeat:
       return
 
-    # start heartbeat thread
+    # heartbeats of all sockets are sent by one process wide thread
     if self._heartbeat_msg:
-      self._thread = threading.Thread(target=self._main_heartbeat, daemon=True)
-      self._thread.start()
+      _heartbeat_scheduler().register(self)
 
   def reconnect(self):
     _logger.info(f'{self._label} reconnecting...')
@@ -273,19 +418,18 @@ class Req(_Socket):
     _logger.debug(f'{self._label} send: %s', str(msg)[:256])
 
     try:
-      json_msg = json.dumps(msg)
-      self._socket.send_json(json_msg)
+      self._socket.send(self._codec.encode(msg))
     except zmq.error.ZMQError as error:
       raise dss.auxiliaries.exception.NoAnswer(msg, self.ip, self.port)
     else:
       try:
-        json_reply = self._socket.recv_json()
+        reply = self._socket.recv()
       except zmq.error.Again as error:
         self.reconnect()
         raise dss.auxiliaries.exception.NoAnswer(msg, self.ip, self.port)
       else:
-        answer = json.loads(json_reply)
-        self._event.set()  # indicates successful communication
+        answer = sniff_codec(reply).decode(reply)
+        self._last_activity = time.monotonic()  # indicates successful communication
         # Should this function also raise the Nack exeption? It is implemented separately in many dss_api calls
         #if dss.auxiliaries.zmq_lib.is_nack(answer):
         #  raise dss.auxiliaries.exception.Nack(dss.auxiliaries.zmq_lib.get_nack_reason(answer), msg['fcn'])
@@ -313,7 +457,7 @@ class Req(_Socket):
         raise dss.auxiliaries.exception.NoAnswer(msg, self.ip, self.port)
       else:
         answer = json_reply
-        self._event.set()  # indicates successful communication
+        self._last_activity = time.monotonic()  # indicates successful communication
 
     _logger.debug(f'{self._label} recv: %s\n', str(answer)[:256])
     return answer
@@ -322,38 +466,356 @@ class Req(_Socket):
     with self._mutex:
       return self._send_and_receive_string(msg)
 
+#--------------------------------------------------------------------#
 
+class _HeartbeatScheduler:
+  '''Sends the heartbeats of all Req sockets from one thread
+
+  Every registered socket has a deadline at its last successful
+  communication plus its timeout. The heartbeat is only sent if the
+  socket was idle until the deadline, otherwise the deadline moves. The
+  reply is awaited on the reactor poller, hence a peer that does not
+  answer doesn't delay the heartbeats of other sockets.'''
+  def __init__(self) -> None:
+    self._reactor = Reactor(zmq.Context.instance(), exception_handler=self._exception_handler)
+    self._thread = threading.Thread(target=self._reactor.run, name='heartbeat', daemon=True)
+    self._thread.start()
+
+  def register(self, req: Req) -> None:
+    req._heartbeat = {'attempts': 0, 'tick': 0, 'timer': None, 'pending': False}
+    self._reactor.call_soon(lambda: self._schedule(req, req._last_activity))
+
+  def unregister(self, req: Req) -> None:
+    '''Blocks until the scheduler released the socket'''
+    done = threading.Event()
+    def _unregister():
+      heartbeat, req._heartbeat = req._heartbeat, None
+      if heartbeat:
+        self._release(req, heartbeat)
+      done.set()
+    # from a callback of the scheduler itself, e.g. an exception handler, it would wait for itself
+    if threading.current_thread() is self._thread:
+      _unregister()
+    else:
+      self._reactor.call_soon(_unregister)
+      done.wait()
+
+  def _schedule(self, req: Req, since: float) -> None:
+    heartbeat = req._heartbeat
+    if heartbeat:
+      delay = since + req._timeout/1000.0 - time.monotonic()
+      heartbeat['timer'] = self._reactor.call_later(max(0.0, delay), lambda: self._due(req))
+
+  def _due(self, req: Req) -> None:
+    heartbeat = req._heartbeat
+    if heartbeat is None:
+      return
+    # skip if there was communication meanwhile or a request is in progress
+    if time.monotonic() - req._last_activity < req._timeout/1000.0 or not req._mutex.acquire(blocking=False):
+      self._schedule(req, req._last_activity)
+      return
+
+    msg = dict(req._heartbeat_msg, tick=heartbeat['tick'])
+    heartbeat['tick'] += 1
+    heartbeat['pending'] = True
+    try:
+      req._socket.send(req._codec.encode(msg))
+    except zmq.error.ZMQError:
+      self._failed(req, heartbeat)
+      return
+    self._reactor.add_socket(req._socket, lambda: self._on_reply(req))
+    heartbeat['timer'] = self._reactor.call_later(req._timeout/1000.0, lambda: self._on_timeout(req))
+
+  def _on_reply(self, req: Req) -> None:
+    heartbeat = req._heartbeat
+    reply = req._socket.recv()
+    self._release(req, heartbeat)
+    if is_ack(sniff_codec(reply).decode(reply)):
+      req._last_activity = time.monotonic()
+      heartbeat['attempts'] = 0
+      self._schedule(req, req._last_activity)
+    else:
+      self._failed(req, heartbeat, released=True)
+
+  def _on_timeout(self, req: Req) -> None:
+    heartbeat = req._heartbeat
+    self._reactor.remove_socket(req._socket)
+    req.reconnect()
+    self._failed(req, heartbeat)
+
+  def _failed(self, req: Req, heartbeat: dict, released: bool = False) -> None:
+    if not released:
+      self._release(req, heartbeat)
+    heartbeat['attempts'] += 1
+    if heartbeat['attempts'] < 3:
+      _logger.warning(f"{req._label} no response to heartbeat ({heartbeat['attempts']})")
+    elif heartbeat['attempts'] == 3:
+      _logger.error(f"{req._label} no response to heartbeat ({heartbeat['attempts']})")
+    self._schedule(req, time.monotonic())
+
+  def _release(self, req: Req, heartbeat: dict) -> None:
+    if heartbeat['timer']:
+      self._reactor.cancel(heartbeat['timer'])
+      heartbeat['timer'] = None
+    if heartbeat['pending']:
+      heartbeat['pending'] = False
+      self._reactor.remove_socket(req._socket)
+      req._mutex.release()
+
+  def _exception_handler(self, error) -> None:
+    _logger.error(f'heartbeat scheduler: {error}\n{traceback.format_exc()}')
+
+_heartbeat_scheduler_instance = None
+_heartbeat_scheduler_mutex = threading.Lock()
+
+def _heartbeat_scheduler() -> _HeartbeatScheduler:
+  global _heartbeat_scheduler_instance
+  with _heartbeat_scheduler_mutex:
+    if _heartbeat_scheduler_instance is None:
+      _heartbeat_scheduler_instance = _HeartbeatScheduler()
+    return _heartbeat_scheduler_instance
+
+#--------------------------------------------------------------------#
+
+class ConnectionPool:
+  '''Cache of Req sockets keyed by (ip, port)
+
+  Sockets are created on first use and reused by later requests. Req
+  reconnects by itself after a timeout, a socket that failed
+  max_failures requests in a row is closed and replaced by a fresh one
+  on the next request. Sockets that were not used for idle_timeout
+  seconds are evicted, unless they send heartbeats.'''
+  def __init__(self, context, timeout=2000, idle_timeout=60.0, max_failures=3) -> None:
+    self._context = context
+    self._entries = dict()  # (ip, port) -> {'socket', 'last_used', 'failures'}
+    self._idle_timeout = idle_timeout
+    self._max_failures = max_failures
+    self._mutex = threading.Lock()
+    self._next_eviction = time.monotonic() + idle_timeout
+    self._timeout = timeout
+
+  def __len__(self) -> int:
+    return len(self._entries)
+
+  def get(self, ip: str, port: int, label=None) -> Req:
+    '''Returns the pooled socket for (ip, port), connects if needed'''
+    now = time.monotonic()
+    with self._mutex:
+      if now > self._next_eviction:
+        self._evict_idle(now)
+      entry = self._entries.get((ip, port))
+      if entry is None:
+        socket = Req(self._context, ip=ip, port=port, label=label, timeout=self._timeout)
+        entry = {'socket': socket, 'last_used': now, 'failures': 0}
+        self._entries[(ip, port)] = entry
+      entry['last_used'] = now
+      return entry['socket']
+
+  def send_and_receive(self, ip: str, port: int, msg: dict, label=None) -> dict:
+    '''Sends a request on the pooled socket for (ip, port) and tracks its health
+
+    :raises dss.auxiliaries.exception.NoAnswer: if there is no answer
+    '''
+    socket = self.get(ip, port, label)
+    try:
+      answer = socket.send_and_receive(msg)
+    except dss.auxiliaries.exception.NoAnswer:
+      with self._mutex:
+        entry = self._entries.get((ip, port))
+        if entry and entry['socket'] is socket:
+          entry['failures'] += 1
+          if entry['failures'] >= self._max_failures:
+            _logger.warning(f'connection pool: dropping tcp://{ip}:{port} after {entry["failures"]} failures')
+            del self._entries[(ip, port)]
+            socket.close()
+      raise
+    with self._mutex:
+      entry = self._entries.get((ip, port))
+      if entry and entry['socket'] is socket:
+        entry['failures'] = 0
+    return answer
+
+  def is_healthy(self, ip: str, port: int) -> bool:
+    '''Returns false if the latest request to (ip, port) failed'''
+    with self._mutex:
+      entry = self._entries.get((ip, port))
+      return entry is None or entry['failures'] == 0
+
+  def remove(self, ip: str, port: int) -> None:
+    '''Closes and forgets the socket for (ip, port)'''
+    with self._mutex:
+      entry = self._entries.pop((ip, port), None)
+    if entry:
+      entry['socket'].close()
+
+  def close(self) -> None:
+    '''Closes all pooled sockets'''
+    with self._mutex:
+      entries = list(self._entries.values())
+      self._entries.clear()
+    for entry in entries:
+      entry['socket'].close()
+
+  def _evict_idle(self, now: float) -> None:
+    for key in [key for key, entry in self._entries.items() if now - entry['last_used'] > self._idle_timeout and not entry['socket'].heartbeat_active]:
+      _logger.debug(f'connection pool: evicting idle tcp://{key[0]}:{key[1]}')
+      self._entries.pop(key)['socket'].close()
+    self._next_eviction = now + self._idle_timeout/2
+
+#--------------------------------------------------------------------#
+
+class Dealer(_Socket):
+  '''Request socket that allows many outstanding requests
+
+  Drop-in replacement for Req. Each request is tagged with a request id
+  that is placed in front of the envelope delimiter. Rep servers echo it
+  back in order and Router servers may answer out of order. Callers
+  block only on their own request, so a slow request does not hold up
+  the heartbeat or other callers sharing the socket.
+
+  The zmq socket is owned by an io thread. Callers hand over requests
+  through an inproc socket.'''
+  def __init__(self, context, ip, port, label=None, timeout=1000, self_id=None) -> None:
+    _Socket.__init__(self, context, ip, port, label, timeout, socket_type='dealer', self_id=self_id)
+
+    self._alive = False
+    self._heartbeat_msg = None
+    self._last_activity = time.monotonic()
+    self._pending = dict()  # request id -> [event, answer]
+    self._pending_mutex = threading.Lock()
+    self._request_ids = itertools.count(1)
+    self._thread = None
+
+    self._inproc = f'inproc://dealer-{id(self):x}'
+    self._push = None
+    self._push_mutex = threading.Lock()
+
+    self.connect()
+
+  def close(self) -> None:
+    if self._thread:
+      # stop io thread, it closes the dealer socket
+      self._alive = False
+      with self._push_mutex:
+        self._push.send_multipart([b''])
+      self._thread.join()
+      self._thread = None
+
+    if self._push:
+      self._push.setsockopt(zmq.LINGER, 0)
+      self._push.close()
+      self._push = None
+
+  def connect(self) -> None:
+    self._socket = self._context.socket(zmq.DEALER)
+    self._socket.connect(f'tcp://{self._ip}:{self._port}')
+    self._push = self._context.socket(zmq.PUSH)
+    self._push.bind(self._inproc)
+    _logger.debug(f'{self._label} Connected to tcp://{self._ip}:{self._port} with timeout {self._timeout}')
 
-  def _main_heartbeat(self):
-    '''Send a heartbeat if no other messages were sent'''
-    attempts = 0
     self._alive = True
+    self._thread = threading.Thread(target=self._main_io, daemon=True)
+    self._thread.start()
+
+  def negotiate_codec(self, codecs: typing.Optional[list]) -> str:
+    '''Selects the codec given the list announced by the peer in get_info'''
+    self.codec = negotiate_codec(codecs)
+    return self.codec
+
+  def start_heartbeat(self, client_id=None) -> None:
+    '''Heartbeats are sent by the io thread when the socket has been idle'''
+    if client_id:
+      self._heartbeat_msg = {'fcn': 'heart_beat', 'id': client_id}
+
+  def send_and_receive(self, msg: dict) -> dict:
+    _logger.debug(f'{self._label} send: %s', str(msg)[:256])
+
+    request_id = str(next(self._request_ids)).encode()
+    pending = [threading.Event(), None]
+    with self._pending_mutex:
+      self._pending[request_id] = pending
+
+    try:
+      with self._push_mutex:
+        self._push.send_multipart([request_id, self._codec.encode(msg)])
+    except zmq.error.ZMQError as error:
+      with self._pending_mutex:
+        del self._pending[request_id]
+      raise dss.auxiliaries.exception.NoAnswer(msg, self.ip, self.port)
+
+    if not pending[0].wait(timeout=self._timeout/1000.0):
+      # a late reply is dropped by the io thread
+      with self._pending_mutex:
+        self._pending.pop(request_id, None)
+      raise dss.auxiliaries.exception.NoAnswer(msg, self.ip, self.port)
+
+    answer = pending[1]
+    _logger.debug(f'{self._label} recv: %s\n', str(answer)[:256])
+    return answer
+
+  def _main_io(self):
+    '''Forwards requests to the dealer socket and dispatches the replies'''
+    pull = self._context.socket(zmq.PULL)
+    pull.connect(self._inproc)
+    poller = zmq.Poller()
+    poller.register(pull, zmq.POLLIN)
+    poller.register(self._socket, zmq.POLLIN)
+
+    attempts = 0
+    heartbeat_id = None
     tick = 0
+    interval = self._timeout/1000.0
     while self._alive:
-      self._event.clear()
-      self._event.wait(timeout=self._timeout/1000.0)
-      if not self._event.is_set():
-        heartbeat_msg = self._heartbeat_msg
-        heartbeat_msg['tick'] = tick
-        tick += 1
-        try:
-          answer = self.send_and_receive(heartbeat_msg)
-        except dss.auxiliaries.exception.NoAnswer:
-          # There was no answer, create a virtual nack to not repeat code
-          answer = {'fcn': 'nack'}
-
-        if not dss.auxiliaries.zmq_lib.is_ack(answer):
-          attempts += 1
-          if attempts < 3:
-            _logger.warning(f"{self._label} no response to heartbeat ({attempts})")
-          elif attempts == 3:
-            _logger.error(f"{self._label} no response to heartbeat ({attempts})")
+      events = dict(poller.poll(timeout=self._timeout))
+
+      if pull in events:
+        frames = pull.recv_multipart()
+        if len(frames) == 2:
+          self._socket.send_multipart([frames[0], b'', frames[1]])
+
+      if self._socket in events:
+        frames = self._socket.recv_multipart()
+        request_id, reply = frames[0], frames[-1]
+        answer = sniff_codec(reply).decode(reply)
+        self._last_activity = time.monotonic()  # indicates successful communication
+        if request_id == heartbeat_id:
+          heartbeat_id = None
+          attempts = 0 if is_ack(answer) else self._heartbeat_failed(attempts)
         else:
-          attempts = 0
+          with self._pending_mutex:
+            pending = self._pending.pop(request_id, None)
+          if pending:
+            pending[1] = answer
+            pending[0].set()
+
+      # Send a heartbeat if no other messages were received
+      if self._heartbeat_msg and time.monotonic() - self._last_activity > interval:
+        if heartbeat_id is not None:
+          # the previous heartbeat is still unanswered
+          attempts = self._heartbeat_failed(attempts)
+        heartbeat_msg = dict(self._heartbeat_msg, tick=tick)
+        tick += 1
+        heartbeat_id = b'hb%d' % tick
+        self._socket.send_multipart([heartbeat_id, b'', self._codec.encode(heartbeat_msg)])
+        self._last_activity = time.monotonic()
+
+    pull.setsockopt(zmq.LINGER, 0)
+    pull.close()
+    _Socket.close(self)
+
+  def _heartbeat_failed(self, attempts: int) -> int:
+    attempts += 1
+    if attempts < 3:
+      _logger.warning(f"{self._label} no response to heartbeat ({attempts})")
+    elif attempts == 3:
+      _logger.error(f"{self._label} no response to heartbeat ({attempts})")
+    return attempts
 
 #--------------------------------------------------------------------#
 
 class Rep(_Socket):
+  _zmq_type = zmq.REP
+
   def __init__(self, context, ip='*', port=None, label=None, timeout=1000, min_port=6000, max_port=6100, self_id=None) -> None:
     _Socket.__init__(self, context, ip, port, label, timeout, socket_type='rep', self_id=self_id)
     self.min_port = min_port
@@ -363,7 +825,7 @@ class Rep(_Socket):
   def connect(self) -> None:
     assert valid_ip(self._ip, asterisk=True), f'bad ip address: {self._ip}'
 
-    self._socket = self._context.socket(zmq.REP)
+    self._socket = self._context.socket(self._zmq_type)
     if self._port:
       self._socket.bind(f'tcp://{self._ip}:{self._port}')
     else:
@@ -371,6 +833,27 @@ class Rep(_Socket):
     self._socket.RCVTIMEO = self._timeout  #in milliseconds
     _logger.debug(f'{self._label} Connected to tcp://{self._ip}:{self._port} with timeout {self._timeout}')
 
+  def recv(self) -> dict:
+    '''Receives and decodes a request, the reply will use the same codec'''
+    try:
+      data = self._socket.recv()
+    except zmq.error.Again as error:
+      raise dss.auxiliaries.exception.Again(error, self.ip, self.port)
+    self._codec = sniff_codec(data)
+    request = self._codec.decode(data)
+    _logger.debug(f'{self._label} recv: %s', str(request)[:256])
+    return request
+
+  def send(self, msg: dict) -> None:
+    '''Encodes and sends a reply using the codec of the latest request'''
+    try:
+      self._socket.send(self._codec.encode(msg))
+    except zmq.error.ZMQError as error:
+      _logger.warning(f'{self._label} send: {error}\n')
+      raise
+    else:
+      _logger.debug(f'{self._label} send: %s\n', str(msg)[:256])
+
   def recv_json(self) -> str:
     try:
       request = self._socket.recv_json()
@@ -393,9 +876,69 @@ class Rep(_Socket):
 
 #--------------------------------------------------------------------#
 
+class Router(Rep):
+  '''Reply socket that can answer requests out of order
+
+  Serves both Req and Dealer clients. recv/send behave like Rep, i.e.
+  the reply goes to the latest request. recv_request returns an
+  envelope that can be passed to send later on to reply out of order.'''
+  _zmq_type = zmq.ROUTER
+
+  def __init__(self, context, ip='*', port=None, label=None, timeout=1000, min_port=6000, max_port=6100, self_id=None) -> None:
+    _Socket.__init__(self, context, ip, port, label, timeout, socket_type='router', self_id=self_id)
+    self._envelope = None
+    self.min_port = min_port
+    self.max_port = max_port
+    self.connect()
+
+  def recv_request(self) -> typing.Tuple[tuple, dict]:
+    '''Receives a request, returns the envelope needed to reply and the request'''
+    while True:
+      try:
+        frames = self._socket.recv_multipart()
+      except zmq.error.Again as error:
+        raise dss.auxiliaries.exception.Again(error, self.ip, self.port)
+      # routing frames up to and including the empty delimiter, then the request
+      try:
+        delimiter = frames.index(b'')
+      except ValueError:
+        _logger.warning(f'{self._label} dropping malformed request')
+        continue
+      codec = sniff_codec(frames[-1])
+      request = codec.decode(frames[-1])
+      _logger.debug(f'{self._label} recv: %s', str(request)[:256])
+      return (frames[:delimiter+1], codec), request
+
+  def recv(self) -> dict:
+    '''Receives and decodes a request, send() without envelope replies to it'''
+    self._envelope, request = self.recv_request()
+    return request
+
+  def send(self, msg: dict, envelope: typing.Optional[tuple] = None) -> None:
+    '''Encodes and sends a reply to the request of the envelope, or to
+    the latest request if no envelope is given'''
+    routing, codec = envelope if envelope else self._envelope
+    try:
+      self._socket.send_multipart(routing + [codec.encode(msg)])
+    except zmq.error.ZMQError as error:
+      _logger.warning(f'{self._label} send: {error}\n')
+      raise
+    else:
+      _logger.debug(f'{self._label} send: %s\n', str(msg)[:256])
+
+#--------------------------------------------------------------------#
+
 class Pub(_Socket):
-  def __init__(self, context, ip='*', port=None, label=None, timeout=1000, min_port=6000, max_port=6100, self_id=None, bind=True) -> None:
+  '''Publisher socket
+
+  With multipart=True the topic and the json payload are sent as two
+  frames, which lets subscribers filter on the topic without decoding
+  the payload. Sub.recv understands both wire formats, but subscribers
+  that use a raw zmq socket and demogrify only understand the legacy
+  single frame format.'''
+  def __init__(self, context, ip='*', port=None, label=None, timeout=1000, min_port=6000, max_port=6100, self_id=None, bind=True, multipart=False) -> None:
     _Socket.__init__(self, context, ip, port, label, timeout, socket_type='pub', self_id=self_id)
+    self._multipart = multipart
     self.min_port = min_port
     self.max_port = max_port
     self.connect(bind)
@@ -416,18 +959,49 @@ class Pub(_Socket):
         raise dss.auxiliaries.exception.Error
     _logger.debug(f'{self._label} Connected to tcp://{self._ip}:{self._port} with timeout {self._timeout}')
 
+  @property
+  def multipart(self) -> bool:
+    '''Returns true if topic and payload are published as separate frames'''
+    return self._multipart
+
   def publish(self, topic: str, msg: dict) -> None:
-    json_msg = mogrify(topic, msg)
-    self._socket.send_string(json_msg)
-    _logger.debug(f'{self._label} %s\n', str(json_msg)[:256])
+    if self._multipart:
+      payload = json.dumps(msg).encode('utf-8')
+      self._socket.send_multipart([topic.encode('utf-8'), payload], copy=False)
+      _logger.debug(f'{self._label} {topic} %s\n', payload[:256])
+    else:
+      json_msg = mogrify(topic, msg)
+      self._socket.send_string(json_msg)
+      _logger.debug(f'{self._label} %s\n', str(json_msg)[:256])
 
 #--------------------------------------------------------------------#
 
 class Sub(_Socket):
-  def __init__(self, context, ip, port, label=None, timeout=1000, self_id=None, subscribe_all=True) -> None:
+  '''Subscribe socket
+
+  With conflate=True only the newest message of each topic is kept:
+  recv() drains everything queued, overwrites one slot per topic and
+  returns the topics in order of their oldest pending update. Slow
+  consumers thereby never process stale samples. ZMQ_CONFLATE is not
+  used since it does not support multipart messages.'''
+  def __init__(self, context, ip, port, label=None, timeout=1000, self_id=None, subscribe_all=True, conflate=False) -> None:
     _Socket.__init__(self, context, ip, port, label, timeout, socket_type='sub', self_id=self_id)
+    self._conflate = conflate
+    self._dropped = 0
+    self._latest = dict()  # topic -> (LazyMessage, sequence number, receive time)
+    self._pending = collections.OrderedDict()  # topics with unread updates
+    self._sequence = 0
     self.connect(subscribe_all)
 
+  @property
+  def conflate(self) -> bool:
+    return self._conflate
+
+  @property
+  def dropped(self) -> int:
+    '''Number of messages overwritten before they were read'''
+    return self._dropped
+
   def connect(self, subscribe_all) -> None:
     #assert valid_ip(self._ip, localhost=True), f'bad ip address: {self._ip}'
     self._socket = self._context.socket(zmq.SUB)
@@ -445,11 +1019,607 @@ class Sub(_Socket):
     _logger.debug(f'{self._label} unsubscribe topic {topic}')
     self._socket.setsockopt_string(zmq.UNSUBSCRIBE, topic)
 
-  def recv(self) -> typing.Tuple[str, dict]:
+  def recv(self, lazy: bool = False) -> typing.Tuple[str, typing.Union[dict, LazyMessage]]:
+    '''Receives a published message, both the multipart and the legacy
+    single frame formats are accepted.
+
+    With lazy=True the payload is returned as a LazyMessage that is only
+    decoded when it is accessed, e.g. after filtering on the topic.'''
+    if self._conflate:
+      return self._recv_latest(lazy)
     try:
-      msg = str(self._socket.recv(), 'utf-8')
+      frames = self._socket.recv_multipart(copy=False)
     except zmq.error.Again as error:
       raise dss.auxiliaries.exception.Again(error, self.ip, self.port)
-    topic, msg = demogrify(msg)
-    _logger.debug(f'{self._label} {topic}: %s', str(msg)[:256])
-    return topic, msg
+    return self._unpack(frames, lazy)
+
+  def latest(self, topic: str, lazy: bool = False) -> typing.Optional[tuple]:
+    '''Returns (msg, sequence number, receive time) of the newest message
+    of the topic without blocking, None if nothing was received yet.
+    Requires conflate=True. The receive time is from time.monotonic().'''
+    if not self._conflate:
+      raise dss.auxiliaries.exception.InputError(self._label, 'latest() requires conflate=True')
+    self._drain()
+    self._pending.pop(topic, None)
+    if topic not in self._latest:
+      return None
+    msg, sequence, stamp = self._latest[topic]
+    return (msg if lazy else msg.msg), sequence, stamp
+
+  def _recv_latest(self, lazy: bool) -> typing.Tuple[str, typing.Union[dict, LazyMessage]]:
+    if not self._pending:
+      try:
+        frames = self._socket.recv_multipart(copy=False)
+      except zmq.error.Again as error:
+        raise dss.auxiliaries.exception.Again(error, self.ip, self.port)
+      self._store(frames)
+    self._drain()
+    topic, _ = self._pending.popitem(last=False)
+    msg = self._latest[topic][0]
+    return topic, msg if lazy else msg.msg
+
+  def _drain(self) -> None:
+    while True:
+      try:
+        frames = self._socket.recv_multipart(zmq.NOBLOCK, copy=False)
+      except zmq.error.Again:
+        return
+      self._store(frames)
+
+  def _store(self, frames: list) -> None:
+    topic, msg = self._unpack(frames, lazy=True)
+    self._sequence += 1
+    if topic in self._pending:
+      self._dropped += 1
+    else:
+      self._pending[topic] = None
+    self._latest[topic] = (msg, self._sequence, time.monotonic())
+
+  def _unpack(self, frames: list, lazy: bool) -> typing.Tuple[str, typing.Union[dict, LazyMessage]]:
+    if len(frames) > 1:
+      topic = str(frames[0].bytes, 'utf-8')
+      payload = frames[1].buffer
+    else:
+      topic, _, payload = frames[0].bytes.partition(b' ')
+      topic = str(topic, 'utf-8')
+
+    msg = LazyMessage(payload)
+    if _logger.isEnabledFor(logging.DEBUG):
+      _logger.debug(f'{self._label} {topic}: %s', str(msg)[:256])
+    return topic, msg if lazy else msg.msg
+
+#--------------------------------------------------------------------#
+
+class SubscriberHub:
+  '''Receives from many Sub sockets in one thread
+
+  All sockets share one zmq.Poller and received messages are dispatched
+  to the callbacks registered for (source, topic), where None matches
+  any source or topic. Callbacks are called as callback(source, topic,
+  msg) from the polling thread. Payloads without a matching callback are
+  never decoded.
+
+  add() and remove() may be called from any thread, the changes are
+  applied by the polling thread before its next poll.'''
+  def __init__(self, context, timeout=100, lazy=False, burst=64) -> None:
+    self._alive = False
+    self._burst = burst  # max messages per source and poll, keeps latency bounded
+    self._callbacks = dict()  # (source, topic) -> [callback]
+    self._changes = list()  # [(source, Sub or None)]
+    self._context = context
+    self._lazy = lazy
+    self._mutex = threading.Lock()
+    self._poller = zmq.Poller()
+    self._sockets = dict()  # zmq socket -> (source, Sub)
+    self._sources = dict()  # source -> Sub
+    self._thread = None
+    self._timeout = timeout
+
+  def __len__(self) -> int:
+    return len(self._sources)
+
+  def __contains__(self, source) -> bool:
+    return source in self._sources
+
+  def add(self, source: str, ip: str, port: int, topics: typing.Optional[list] = None) -> None:
+    '''Subscribes to the publisher at ip:port, to all topics if topics is None'''
+    socket = Sub(self._context, ip, port, label=source, subscribe_all=topics is None)
+    for topic in topics or ():
+      socket.subscribe(topic)
+    with self._mutex:
+      self._sources[source] = socket
+      self._changes.append((source, socket))
+
+  def remove(self, source: str) -> None:
+    '''Unsubscribes from the source, the socket is closed by the polling thread'''
+    with self._mutex:
+      if self._sources.pop(source, None) is not None:
+        self._changes.append((source, None))
+
+  def register(self, callback, source: typing.Optional[str] = None, topic: typing.Optional[str] = None) -> None:
+    with self._mutex:
+      self._callbacks.setdefault((source, topic), []).append(callback)
+
+  def unregister(self, callback, source: typing.Optional[str] = None, topic: typing.Optional[str] = None) -> None:
+    with self._mutex:
+      callbacks = self._callbacks.get((source, topic), [])
+      if callback in callbacks:
+        callbacks.remove(callback)
+      if not callbacks:
+        self._callbacks.pop((source, topic), None)
+
+  def poll(self, timeout: typing.Optional[int] = None) -> int:
+    '''Waits up to timeout ms for messages and dispatches them, returns the number of messages'''
+    self._apply_changes()
+    if not self._sockets:
+      time.sleep((self._timeout if timeout is None else timeout)/1000)
+      return 0
+
+    count = 0
+    for zmq_socket, _ in self._poller.poll(self._timeout if timeout is None else timeout):
+      source, socket = self._sockets[zmq_socket]
+      for _ in range(self._burst):
+        try:
+          frames = zmq_socket.recv_multipart(zmq.NOBLOCK, copy=False)
+        except zmq.error.Again:
+          break
+        count += 1
+        topic, msg = socket._unpack(frames, lazy=True)
+        self._dispatch(source, topic, msg)
+    return count
+
+  def start(self) -> None:
+    '''Starts polling in a daemon thread'''
+    if self._thread is None:
+      self._alive = True
+      self._thread = threading.Thread(target=self._main, daemon=True)
+      self._thread.start()
+
+  def stop(self) -> None:
+    if self._thread is not None:
+      self._alive = False
+      self._thread.join()
+      self._thread = None
+
+  def close(self) -> None:
+    '''Stops the thread and closes all sockets'''
+    self.stop()
+    # pending subscriptions have sockets too, apply them to close them below
+    self._apply_changes()
+    with self._mutex:
+      self._sources.clear()
+    for zmq_socket, (_, socket) in self._sockets.items():
+      self._poller.unregister(zmq_socket)
+      socket.close()
+    self._sockets.clear()
+
+  def _apply_changes(self) -> None:
+    with self._mutex:
+      changes, self._changes = self._changes, list()
+    for source, socket in changes:
+      for zmq_socket, (other, other_socket) in list(self._sockets.items()):
+        if other == source:
+          self._poller.unregister(zmq_socket)
+          del self._sockets[zmq_socket]
+          other_socket.close()
+      if socket is not None:
+        self._poller.register(socket._socket, zmq.POLLIN)
+        self._sockets[socket._socket] = (source, socket)
+
+  def _dispatch(self, source: str, topic: str, msg: LazyMessage) -> None:
+    with self._mutex:
+      callbacks = [callback for key in ((source, topic), (source, None), (None, topic), (None, None)) for callback in self._callbacks.get(key, ())]
+    if not callbacks:
+      return
+    if not self._lazy:
+      msg = msg.msg
+    for callback in callbacks:
+      try:
+        callback(source, topic, msg)
+      except:
+        _logger.error(f'subscriber hub: callback failed for {source} {topic}\n{traceback.format_exc()}')
+
+  def _main(self) -> None:
+    while self._alive:
+      self.poll()
+
+#--------------------------------------------------------------------#
+# Chunked file transfer
+#
+# The client requests chunks by offset and keeps up to 'credit' requests
+# in flight. Every reply is a header frame followed by the raw chunk:
+#   client: {'fcn': 'fetch', 'file': name, 'offset': 0, 'size': 262144, 'tag': 1}
+#   server: {'fcn': 'ack', 'call': 'fetch', 'offset': 0, 'size': 262144, 'crc32': ..., 'tag': 1}, <chunk>
+# A transfer is resumed by requesting from the size of the partial file,
+# the complete file is verified with the sha256 from 'stat'.
+
+class FileServer(Router):
+  '''Serves the files of a directory in chunks, see FileClient'''
+  def __init__(self, context, root, ip='*', port=None, label='files', timeout=1000, min_port=6000, max_port=6100, max_chunk=1 << 20) -> None:
+    Router.__init__(self, context, ip=ip, port=port, label=label, timeout=timeout, min_port=min_port, max_port=max_port)
+    self._alive = False
+    self._digests = dict()  # path -> (mtime, size, sha256)
+    self._max_chunk = max_chunk
+    self._root = os.path.realpath(root)
+    self._thread = None
+
+  def start(self) -> None:
+    '''Serves requests in a daemon thread'''
+    if self._thread is None:
+      self._alive = True
+      self._thread = threading.Thread(target=self._main, daemon=True)
+      self._thread.start()
+
+  def close(self) -> None:
+    if self._thread:
+      self._alive = False
+      self._thread.join()
+      self._thread = None
+    Router.close(self)
+
+  def serve_once(self) -> None:
+    '''Receives and answers one request'''
+    envelope, msg = self.recv_request()
+    fcn = get_fcn(msg)
+    chunk = None
+    if fcn == 'list':
+      answer = ack(fcn)
+      answer['files'] = self.list_files()
+    elif fcn in ('stat', 'fetch'):
+      path = self._path(msg.get('file'))
+      if path is None:
+        answer = nack(fcn, 'File not found')
+        if fcn == 'fetch':
+          answer['tag'] = msg.get('tag')
+      elif fcn == 'stat':
+        answer = ack(fcn)
+        answer['size'], answer['sha256'] = self._digest(path)
+        answer['max_chunk'] = self._max_chunk
+      else:
+        offset = int(msg.get('offset', 0))
+        size = min(int(msg.get('size', self._max_chunk)), self._max_chunk)
+        with open(path, 'rb') as fh:
+          fh.seek(offset)
+          chunk = fh.read(size)
+        answer = ack(fcn)
+        answer.update({'offset': offset, 'size': len(chunk), 'crc32': zlib.crc32(chunk), 'tag': msg.get('tag')})
+    else:
+      answer = nack(fcn, 'request not supported')
+
+    routing, codec = envelope
+    frames = routing + [codec.encode(answer)]
+    if chunk is not None:
+      frames.append(chunk)
+    self._socket.send_multipart(frames, copy=False)
+
+  def _main(self) -> None:
+    while self._alive:
+      try:
+        self.serve_once()
+      except dss.auxiliaries.exception.Again:
+        pass
+      except:
+        _logger.error(f'{self._label} request failed\n{traceback.format_exc()}')
+
+  def _path(self, name: typing.Optional[str]) -> typing.Optional[str]:
+    # only files below the root directory are served
+    if not name:
+      return None
+    path = os.path.realpath(os.path.join(self._root, name))
+    if os.path.commonpath((self._root, path)) != self._root or not os.path.isfile(path):
+      return None
+    return path
+
+  def list_files(self) -> list:
+    '''Returns [{'file': name, 'size': bytes}] of all served files'''
+    files = list()
+    for directory, _, names in os.walk(self._root):
+      for name in names:
+        path = os.path.join(directory, name)
+        files.append({'file': os.path.relpath(path, self._root), 'size': os.path.getsize(path)})
+    return sorted(files, key=lambda entry: entry['file'])
+
+  def _digest(self, path: str) -> typing.Tuple[int, str]:
+    stat = os.stat(path)
+    cached = self._digests.get(path)
+    if cached is None or cached[:2] != (stat.st_mtime, stat.st_size):
+      sha256 = hashlib.sha256()
+      with open(path, 'rb') as fh:
+        for block in iter(lambda: fh.read(self._max_chunk), b''):
+          sha256.update(block)
+      cached = (stat.st_mtime, stat.st_size, sha256.hexdigest())
+      self._digests[path] = cached
+    return cached[1], cached[2]
+
+class FileClient(_Socket):
+  '''Fetches files from a FileServer
+
+  Chunks are requested with up to credit requests in flight and are
+  written straight to '<target>.part', which is renamed when the sha256
+  of the whole file matches. If a transfer fails, e.g. with NoAnswer,
+  the next fetch of the same target resumes from the partial file.'''
+  def __init__(self, context, ip, port, label='files', timeout=5000, credit=8, chunk_size=1 << 18, self_id=None) -> None:
+    _Socket.__init__(self, context, ip, port, label, timeout, socket_type='dealer', self_id=self_id)
+    self._chunk_size = chunk_size
+    self._credit = credit
+    self._tags = itertools.count(1)
+    self.connect()
+
+  def connect(self) -> None:
+    self._socket = self._context.socket(zmq.DEALER)
+    self._socket.connect(f'tcp://{self._ip}:{self._port}')
+    _logger.debug(f'{self._label} Connected to tcp://{self._ip}:{self._port} with timeout {self._timeout}')
+
+  def list(self) -> list:
+    '''Returns [{'file': name, 'size': bytes}] of all files on the server'''
+    return self._request({'fcn': 'list'})['files']
+
+  def stat(self, name: str) -> dict:
+    '''Returns the size and the sha256 of a file'''
+    return self._request({'fcn': 'stat', 'file': name})
+
+  def fetch(self, name: str, target: str, resume: bool = True) -> int:
+    '''Downloads the file to target, returns the number of transferred bytes
+
+    :raises dss.auxiliaries.exception.NoAnswer: if the server stops answering
+    :raises dss.auxiliaries.exception.Nack: if the file does not exist
+    :raises dss.auxiliaries.exception.Error: if a checksum does not match
+    '''
+    stat = self.stat(name)
+    size = stat['size']
+    chunk_size = min(self._chunk_size, stat['max_chunk'])
+    part = target + '.part'
+
+    sha256 = hashlib.sha256()
+    offset = os.path.getsize(part) if resume and os.path.isfile(part) else 0
+    if offset > size:
+      offset = 0
+    if offset:
+      with open(part, 'rb') as fh:
+        for block in iter(lambda: fh.read(chunk_size), b''):
+          sha256.update(block)
+      _logger.info(f'{self._label} resuming {name} at {offset} of {size} bytes')
+
+    transferred = 0
+    tag = next(self._tags)
+    with open(part, 'ab' if offset else 'wb') as fh:
+      requested = offset
+      credit = self._credit
+      while offset < size:
+        while credit and requested < size:
+          self._send({'fcn': 'fetch', 'file': name, 'offset': requested, 'size': min(chunk_size, size - requested), 'tag': tag})
+          requested += chunk_size
+          credit -= 1
+
+        header, chunk = self._recv(name)
+        if header.get('tag') != tag:
+          continue  # left over from an aborted transfer
+        if not is_ack(header):
+          raise dss.auxiliaries.exception.Nack(get_nack_reason(header), 'fetch')
+        if header['offset'] != offset or zlib.crc32(chunk) != header['crc32']:
+          raise dss.auxiliaries.exception.Error(f'{name}: corrupt chunk at offset {header["offset"]}')
+
+        fh.write(chunk)
+        sha256.update(chunk)
+        offset += len(chunk)
+        transferred += len(chunk)
+        credit += 1
+
+    if sha256.hexdigest() != stat['sha256']:
+      os.remove(part)
+      raise dss.auxiliaries.exception.Error(f'{name}: sha256 mismatch')
+    os.replace(part, target)
+    _logger.info(f'{self._label} fetched {name} to {target}, {transferred} bytes transferred')
+    return transferred
+
+  def _request(self, msg: dict) -> dict:
+    self._send(msg)
+    while True:
+      answer, _ = self._recv(msg['fcn'])
+      if answer.get('call') == msg['fcn'] and 'tag' not in answer:
+        break
+    if not is_ack(answer):
+      raise dss.auxiliaries.exception.Nack(get_nack_reason(answer), msg['fcn'])
+    return answer
+
+  def _send(self, msg: dict) -> None:
+    self._socket.send_multipart([b'', self._codec.encode(msg)])
+
+  def _recv(self, what) -> typing.Tuple[dict, typing.Optional[bytes]]:
+    if not self._socket.poll(self._timeout):
+      raise dss.auxiliaries.exception.NoAnswer(what, self.ip, self.port)
+    frames = self._socket.recv_multipart()
+    header = sniff_codec(frames[1]).decode(frames[1])
+    return header, frames[2] if len(frames) > 2 else None
+
+#--------------------------------------------------------------------#
+# asyncio sockets, create them with a context from AsyncContext()
+
+class AsyncReq(_Socket):
+  '''Request socket for asyncio applications
+
+  Same semantics as Req: requests are serialised, a timeout raises
+  NoAnswer and reconnects the socket, and the optional heartbeat is
+  sent when no other request was sent within the timeout. The heartbeat
+  runs as a task on the event loop instead of a thread.'''
+  def __init__(self, context, ip, port, label=None, timeout=1000, self_id=None) -> None:
+    _Socket.__init__(self, context, ip, port, label, timeout, socket_type='req', self_id=self_id)
+
+    self._heartbeat_msg = None
+    self._heartbeat_task = None
+    self._last_activity = time.monotonic()
+    self._mutex = None  # asyncio.Lock, created on first use inside the event loop
+
+    self.connect()
+
+  def close(self) -> None:
+    if self._heartbeat_task:
+      self._heartbeat_task.cancel()
+      self._heartbeat_task = None
+
+    _Socket.close(self)
+
+  def connect(self) -> None:
+    self._socket = self._context.socket(zmq.REQ)
+    self._socket.connect(f'tcp://{self._ip}:{self._port}')
+    self._socket.RCVTIMEO = self._timeout
+    _logger.debug(f'{self._label} Connected to tcp://{self._ip}:{self._port} with timeout {self._timeout}')
+
+  def negotiate_codec(self, codecs: typing.Optional[list]) -> str:
+    '''Selects the codec given the list announced by the peer in get_info'''
+    self.codec = negotiate_codec(codecs)
+    return self.codec
+
+  def start_heartbeat(self, client_id=None) -> None:
+    '''Starts the heartbeat task, must be called from within the event loop'''
+    # update heartbeat message
+    if client_id:
+      self._heartbeat_msg = {'fcn': 'heart_beat', 'id': client_id}
+
+    # task is already running
+    if self._heartbeat_task:
+      return
+
+    if self._heartbeat_msg:
+      self._heartbeat_task = asyncio.ensure_future(self._main_heartbeat())
+
+  def reconnect(self):
+    _logger.info(f'{self._label} reconnecting...')
+    _Socket.close(self)
+    self.connect()
+
+  async def _send_and_receive(self, msg: dict) -> dict:
+    _logger.debug(f'{self._label} send: %s', str(msg)[:256])
+
+    try:
+      await self._socket.send(self._codec.encode(msg))
+    except zmq.error.ZMQError as error:
+      raise dss.auxiliaries.exception.NoAnswer(msg, self.ip, self.port)
+
+    try:
+      reply = await self._socket.recv()
+    except zmq.error.Again as error:
+      self.reconnect()
+      raise dss.auxiliaries.exception.NoAnswer(msg, self.ip, self.port)
+
+    answer = sniff_codec(reply).decode(reply)
+    self._last_activity = time.monotonic()  # indicates successful communication
+
+    _logger.debug(f'{self._label} recv: %s\n', str(answer)[:256])
+    return answer
+
+  async def send_and_receive(self, msg: dict) -> dict:
+    if self._mutex is None:
+      self._mutex = asyncio.Lock()
+    async with self._mutex:
+      return await self._send_and_receive(msg)
+
+  async def _main_heartbeat(self):
+    '''Send a heartbeat if no other messages were sent'''
+    attempts = 0
+    tick = 0
+    interval = self._timeout/1000.0
+    while True:
+      idle = time.monotonic() - self._last_activity
+      if idle < interval:
+        await asyncio.sleep(interval - idle)
+        continue
+
+      heartbeat_msg = self._heartbeat_msg
+      heartbeat_msg['tick'] = tick
+      tick += 1
+      try:
+        answer = await self.send_and_receive(heartbeat_msg)
+      except dss.auxiliaries.exception.NoAnswer:
+        # There was no answer, create a virtual nack to not repeat code
+        answer = {'fcn': 'nack'}
+        self._last_activity = time.monotonic()
+
+      if not is_ack(answer):
+        attempts += 1
+        if attempts < 3:
+          _logger.warning(f"{self._label} no response to heartbeat ({attempts})")
+        elif attempts == 3:
+          _logger.error(f"{self._label} no response to heartbeat ({attempts})")
+      else:
+        attempts = 0
+
+class AsyncRep(Rep):
+  '''Reply socket for asyncio applications, see Rep'''
+
+  async def recv(self) -> dict:
+    '''Receives and decodes a request, the reply will use the same codec'''
+    try:
+      data = await self._socket.recv()
+    except zmq.error.Again as error:
+      raise dss.auxiliaries.exception.Again(error, self.ip, self.port)
+    self._codec = sniff_codec(data)
+    request = self._codec.decode(data)
+    _logger.debug(f'{self._label} recv: %s', str(request)[:256])
+    return request
+
+  async def send(self, msg: dict) -> None:
+    '''Encodes and sends a reply using the codec of the latest request'''
+    try:
+      await self._socket.send(self._codec.encode(msg))
+    except zmq.error.ZMQError as error:
+      _logger.warning(f'{self._label} send: {error}\n')
+      raise
+    else:
+      _logger.debug(f'{self._label} send: %s\n', str(msg)[:256])
+
+class AsyncPub(Pub):
+  '''Publisher socket for asyncio applications, see Pub'''
+
+  async def publish(self, topic: str, msg: dict) -> None:
+    if self._multipart:
+      payload = json.dumps(msg).encode('utf-8')
+      await self._socket.send_multipart([topic.encode('utf-8'), payload], copy=False)
+      _logger.debug(f'{self._label} {topic} %s\n', payload[:256])
+    else:
+      json_msg = mogrify(topic, msg)
+      await self._socket.send_string(json_msg)
+      _logger.debug(f'{self._label} %s\n', str(json_msg)[:256])
+
+class AsyncSub(Sub):
+  '''Subscriber socket for asyncio applications, see Sub'''
+
+  async def recv(self, lazy: bool = False) -> typing.Tuple[str, typing.Union[dict, LazyMessage]]:
+    if self._conflate:
+      return await self._recv_latest(lazy)
+    try:
+      frames = await self._socket.recv_multipart(copy=False)
+    except zmq.error.Again as error:
+      raise dss.auxiliaries.exception.Again(error, self.ip, self.port)
+    return self._unpack(frames, lazy)
+
+  async def latest(self, topic: str, lazy: bool = False) -> typing.Optional[tuple]:
+    '''See Sub.latest'''
+    if not self._conflate:
+      raise dss.auxiliaries.exception.InputError(self._label, 'latest() requires conflate=True')
+    await self._drain()
+    self._pending.pop(topic, None)
+    if topic not in self._latest:
+      return None
+    msg, sequence, stamp = self._latest[topic]
+    return (msg if lazy else msg.msg), sequence, stamp
+
+  async def _recv_latest(self, lazy: bool) -> typing.Tuple[str, typing.Union[dict, LazyMessage]]:
+    if not self._pending:
+      try:
+        frames = await self._socket.recv_multipart(copy=False)
+      except zmq.error.Again as error:
+        raise dss.auxiliaries.exception.Again(error, self.ip, self.port)
+      self._store(frames)
+    await self._drain()
+    topic, _ = self._pending.popitem(last=False)
+    msg = self._latest[topic][0]
+    return topic, msg if lazy else msg.msg
+
+  async def _drain(self) -> None:
+    while True:
+      try:
+        frames = await self._socket.recv_multipart(zmq.NOBLOCK, copy=False)
+      except zmq.error.Again:
+        return
+      self._store(frames)
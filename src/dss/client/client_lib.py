@@ -11,6 +11,7 @@ amd the actual API as described in documentation.
 
 import json
 import logging
+import os
 import time
 
 import dss.auxiliaries
@@ -20,6 +21,8 @@ __version__ = '1.1.0'
 __copyright__ = 'Copyright (c) 2019-2021, RISE'
 __status__ = 'development'
 
+TRACKING_STATE_RATE = 1.0 # [Hz] STATE rate while tracking waypoints, if the app has not enabled STATE
+
 class Client:
   '''Base class for DSS applications'''
   def __init__(self, timeout, exception_handler=None, context=None):
@@ -44,6 +47,8 @@ class Client:
     self._timeout = timeout
     self._in_controls = False
     self._app_abort = False
+    # Streams enabled by the app, waypoint tracking leaves them as they are
+    self._data_streams = set()
 
 
   @property
@@ -252,12 +257,14 @@ class Client:
     self._dss.follow_stream(True, ip, port)
 
   # Enable data stream
-  def enable_data_stream(self, stream):
-    self._dss.data_stream(stream=stream, enable=True)
+  def enable_data_stream(self, stream, rate=None, min_change=None):
+    self._dss.data_stream(stream=stream, enable=True, rate=rate, min_change=min_change)
+    self._data_streams.add(stream)
 
   # Disable data stream
   def disable_data_stream(self, stream):
     self._dss.data_stream(stream=stream, enable=False)
+    self._data_streams.discard(stream)
 
   # Get info pub port or data pub port of connected DSS
   def get_port(self, port_label) -> int:
@@ -402,36 +409,98 @@ class Client:
   def get_idle(self):
     return self._dss.get_idle()
 
+  # Subscribe to the mission progress and the flight state pushed by the DSS,
+  # returns the socket and the streams that were enabled for the tracking
+  def _subscribe_currentWP(self):
+    enabled = list()
+    if 'currentWP' not in self._data_streams:
+      self._dss.data_stream('currentWP', True)
+      enabled.append('currentWP')
+    if 'STATE' not in self._data_streams:
+      self._dss.data_stream('STATE', True, rate=TRACKING_STATE_RATE)
+      enabled.append('STATE')
+    try:
+      socket = dss.auxiliaries.zmq_lib.Sub(self._context, self._dss.ip, self.get_port('info_pub_port'), label='currentWP', timeout=1000, subscribe_all=False)
+    except:
+      self._unsubscribe_currentWP(None, enabled)
+      raise
+    socket.subscribe('currentWP')
+    socket.subscribe('STATE')
+    return (socket, enabled)
+
+  def _unsubscribe_currentWP(self, socket, enabled):
+    if socket:
+      socket.close()
+    for stream in enabled:
+      try:
+        self._dss.data_stream(stream, False)
+      except (dss.auxiliaries.exception.NoAnswer, dss.auxiliaries.exception.Nack) as error:
+        self._logger.warning('Disabling %s after tracking failed: %s', stream, error)
+
+  # Block on the streams until the final wp is reached or the drone is no longer flying
+  def _track_waypoints(self, socket, last_answer, raise_if_aborted):
+    # STATE is published at least at TRACKING_STATE_RATE, silence means that the DSS or the link is lost
+    max_silence = max(3.0/TRACKING_STATE_RATE, self._timeout/1000)
+    t_abort_check = 0.0
+    t_received = time.monotonic()
+    while True:
+      # The controls are requested from the DSS, once per second is enough
+      if raise_if_aborted and time.monotonic() >= t_abort_check:
+        self.raise_if_aborted()
+        t_abort_check = time.monotonic() + 1.0
+      try:
+        (topic, msg) = socket.recv()
+      except dss.auxiliaries.exception.Again:
+        if time.monotonic() - t_received < max_silence:
+          continue
+        # Raises NoAnswer if the DSS is gone, otherwise catch up with the request
+        (topic, msg) = ('currentWP', {'currentWP': self._dss.get_currentWP()[0]})
+      t_received = time.monotonic()
+      if topic == 'STATE':
+        # The mission is over if the drone has landed
+        if msg['flight_state'] != 'flying':
+          return
+        continue
+      currentWP = msg['currentWP']
+      if currentWP != last_answer:
+        self._logger.info('reached wp %s', last_answer)
+        last_answer = currentWP
+        if last_answer == -1:
+          return
+
   # Track waypoints
   def track_waypoints(self, first_wp=0, raise_if_aborted = True):
     '''
     Track wp until end of mission.
     Set raise_if_aborted = False to not throw exception on PILOT in controls
     '''
-
-    last_answer = first_wp
-    while self._dss.get_armed():
-      time.sleep(1.0)
-      if raise_if_aborted:
-        self.raise_if_aborted()
+    (socket, enabled) = self._subscribe_currentWP()
+    try:
+      # gogo was called before the subscription, catch up once
       currentWP, _ = self._dss.get_currentWP()
-      if currentWP != last_answer:
-        self._logger.info('reached wp %s', last_answer)
-        last_answer = currentWP
-        if last_answer == -1:
+      if currentWP != first_wp:
+        self._logger.info('reached wp %s', first_wp)
+        if currentWP == -1:
           return
+      self._track_waypoints(socket, currentWP, raise_if_aborted)
+    finally:
+      self._unsubscribe_currentWP(socket, enabled)
 
   # Start mission flight and track mission progress
   def fly_waypoints_lla(self, first_wp=0):
     self._logger.info('fly waypoints (lla)')
     self._logger.warning('method fly_waypoints_lla is obsolete, use fly_waypoints instead')
-    self._dss.gogo(first_wp)
-    self.track_waypoints(first_wp)
+    self.fly_waypoints(first_wp)
 
   def fly_waypoints(self, first_wp=0, raise_if_aborted = True):
     self._logger.info('Fly waypoints')
-    self._dss.gogo(first_wp)
-    self.track_waypoints(first_wp, raise_if_aborted)
+    # Subscribe before gogo to not miss the first waypoints
+    (socket, enabled) = self._subscribe_currentWP()
+    try:
+      self._dss.gogo(first_wp)
+      self._track_waypoints(socket, first_wp, raise_if_aborted)
+    finally:
+      self._unsubscribe_currentWP(socket, enabled)
 
   # Get current and final wp info
   def get_currentWP(self):
@@ -564,9 +633,19 @@ class Client:
   def photo_continous_photo(self, enable, period=2, publish="off"):
     self._dss.photo('continous_photo', '', '', enable, period, publish)
 
-  # Photo download
-  def photo_download(self, index, resolution):
-    self._dss.photo('download', resolution, index)
+  # Photo download, the photos are fetched from the file server of the photo service
+  def photo_download(self, index, resolution, target_dir='.') -> list:
+    answer = self._dss.photo('download', resolution, index)
+    file_client = dss.auxiliaries.zmq_lib.FileClient(self._context, answer['ip'], answer['port'], label='photo files', timeout=self._timeout)
+    targets = list()
+    try:
+      for photo in answer['files']:
+        target = os.path.join(target_dir, os.path.basename(photo['file']))
+        file_client.fetch(photo['file'], target)
+        targets.append(target)
+    finally:
+      file_client.close()
+    return targets
 
   # Photo recording
   def photo_rec(self, enable):
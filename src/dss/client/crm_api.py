@@ -10,8 +10,9 @@ __copyright__ = 'Copyright (c) 2021, RISE'
 __status__ = 'development'
 
 class CRM:
-  def __init__(self, context, crm, app_name, desc='', app_id=None):
-    '''Either app_id or app_name is required'''
+  def __init__(self, context, crm, app_name, desc='', app_id=None, pipelined=False):
+    '''Either app_id or app_name is required, pipelined=True uses a Dealer
+    socket that allows concurrent requests from several threads'''
     self._logger = logging.getLogger(__name__)
     self._logger.info(f'CRM crm_api {dss.auxiliaries.git.describe()}')
 
@@ -27,7 +28,10 @@ class CRM:
     self._app_id = app_id
 
     # Create request socket, don't start heartbeat thread yet.
-    self._socket = dss.auxiliaries.zmq_lib.Req(self._context, self._ip, self._port, label='crm', timeout=2000)
+    if pipelined:
+      self._socket = dss.auxiliaries.zmq_lib.Dealer(self._context, self._ip, self._port, label='crm', timeout=2000)
+    else:
+      self._socket = dss.auxiliaries.zmq_lib.Req(self._context, self._ip, self._port, label='crm', timeout=2000)
 
   def __del__(self):
     if hasattr(self, '_socket'): # this is sometimes needed if the __init__ function failed
@@ -53,6 +57,9 @@ class CRM:
   def app_lost(self):
     return self._socket.send_and_receive({'id': self._app_id, 'fcn': 'app_lost'})
 
+  def batch(self, requests: list):
+    return self._socket.send_and_receive({'id': self._app_id, 'fcn': 'batch', 'requests': [{'id': self._app_id, **request} for request in requests]})
+
   def clients(self, filter=''):
     return self._socket.send_and_receive({'id': self._app_id, 'fcn': 'clients', 'filter': filter})
 
@@ -76,7 +83,11 @@ class CRM:
     return self._socket.send_and_receive(msg)
 
   def get_info(self):
-    return self._socket.send_and_receive({'id': self._app_id, 'fcn': 'get_info'})
+    answer = self._socket.send_and_receive({'id': self._app_id, 'fcn': 'get_info'})
+    if dss.auxiliaries.zmq_lib.is_ack(answer):
+      # Switch to the preferred codec supported by the CRM
+      self._socket.negotiate_codec(answer.get('codecs'))
+    return answer
 
   def launch_app(self, app_name, extra_args=[], launch : bool=True):
     return self._socket.send_and_receive({'id': self._app_id, 'fcn': 'launch_app', 'app': app_name, 'launch': launch, 'extra_args': extra_args})
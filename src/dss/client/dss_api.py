@@ -16,7 +16,8 @@ __copyright__ = 'Copyright (c) 2021, RISE'
 __status__ = 'development'
 
 class DSS:
-  def __init__(self, context, app_id, ip, port, dss_id, timeout=1000):
+  def __init__(self, context, app_id, ip, port, dss_id, timeout=1000, pipelined=False):
+    '''pipelined=True uses a Dealer socket that allows concurrent requests from several threads'''
     self._logger = logging.getLogger(__name__)
     self._logger.info(f'DSS dss_api {dss.auxiliaries.git.describe()}')
 
@@ -26,7 +27,10 @@ class DSS:
     self._port = port
     self._dss_id = dss_id
 
-    self._socket = dss.auxiliaries.zmq_lib.Req(context, ip, port, label=dss_id, timeout=timeout, self_id=app_id)
+    if pipelined:
+      self._socket = dss.auxiliaries.zmq_lib.Dealer(context, ip, port, label=dss_id, timeout=timeout, self_id=app_id)
+    else:
+      self._socket = dss.auxiliaries.zmq_lib.Req(context, ip, port, label=dss_id, timeout=timeout, self_id=app_id)
     self._socket.start_heartbeat(app_id)
 
   def __del__(self):
@@ -60,6 +64,20 @@ class DSS:
     # return
     return
 
+  def batch(self, requests: list) -> list:
+    '''Sends simple requests in one round trip and returns their answers in
+    order. The sub-requests are not checked for nack, tasks are not allowed.'''
+    call = 'batch'
+    # build message
+    msg = {'fcn': call, 'id': self._app_id, 'requests': [{'id': self._app_id, **request} for request in requests]}
+    # send and receive message
+    answer = self._socket.send_and_receive(msg)
+    # handle nack
+    if not dss.auxiliaries.zmq_lib.is_ack(answer, call):
+      raise dss.auxiliaries.exception.Nack(dss.auxiliaries.zmq_lib.get_nack_reason(answer), fcn=call)
+    # return
+    return answer['answers']
+
   def get_info(self) -> dict:
     call = 'get_info'
     # build message
@@ -72,6 +90,8 @@ class DSS:
     # Take the returned id and store it in the class
     if answer['id'] != self._dss_id:
       self._dss_id = answer['id']
+    # Switch to the preferred codec supported by the DSS
+    self._socket.negotiate_codec(answer.get('codecs'))
     # return
     return answer
 
@@ -411,7 +431,7 @@ class DSS:
     # return
     return
 
-  def photo(self, cmd, resolution='low', index='latest', enable=False, period=10, publish="low") -> None:
+  def photo(self, cmd, resolution='low', index='latest', enable=False, period=10, publish="low") -> dict:
     call = 'photo'
     # build message
     msg = {'fcn': call, 'id': self._app_id}
@@ -431,8 +451,8 @@ class DSS:
     # handle nack
     if not dss.auxiliaries.zmq_lib.is_ack(answer, call):
       raise dss.auxiliaries.exception.Nack(dss.auxiliaries.zmq_lib.get_nack_reason(answer), fcn=call)
-    # return
-    return
+    # return, download has the files and the file server
+    return answer
 
   def get_armed(self) -> bool:
     call = 'get_armed'
@@ -521,12 +541,16 @@ class DSS:
     # return
     return
 
-  def data_stream(self, stream: str, enable: bool) -> None:
+  def data_stream(self, stream: str, enable: bool, rate: typing.Optional[float] = None, min_change: typing.Optional[float] = None) -> None:
     call = 'data_stream'
     # build message
     msg = {'fcn': call, 'id': self._app_id}
     msg['stream'] = stream
     msg['enable'] = enable
+    if rate is not None:
+      msg['rate'] = rate
+    if min_change is not None:
+      msg['min_change'] = min_change
     # send and receive message
     answer = self._socket.send_and_receive(msg)
     # handle nack
@@ -1,6 +1,6 @@
 '''Drone Safety Service'''
 
-from . import photo
+from . import breadcrumbs, flight_recorder, photo, tracker
 from .glana import Glana
 from .hexacopter import Hexacopter
 from .dss import Server
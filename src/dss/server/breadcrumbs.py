@@ -0,0 +1,154 @@
+'''Breadcrumb trail for the DSS SRTL
+
+Reached positions are stored as compact rows (north, east, down, speed,
+heading) in arrays of fixed size, in a local NED frame with the origin in
+the home position. The trail is simplified online when a crumb is added:
+  - a crumb closer than min_dist to the previous one is dropped
+  - a crumb closer than loop_dist to an older part of the trail closes a
+    loop, the trail flown after the closest point is removed
+  - a crumb that makes the previous one redundant, i.e. the previous one
+    is closer than epsilon to the straight line, replaces it
+If the arrays are full the trail is simplified by Douglas-Peucker with an
+increasing tolerance until half of the capacity is free. The memory is
+hence bounded and the return path is short, also after thousands of
+waypoint events.
+'''
+
+import logging
+import threading
+
+import numpy as np
+
+import dss.auxiliaries
+
+__author__ = 'Lennart Ochel <>, Andreas Gising <andreas.gising@ri.se>, Kristoffer Bergman <kristoffer.bergman@ri.se>, Hanna Müller <hanna.muller@ri.se>, Joel Nordahl'
+__version__ = '1.0.0'
+__copyright__ = 'Copyright (c) 2023, RISE'
+__status__ = 'development'
+
+_logger = logging.getLogger(__name__)
+
+def _closest_points(p, a, b) -> tuple:
+  '''Distance [m] from p to the segments a-b and the closest points on the segments, rows broadcast'''
+  ab = b - a
+  ab2 = np.sum(ab*ab, axis=-1)
+  t = np.clip(np.sum((p - a)*ab, axis=-1) / np.where(ab2 > 0.0, ab2, 1.0), 0.0, 1.0)
+  closest = a + t[..., None]*ab
+  return (np.linalg.norm(p - closest, axis=-1), closest)
+
+def douglas_peucker(points, epsilon) -> np.ndarray:
+  '''Boolean mask of the points kept by Douglas-Peucker, the end points are always kept'''
+  keep = np.zeros(len(points), dtype=bool)
+  keep[0] = keep[-1] = True
+  stack = [(0, len(points) - 1)]
+  while stack:
+    (first, last) = stack.pop()
+    if last - first < 2:
+      continue
+    (dist, _) = _closest_points(points[first+1:last], points[first], points[last])
+    i = int(np.argmax(dist))
+    if dist[i] > epsilon:
+      i += first + 1
+      keep[i] = True
+      stack.append((first, i))
+      stack.append((i, last))
+  return keep
+
+class Breadcrumbs:
+  '''Bounded and simplified trail of reached positions'''
+  def __init__(self, capacity=500, min_dist=2.0, loop_dist=5.0, epsilon=1.0):
+    if capacity < 4:
+      raise dss.auxiliaries.exception.InputError(capacity, 'capacity must be at least 4')
+    self._crumbs = np.empty((capacity, 5)) # north, east, down, speed, heading
+    self._epsilon = epsilon
+    self._home = None
+    self._loop_dist = loop_dist
+    self._min_dist = min_dist
+    self._mutex = threading.Lock()
+    self._n = 0
+    self._origin = None
+
+  def __len__(self):
+    with self._mutex:
+      return self._n + (self._home is not None)
+
+  @property
+  def capacity(self) -> int:
+    return len(self._crumbs)
+
+  def reset(self, lat, lon, alt, speed, heading):
+    '''Clears the trail, the position is the new home, i.e. the final point of the return path'''
+    with self._mutex:
+      self._origin = {'lat': lat, 'lon': lon, 'alt': 0.0}
+      self._home = np.array([0.0, 0.0, -alt, speed, heading])
+      self._n = 0
+
+  def add(self, lat, lon, alt, speed, heading):
+    '''Adds a reached position to the trail'''
+    with self._mutex:
+      if self._origin is None:
+        self._origin = {'lat': lat, 'lon': lon, 'alt': 0.0}
+      ned = dss.auxiliaries.math_lib.lla_to_ned({'lat': lat, 'lon': lon, 'alt': alt}, self._origin)
+      crumb = np.array([ned[0], ned[1], ned[2], speed, heading])
+
+      trail = self._trail()
+      if len(trail) > 0 and np.linalg.norm(trail[-1, 0:3] - ned) < self._min_dist:
+        return
+
+      # Close the oldest loop, the latest segment can not close one
+      if len(trail) > 2:
+        (dist, closest) = _closest_points(ned, trail[:-2, 0:3], trail[1:-1, 0:3])
+        loops = np.flatnonzero(dist < self._loop_dist)
+        if len(loops) > 0:
+          k = loops[0]
+          self._n = k + 1 - (self._home is not None)
+          if np.linalg.norm(closest[k] - trail[k, 0:3]) >= self._min_dist:
+            self._crumbs[self._n] = np.concatenate((closest[k], crumb[3:]))
+            self._n += 1
+          trail = self._trail()
+          if np.linalg.norm(trail[-1, 0:3] - ned) < self._min_dist:
+            return
+
+      # Replace the latest crumb if it is on the line to the new one
+      if len(trail) >= 2 and self._n > 0:
+        if _closest_points(trail[-1, 0:3], trail[-2, 0:3], ned)[0] < self._epsilon:
+          self._crumbs[self._n - 1] = crumb
+          return
+
+      if self._n == self.capacity:
+        self._simplify()
+      self._crumbs[self._n] = crumb
+      self._n += 1
+
+  def path(self) -> list:
+    '''The return path, [{lat, lon, alt, speed, heading}] from the latest crumb to home'''
+    with self._mutex:
+      trail = self._trail()[::-1]
+      origin = self._origin
+    path = list()
+    for (north, east, down, speed, heading) in trail:
+      lla = dss.auxiliaries.math_lib.ned_to_lla(np.array([north, east, down]), origin)
+      path.append({'lat': origin['lat'] + float(lla[0]), 'lon': origin['lon'] + float(lla[1]), 'alt': float(lla[2]),
+                   'speed': float(speed), 'heading': float(heading)})
+    return path
+
+  def _trail(self) -> np.ndarray:
+    # Home followed by the crumbs, oldest first
+    if self._home is None:
+      return self._crumbs[:self._n]
+    return np.vstack((self._home, self._crumbs[:self._n]))
+
+  def _simplify(self):
+    # Douglas-Peucker on the full trail, home and the latest crumb are kept
+    trail = self._trail()
+    offset = 1 if self._home is not None else 0
+    epsilon = max(self._epsilon, 1e-3)
+    while True:
+      keep = douglas_peucker(trail[:, 0:3], epsilon)
+      if np.count_nonzero(keep) - offset <= self.capacity//2:
+        break
+      epsilon *= 2
+    crumbs = trail[keep][offset:]
+    self._crumbs[:len(crumbs)] = crumbs
+    _logger.info('SRTL trail simplified from %d to %d crumbs, tolerance %.1f m', self._n, len(crumbs), epsilon)
+    self._n = len(crumbs)
@@ -1,7 +1,8 @@
 '''Drone Safety Service Server'''
 
-import json
+import concurrent.futures
 import logging
+import math
 import threading
 import time
 import traceback
@@ -17,11 +18,14 @@ __copyright__ = 'Copyright (c) 2019-2022, RISE'
 __status__ = 'development'
 
 MAX_PRIORITY = 10
+STREAM_KEEPALIVE = 1.0 # [s] streams with min_change are published at least this often
+BATTERY_INTERVAL = 10.0 # [s] default publish interval of the battery stream
+EVENT_STREAMS = ('currentWP', 'photo_LLA') # published on every event, never rate limited
 
 class Server:
   '''Drone Safety Service Server - new implementation'''
 
-  def __init__(self, dss_ip, dss_id='', drone: str='', baud=921600, with_gcs=False, gcs_address=None, rangefinder=False, autogain=False, midstick_check=True, clearance_check=True, photo=False, crm: str='', capabilities=None, description='crm_dss', die_gracefully: bool=False):
+  def __init__(self, dss_ip, dss_id='', drone: str='', baud=921600, with_gcs=False, gcs_address=None, rangefinder=False, autogain=False, midstick_check=True, clearance_check=True, photo=False, flight_recorder=False, crm: str='', capabilities=None, description='crm_dss', die_gracefully: bool=False):
     if die_gracefully:
       # source: https://stackoverflow.com/a/31464349
       import signal
@@ -30,6 +34,9 @@ class Server:
 
     # create all objects that are used in the destructor
     self._photo = None
+    self._photo_index = 0
+    self._photo_ip = None
+    self._flight_recorder = None
     self._dss_id = dss_id
     self._dss_ip = dss_ip
 
@@ -73,16 +80,18 @@ class Server:
     app_port = None if crm else config['DSS']['ServSocket'].split(':')[-1]
     if crm:
       # We will connect to crm, set random ports within range.
-      self._serv_socket = dss.auxiliaries.zmq_lib.Rep(self._zmq_context, port=app_port, label='dss', min_port=crm_port+1, max_port=crm_port+49)
-      self._pub_socket = dss.auxiliaries.zmq_lib.Pub(self._zmq_context, port=None, min_port=crm_port+1, max_port=crm_port+50, label='info')
+      self._serv_socket = dss.auxiliaries.zmq_lib.Router(self._zmq_context, port=app_port, label='dss', min_port=crm_port+1, max_port=crm_port+49)
+      self._pub_socket = dss.auxiliaries.zmq_lib.Pub(self._zmq_context, port=None, min_port=crm_port+1, max_port=crm_port+50, label='info', multipart=True)
     else:
       # We are running dss stand alone, set standard ports
-      self._serv_socket = dss.auxiliaries.zmq_lib.Rep(self._zmq_context, port=app_port, label='dss', min_port=6000, max_port=6100)
-      self._pub_socket = dss.auxiliaries.zmq_lib.Pub(self._zmq_context, port=5558, min_port=6000, max_port=6100, label='info')
+      self._serv_socket = dss.auxiliaries.zmq_lib.Router(self._zmq_context, port=app_port, label='dss', min_port=6000, max_port=6100)
+      self._pub_socket = dss.auxiliaries.zmq_lib.Pub(self._zmq_context, port=5558, min_port=6000, max_port=6100, label='info', multipart=True)
     self._logger.info('Starting pub server on %d... done', self._pub_socket.port)
 
     if photo:
       self._photo = dss.server.photo.Client(self._zmq_context, config['DSS']['PhotoClient'])
+      # tcp://<ip>:<port>, the file server of the photo service is on the same host
+      self._photo_ip = config['DSS']['PhotoClient'].rsplit(':', 1)[0].rsplit('/', 1)[-1]
       self._logger.info('Connecting to photo client on %s... done', config['DSS']['PhotoClient'])
 
 
@@ -91,16 +100,29 @@ class Server:
                             'LLA':                   {'enabled': False, 'name': 'location.global_frame'},
                             'NED':                   {'enabled': False, 'name': 'location.local_frame'},
                             'XYZ':                   {'enabled': False, 'name': 'TODO'},
-                            'photo_LLA':             {'enabled': False, 'name': 'TODO'},
+                            'photo_LLA':             {'enabled': False, 'name': 'photo_LLA'},      # Notified by _request_photo
                             'photo_XYZ':             {'enabled': False, 'name': 'TODO'},
-                            'currentWP':             {'enabled': False, 'name': 'TODO'},
-                            'battery':               {'enabled': False, 'name': 'TODO'},
+                            'currentWP':             {'enabled': False, 'name': 'currentWP'},      # Notified by Hexacopter.task_gogo
+                            'battery':               {'enabled': False, 'name': 'battery'},
                             'STATE':                 {'enabled': False, 'name': None}}        # Trigger LLA subscription, but not twice. Handeled in _attribute_listener
+    # publish limits set by data_stream, interval [s] from rate, min_change [m] or [rad]
+    for attribute in self._pub_attributes.values():
+      attribute.update({'interval': 0.0, 'min_change': 0.0, 't_next': 0.0, 't_last': 0.0, 'last': None})
+    self._pub_attributes['battery']['interval'] = BATTERY_INTERVAL
+    # STATE is published by a timer if data_stream gave it a rate
+    self._state_timer = None
+    self._pub_mutex = threading.Lock()
 
 
     # create the hexacopter object
     self._hexa = dss.server.Hexacopter(f'{drone_ip}:{drone_port}', baud, rangefinder)
 
+    # record the vehicle attributes at full rate
+    if flight_recorder:
+      timestamp = time.strftime('%Y%m%d_%H%M%S')
+      self._flight_recorder = dss.server.flight_recorder.FlightRecorder('log/' + '{}_{}'.format(timestamp, 'flight-data.fdr'))
+      self._flight_recorder.attach(self._hexa.vehicle)
+
     # init GLANA
     self._hexa.glana = dss.server.Glana(self._zmq_context, config['DSS']['GlanaClientSocket'])
     self._hexa.glana_autogain = autogain
@@ -111,6 +133,7 @@ class Server:
 
     # Functions in same order as documentation
     self._commands = {'arm_take_off':       {'request': self._request_arm_take_off,       'task': self._task_arm_take_off, 'priority': MAX_PRIORITY},
+                      'batch':              {'request': self._request_batch,              'task': None},
                       'data_stream':        {'request': self._request_data_stream,        'task': None},
                       'disconnect':         {'request': self._request_disconnect,         'task': self._task_disconnect, 'priority': 1},
                       'dss_srtl':           {'request': self._request_dss_srtl,           'task': self._task_dss_srtl, 'priority': MAX_PRIORITY},
@@ -128,7 +151,7 @@ class Server:
                       'gogo':               {'request': self._request_gogo,               'task': self._task_gogo, 'priority': 1}, # Not fully implemented
                       'heart_beat':         {'request': self._request_heart_beat,         'task': None},
                       'land':               {'request': self._request_land,               'task': self._task_land, 'priority': MAX_PRIORITY},
-                      'photo':              {'request': self._request_photo,              'task': None}, # Not implemented
+                      'photo':              {'request': self._request_photo,              'task': None, 'worker': True}, # Not implemented
                       'reset_dss_srtl':     {'request': self._request_reset_dss_srtl,     'task': None},
                       'rtl':                {'request': self._request_rtl,                'task': self._task_rtl, 'priority': MAX_PRIORITY},
                       'set_default_speed':  {'request': self._request_set_default_speed,  'task': None}, # Not implemented
@@ -154,12 +177,20 @@ class Server:
 
     self._alive = True
     self._in_controls = 'PILOT'
+    self._status = ''
+
+    # requests, state machine checks and status output are events of the main thread
+    self._reactor = dss.auxiliaries.Reactor(self._zmq_context)
+    # requests that block on other services, one worker keeps the photo client serialised
+    self._workers = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix='dss_worker')
 
     #start attribute_listener for clearance check
     if self._clearance_check:
       self._hexa.vehicle.add_attribute_listener("channel13", self._clearance_listener)
     #Internal state for clearance command : WAITING, HIGH, CLEARED
     self._clearance_state = 'WAITING' if self._clearance_check else 'CLEARED'
+    # react on flight mode changes without waiting for the next check
+    self._hexa.vehicle.add_attribute_listener('mode', self._mode_listener)
     # start main thread
     main_thread = threading.Thread(target=self._main, daemon=False)
     main_thread.start()
@@ -211,6 +242,8 @@ class Server:
   @alive.setter
   def alive(self, value):
     self._alive = value
+    if not value:
+      self._reactor.stop()
 
 	# Ack nack helpers
 	# Is message from owner?
@@ -236,6 +269,34 @@ class Server:
   # REQUESTS
   #############################################################################
 
+  def _request_batch(self, msg) -> dict:
+    '''Runs a list of simple requests in order and replies with all answers'''
+    fcn = dss.auxiliaries.zmq_lib.get_fcn(msg)
+    # Test nack reasons
+    if not isinstance(msg.get('requests'), list):
+      answer = dss.auxiliaries.zmq_lib.nack(fcn, 'Requests faulty')
+    # Accept
+    else:
+      answers = list()
+      for request in msg['requests']:
+        sub_fcn = request.get('fcn', '') if isinstance(request, dict) else ''
+        if sub_fcn not in self._commands or sub_fcn == fcn:
+          answers.append(dss.auxiliaries.zmq_lib.nack(sub_fcn, 'request not supported'))
+        elif self._commands[sub_fcn]['task']:
+          # Tasks may abort each other, they have to be sent one by one
+          answers.append(dss.auxiliaries.zmq_lib.nack(sub_fcn, 'Tasks are not allowed in a batch'))
+        else:
+          request = dict(request)
+          request.setdefault('id', msg['id'])
+          # One failing request must not drop the answers of the others
+          try:
+            answers.append(self._commands[sub_fcn]['request'](request))
+          except:
+            self._logger.error(f'unexpected exception\n{traceback.format_exc()}')
+            answers.append(dss.auxiliaries.zmq_lib.nack(sub_fcn, 'unexpected exception'))
+      answer = dss.auxiliaries.zmq_lib.ack(fcn, {'answers': answers})
+    return answer
+
   def _request_heart_beat(self, msg) -> dict:
     fcn = dss.auxiliaries.zmq_lib.get_fcn(msg)
     # Test nack reasons
@@ -298,18 +359,17 @@ class Server:
   def _request_get_state(self, msg) -> dict:
     fcn = dss.auxiliaries.zmq_lib.get_fcn(msg)
     # No nack reasons, accept
-    # Build up answer
-    pos = self._hexa.get_position_lla()
-    heading_deg = self._hexa.get_heading(unit="deg")
-    (vel_n, vel_e, vel_d) = self._hexa.get_velocity(ref="NED")
-    mess = {'lat': pos.lat, 'lon': pos.lon, 'alt': pos.alt, 'heading': heading_deg, 'agl': -1, 'vel_n': vel_n, 'vel_e': vel_e, 'vel_d': vel_d, 'gnss_state': self._hexa.gnss_state, 'flight_state': self._hexa.flight_state}
+    # Build up answer from the state snapshot
+    state = self._hexa.state
+    heading_deg = None if state.yaw is None else state.yaw/math.pi*180
+    mess = {'lat': state.lat, 'lon': state.lon, 'alt': state.alt, 'heading': heading_deg, 'agl': -1, 'vel_n': state.vel_n, 'vel_e': state.vel_e, 'vel_d': state.vel_d, 'gnss_state': state.gnss_state, 'flight_state': state.flight_state}
     answer = dss.auxiliaries.zmq_lib.ack(fcn, mess)
     return answer
 
   def _request_get_info(self, msg) -> dict:
     fcn = dss.auxiliaries.zmq_lib.get_fcn(msg)
     # No nack reasons, accept
-    answer = dss.auxiliaries.zmq_lib.ack(fcn, {'info_pub_port': self._pub_socket.port, 'data_pub_port': '', 'id': self._dss_id})
+    answer = dss.auxiliaries.zmq_lib.ack(fcn, {'info_pub_port': self._pub_socket.port, 'data_pub_port': '', 'id': self._dss_id, 'codecs': dss.auxiliaries.zmq_lib.available_codecs()})
     return answer
 
   def _request_set_init_point(self, msg) -> dict:
@@ -647,10 +707,18 @@ class Server:
     # Accept
     else:
       if cmd == 'take_photo':
-        answer = dss.auxiliaries.zmq_lib.ack(fcn)
-        answer['description'] = 'take_photo'
-        # TODO, take_photo
-        answer = dss.auxiliaries.zmq_lib.nack(fcn, 'Take photo not implemented')
+        if self._photo is None:
+          answer = dss.auxiliaries.zmq_lib.nack(fcn, 'Take photo not implemented')
+        elif not self._photo.take_picture():
+          answer = dss.auxiliaries.zmq_lib.nack(fcn, 'Camera did not take the photo')
+        else:
+          answer = dss.auxiliaries.zmq_lib.ack(fcn)
+          answer['description'] = 'take_photo'
+          # Push the metadata to the photo_LLA stream, filename is not known until download
+          self._photo_index += 1
+          state = self._hexa.state
+          metadata = {'index': self._photo_index, 'filename': '', 'lat': state.lat, 'lon': state.lon, 'alt': state.alt_amsl, 'agl': -1, 'heading': state.heading}
+          self._hexa.vehicle.notify_attribute_listeners('photo_LLA', metadata)
       elif cmd == 'continous_photo':
         enable = msg['enable']
         publish = msg['publish'] #'off', 'low' or 'high'
@@ -664,26 +732,37 @@ class Server:
         # TODO, enable/disable continous photo
         answer = dss.auxiliaries.zmq_lib.nack(fcn, 'Continous photo not implemented')
       elif cmd == 'download':
-        resolution = msg['resolution']
-        index = msg['index']
-        # Test more nack reasons
-        if False:
-          anser = dss.auxiliaries.zmq_lib.nack(fcn, 'Index out of range' + index)
-        elif False:
-          anser = dss.auxiliaries.zmq_lib.nack(fcn, 'Index string faulty' + index)
-        # Accept
-        else:
-          answer = dss.auxiliaries.zmq_lib.ack(fcn)
-          answer['description'] = 'download ' + 'index'
-          # TODO, download photo
+        # The photo service stores the photos in full resolution only
+        index = str(msg.get('index', 'latest'))
+        files = self._photo.files() if self._photo is not None else None
+        if files is None:
           answer = dss.auxiliaries.zmq_lib.nack(fcn, 'Download photo not implemented')
+        elif files.get('fcn') != 'ack':
+          answer = dss.auxiliaries.zmq_lib.nack(fcn, 'Photo server did not list the photos')
+        elif index not in ('latest', 'all') and not index.isdigit():
+          answer = dss.auxiliaries.zmq_lib.nack(fcn, 'Index string faulty, ' + index)
+        else:
+          photos = files['files']
+          if index == 'latest':
+            photos = photos[-1:]
+          elif index != 'all':
+            photos = [photo for photo in photos if photo['file'].startswith('img_%s.' % index.zfill(5))]
+          if not photos:
+            answer = dss.auxiliaries.zmq_lib.nack(fcn, 'Index out of range, ' + index)
+          # Accept, the requester fetches the files from the file server of the photo service
+          else:
+            answer = dss.auxiliaries.zmq_lib.ack(fcn)
+            answer['description'] = 'download ' + index
+            answer['files'] = photos
+            answer['ip'] = self._photo_ip
+            answer['port'] = files['port']
     return answer
 
   def _request_get_armed(self, msg) -> dict:
     fcn = dss.auxiliaries.zmq_lib.get_fcn(msg)
     # No nack reasons, accept
     answer = dss.auxiliaries.zmq_lib.ack(fcn)
-    answer['armed'] = self._hexa.vehicle.armed
+    answer['armed'] = self._hexa.state.armed
     return answer
 
   def _request_get_currentWP(self, msg) -> dict:
@@ -698,7 +777,7 @@ class Server:
     fcn = dss.auxiliaries.zmq_lib.get_fcn(msg)
     # No nack reasons, accept
     answer = dss.auxiliaries.zmq_lib.ack(fcn)
-    answer['flightmode'] = self._hexa.get_flight_mode()
+    answer['flightmode'] = self._hexa.state.flight_mode
     return answer
 
   def _request_get_metadata(self, msg) -> dict:
@@ -729,11 +808,7 @@ class Server:
     fcn = dss.auxiliaries.zmq_lib.get_fcn(msg)
     # No nack reasons, accept
     answer = dss.auxiliaries.zmq_lib.ack(fcn)
-    if self._hexa.vehicle.location.local_frame.down is None:
-      posD = 0.0
-    else:
-      posD = self._hexa.vehicle.location.local_frame.down
-    answer['posD'] = posD
+    answer['posD'] = self._hexa.state.posD
     return answer
 
   def _request_get_PWM(self, msg) -> dict:
@@ -766,29 +841,48 @@ class Server:
     # Parse
     stream = msg['stream']
     enable = msg['enable']
+    rate = msg.get('rate', 0)
+    min_change = msg.get('min_change', 0)
     # Test nack reasons
     if stream not in self._pub_attributes:
       descr = 'Stream faulty, ' + stream
       answer = dss.auxiliaries.zmq_lib.nack(fcn, descr)
+    elif not isinstance(rate, (int, float)) or rate < 0:
+      answer = dss.auxiliaries.zmq_lib.nack(fcn, 'Rate faulty')
+    elif not isinstance(min_change, (int, float)) or min_change < 0:
+      answer = dss.auxiliaries.zmq_lib.nack(fcn, 'Min change faulty')
     # Accept
     else:
       answer = dss.auxiliaries.zmq_lib.ack(fcn)
       # Update publish attributes dict
       self._pub_attributes[stream]['enabled'] = enable
+      default_interval = BATTERY_INTERVAL if stream == 'battery' else 0.0
+      with self._pub_mutex:
+        self._pub_attributes[stream].update({'interval': 1.0/rate if rate else default_interval, 'min_change': min_change, 't_next': 0.0, 'last': None})
+      # STATE with a rate is coalesced from position and velocity at a fixed tick
+      if stream == 'STATE':
+        if self._state_timer:
+          self._reactor.cancel(self._state_timer)
+          self._state_timer = None
+        if enable and rate:
+          self._pub_attributes[stream]['interval'] = 0.0
+          self._state_timer = self._reactor.call_every(1.0/rate, self._publish_state)
+          return answer
       # Activate publish of stream
       if stream == 'STATE':
-        # STATE requires pos attribute listener. Make sure there is one enabled.
-        if not self._pub_attributes['LLA']['enabled']:
-          msg_mod = msg
-          msg_mod['stream'] = 'LLA'
-          return self._request_data_stream(msg_mod)
+        # STATE requires pos attribute listener. Make sure there is one enabled,
+        # with the defaults of LLA, not the rate and min change of STATE.
+        if enable and not self._pub_attributes['LLA']['enabled']:
+          return self._request_data_stream({'fcn': fcn, 'id': msg.get('id'), 'stream': 'LLA', 'enable': True})
+        # STATE has no listener of its own
+        return answer
       if enable:
         self._hexa.vehicle.add_attribute_listener(self._pub_attributes[stream]['name'], self._attribute_listener)
         self._logger.info("Global listener added: %s", stream)
       # Deactivate publish of stream
       else:
         # STATE stream requires pos attribute listener.
-        if stream == 'LLA' and self._pub_attributes['STATE']['enabled']:
+        if stream == 'LLA' and self._pub_attributes['STATE']['enabled'] and self._state_timer is None:
           return dss.auxiliaries.zmq_lib.nack(fcn, 'STATE stream is active')
         self._hexa.vehicle.remove_attribute_listener(self._pub_attributes[stream]['name'], self._attribute_listener)
         self._logger.info("Global listener removed: %s", stream)
@@ -870,16 +964,16 @@ class Server:
     port = msg['port']
 
     if self._hexa.follow_stream_enabled:
-      # setup the subscription!
-      self._sub_stream_socket = dss.auxiliaries.zmq_lib.Sub(self._zmq_context, ip, port, label="follow_stream subscr")
-      self._sub_stream_socket.subscribe('LLA')
-      # Start follow stream thread
-      self._hexa.follow_stream()
-
-    #else: # Put else in request?
-      # Stop the subscription and close socket if they exist(!), TODO
-      #self._sub_stream_socket.unsubscribe('')
-      #self._sub_stream_socket.close()
+      # setup the subscription! Every sample is filtered, hence no conflate
+      socket = dss.auxiliaries.zmq_lib.Sub(self._zmq_context, ip, port, label="follow_stream subscr", timeout=100, subscribe_all=False)
+      socket.subscribe('LLA')
+      tracker = dss.server.tracker.StreamTracker(socket)
+      tracker.start()
+      # Follow the stream until disabled or aborted, then stop the subscription
+      try:
+        self._hexa.follow_stream(tracker)
+      finally:
+        tracker.stop()
 
 
   def _task_set_gripper(self, msg):
@@ -916,27 +1010,81 @@ class Server:
   def _attribute_listener(self, vehicle, att_name, msg):
     if att_name == 'attitude':
       msg = {"r": msg.roll, "p": msg.pitch, "y": msg.yaw}
-      self._pub_socket.publish('ATT', msg)
+      self._publish_stream('ATT', msg)
       #print("Attitude callback sending log data:", json_msg)
     # LLA
     elif att_name == 'location.global_frame':
-      msg_LLA = {'lat': msg.lat, 'lon': msg.lon, 'alt': msg.alt, 'heading': vehicle.heading, 'gnss_state': self._hexa.gnss_state, 'agl': -1 }
-      self._pub_socket.publish('LLA', msg_LLA)
-      if self._pub_attributes['STATE']['enabled']:
-        vel = vehicle.velocity
-        vel_n = vel[0]
-        vel_e = vel[1]
-        vel_d = vel[2]
-        msg_STATE = {'lat': msg.lat, 'lon': msg.lon, 'alt': msg.alt, 'heading': vehicle.heading, 'agl': -1, 'vel_n': vel_n, 'vel_e': vel_e, 'vel_d': vel_d, 'gnss_state': self._hexa.gnss_state, 'flight_state': self._hexa.flight_state}
-        self._pub_socket.publish('STATE', msg_STATE)
+      # heading and gnss from the snapshot, consistent with STATE and no dronekit attribute locks
+      state = self._hexa.state
+      msg_LLA = {'lat': msg.lat, 'lon': msg.lon, 'alt': msg.alt, 'heading': state.heading, 'gnss_state': state.gnss_state, 'agl': -1, 'time': time.time()}
+      self._publish_stream('LLA', msg_LLA)
+      if self._pub_attributes['STATE']['enabled'] and self._state_timer is None:
+        self._publish_stream('STATE', self._state_msg(state, msg))
 
     # NED
     elif att_name == 'location.local_frame':
       msg = {'north': msg.north, 'east': msg.east, 'down': msg.down, 'heading': vehicle.heading, 'velocity': vehicle.velocity, 'agl': -1}
-      self._pub_socket.publish('NED', msg)
+      self._publish_stream('NED', msg)
+    # Mission progress, (currentWP, finalWP) from Hexacopter.task_gogo
+    elif att_name == 'currentWP':
+      self._publish_stream('currentWP', {'currentWP': msg[0], 'finalWP': msg[1]})
+    elif att_name == 'battery':
+      msg = {'remaining_time': self._hexa.battery_remaining_time(msg.level), 'voltage': msg.voltage, 'current': msg.current, 'level': msg.level}
+      self._publish_stream('battery', msg)
+    elif att_name == 'photo_LLA':
+      self._publish_stream('photo_LLA', msg)
     else:
       self._logger.error('Unknown attribute send to listener: %s', att_name)
 
+  @staticmethod
+  def _state_msg(state, location=None) -> dict:
+    # the position of the triggering callback is newer than the snapshot
+    if location is None:
+      (lat, lon, alt) = (state.lat, state.lon, state.alt_amsl)
+    else:
+      (lat, lon, alt) = (location.lat, location.lon, location.alt)
+    return {'lat': lat, 'lon': lon, 'alt': alt, 'heading': state.heading, 'agl': -1, 'vel_n': state.vel_n, 'vel_e': state.vel_e, 'vel_d': state.vel_d, 'gnss_state': state.gnss_state, 'flight_state': state.flight_state}
+
+  # STATE timer, runs in the main thread
+  def _publish_state(self):
+    self._publish_stream('STATE', self._state_msg(self._hexa.state))
+
+  def _publish_stream(self, stream, msg):
+    '''Publishes msg unless the rate or the min change of the stream suppresses it'''
+    # The listeners of dronekit and the reactor publish, the rate limit is checked under the mutex
+    with self._pub_mutex:
+      if stream in EVENT_STREAMS:
+        self._pub_socket.publish(stream, msg)
+        return
+      attribute = self._pub_attributes[stream]
+      now = time.monotonic()
+      if now < attribute['t_next']:
+        return
+      if attribute['min_change'] and attribute['last'] and now - attribute['t_last'] < STREAM_KEEPALIVE:
+        if self._stream_change(stream, attribute['last'], msg) < attribute['min_change']:
+          return
+      # keep the average rate, but don't catch up after a pause
+      base = attribute['t_next'] if now - attribute['t_next'] < attribute['interval'] else now
+      attribute['t_next'] = base + attribute['interval']
+      attribute['t_last'] = now
+      attribute['last'] = msg
+      self._pub_socket.publish(stream, msg)
+
+  @staticmethod
+  def _stream_change(stream, last, msg) -> float:
+    if stream == 'ATT':
+      return max(abs(msg[key] - last[key]) for key in ('r', 'p', 'y'))
+    if stream == 'NED':
+      return math.sqrt(sum((msg[key] - last[key])**2 for key in ('north', 'east', 'down')))
+    if stream == 'battery':
+      return abs(msg['voltage'] - last['voltage'])
+    # LLA and STATE, a new flight or gnss state is always published
+    if stream == 'STATE' and (msg['flight_state'], msg['gnss_state']) != (last['flight_state'], last['gnss_state']):
+      return math.inf
+    # lla_to_ned gives the absolute altitude as down, the vertical change is the altitude difference
+    ned = dss.auxiliaries.math_lib.lla_to_ned(msg, last)
+    return math.sqrt(ned[0]**2 + ned[1]**2 + (msg['alt'] - last['alt'])**2)
+
   def _clearance_listener(self, vehicle, att_name, value):
     if not self._midstick_check or ( 1400 < self._hexa.get_channel(3) < 1600):
       if self._clearance_state == 'WAITING':
@@ -947,6 +1095,9 @@ class Server:
           self._clearance_state = 'CLEARED'
           self._logger.info('PILOT gave clearance via clearance switch')
 
+  def _mode_listener(self, vehicle, att_name, value):
+    # runs in the dronekit thread, the check is done by the main thread
+    self._reactor.call_soon(self._on_flight_mode_changed)
 
   #############################################################################
   # THREAD *TASKS*
@@ -1023,34 +1174,27 @@ class Server:
     else:
       self._logger.warning("MODEM: FAILED to set Modem to report Cell-ID on request")
 
-    # Allocate logfiles
+    # Allocate logfile, one JSON line per sample. Convert with dev/jsonl_to_json.py
     timestamp = time.strftime('%Y%m%d_%H%M%S')
-    log_items_filename = '{}_{}'.format(timestamp, 'network-log-items.txt')
-    log_filename = '{}_{}'.format(timestamp, 'network-log.json')
-    log_items = 'log/' + log_items_filename
-    log_file = 'log/' + log_filename
+    log_file = 'log/' + '{}_{}'.format(timestamp, 'network-log.jsonl')
 
     # Poll static infomration
     static = self._modem.get_static_info()
     self._logger.info(f'MODEM: imei: {static["imei"]}, number: {static["number"]}')
 
-    # Save static information and leave out final curly bracket
-    with open(log_items, 'w', encoding="utf-8") as outfile:
-          # Manually add the key to prevent the final curly bracket
-          outfile.write('{ "static_info":')
-          # Write the log_item as a string under the newly added key
-          outfile.write(json.dumps(static))
-
-    # Wait for vehicle to arm
-    while not self._hexa.is_armed():
-      time.sleep(0.5)
-
-    # Enter loop to collect data until landed for xx seconds
-    index = 0
-    t_landed = 0
-    t_sleep = 1
-    t_landed_threshold = 15/t_sleep # Unit seconds
-    while t_landed < t_landed_threshold :
+    with dss.auxiliaries.recorder.JsonlRecorder(log_file) as recorder:
+      # Save static information
+      recorder.write({'static_info': static})
+
+      # Wait for vehicle to arm
+      while not self._hexa.is_armed():
+        time.sleep(0.5)
+
+      # Enter loop to collect data until landed for xx seconds
+      t_landed = 0
+      t_sleep = 1
+      t_landed_threshold = 15/t_sleep # Unit seconds
+      while t_landed < t_landed_threshold :
         if self._hexa.flight_state == 'landed':
           t_landed += t_sleep
         else:
@@ -1066,192 +1210,193 @@ class Server:
         log_item['pos']['alt'] = pos.alt
         log_item['pos']['fix_type'] = self._hexa.gnss_state_str
 
-        # Save the log_item under a new key in the log file built line by line
-        with open(log_items, 'a', encoding="utf-8") as outfile:
-          # Write comma to previous line
-          outfile.write(',')
-          # Add a new numbered key manually
-          new_key = '"' + str(index) + '"' + ':'
-          outfile.write(new_key)
-          # write the log_item as a string under the newly added key
-          outfile.write(json.dumps(log_item))
+        # Save the log_item, the recorder flushes in the background
+        recorder.write(log_item)
         time.sleep(t_sleep)
-        index+=1
-
-    # Add the final curly bracket
-    with open(log_items, 'a', encoding="utf-8") as outfile:
-      outfile.write('}')
-
-    # Open the log file and save it in an other file with pretty print
-    with open(log_items, 'r', encoding="utf-8") as infile:
-      big_json = json.load(infile)
-      with open(log_file, 'w', encoding="utf-8") as outfile:
-        log_str = json.dumps(big_json, indent=4)
-        outfile.write(log_str)
+
     self._logger.info("MODEM: Logging complete!")
 
   #############################################################################
   # THREAD *MAIN*
   #############################################################################
 
-  def _main(self):
-    '''Listening for new requests and gcs heartbeats'''
-    attempts = 0
+  def _set_status(self, status):
+    self._status = '[%s has the CONTROLS] %s' % (self._in_controls, status)
+
+  def _print_status(self):
+    print('\033[K', end='\r') # clear to the end of line
+    print(self._status, end='\r')
+
+  # Monitor gcs heartbeats
+  def _check_gcs_link(self):
+    if self._in_controls == 'APPLICATION' and self.lost_link_to_gcs():
+      self._logger.error('Lost link to the gcs heartbeats; DSS taking the CONTROLS')
+      self._in_controls = 'DSS'
+      self._update_controls()
+
+  # Monitor if pilot changed flight mode
+  def _check_flight_mode(self):
+    if self._in_controls in ('APPLICATION', 'DSS'):
+      if not self._hexa.expected_flight_mode:
+        mode = self._hexa.get_flight_mode()
+        self._logger.warning('Unexpected flight mode: %s; PILOT took the CONTROLS', mode)
+        self._hexa.set_expected_flight_mode(mode)
+        self._in_controls = 'PILOT'
+        self._clearance_state = 'WAITING' if self._clearance_check else 'CLEARED'
+        self._update_controls()
+
+  def _on_flight_mode_changed(self):
+    self._hexa.update_expected_flight_mode()
+    self._check_flight_mode()
+
+  # In controls state machine
+  def _update_controls(self):
+    # PILOT is in controls
+    ######################
+    if self._in_controls == 'PILOT':
+      # Look for PILOT handover to DSS, require:
+      # 1. armable, 2. GUIDED, 3. Cleared state
+      if not self._hexa.vehicle.is_armable:
+        self._set_status('Waiting for vehicle to initialise...')
+      elif not self._hexa.is_flight_mode('GUIDED'):
+        self._set_status('Waiting for GUIDED mode...')
+      elif not self._clearance_state == 'CLEARED':
+        self._set_status('Waiting for safety pilot to give clearance...')
+      # Pilot ready for hand over.
+      # Look for DSS ready for immidiate handover to APPLICATION, require: (DSS in controls without application triggers rtl)
+      # 1. Connected to app, 2. Gcs heartbeats if used, 3. THR to midstick if used.
+      elif not self._connected:
+        self._set_status('Waiting for APPLICATION to connect...')
+      elif self.lost_link_to_gcs():
+        self._set_status('Waiting for gcs heartbeats...')
+      elif self._hexa.get_channel(3) is None:
+        self._set_status('Waiting for rc channel 3 to become available...')
+      elif self._midstick_check and (not 1400 < self._hexa.get_channel(3) < 1600):
+        self._set_status('Waiting for throttle to mid-stick...')
+      # Handover to APPLICATION
+      else:
+        self._logger.info('APPLICATION got the the CONTROLS')
+        self._hexa.set_expected_flight_mode('GUIDED')
+        self._in_controls = 'APPLICATION'
+        self._hexa.gimbal_stow()
+
+    # DSS is in controls
+    ####################
+    if self._in_controls == 'DSS':
+      # If DSS is in controls without connected app, DSS will trigger RTL
+
+      # Monitor DSS is in controls without connected APP
+      if self._task['fcn'] == 'rtl':
+        if self._task_event.is_set():
+          self._set_status('Smart RTL, %s' % self._hexa.status_msg)
+        elif not self._status.endswith('RTL completed'):
+          self._logger.info('RTL completed. Waiting for PILOT to take CONTROLS')
+          self._set_status('RTL completed')
+      else:
+        if self._task_event.is_set():
+          self._hexa.abort_task = True
+          self._set_status('Waiting for task to abort')
+        else:
+          self._hexa.abort_task = False
+          self._task = {'fcn': 'rtl'}
+          self._task_event.set()
 
-    while self.alive:
+    # APPLICATION is in controls
+    ############################
+    if self._in_controls == 'APPLICATION':
+      if self._task_event.is_set():
+        self._set_status(self._hexa.status_msg)
+      else:
+        self._set_status('idle')
 
-      #################################
-      ## In controls state machine
-      #################################
-
-      # Monitor gcs heartbeats
-      ########################
-      if self._in_controls == 'APPLICATION' and self.lost_link_to_gcs():
-        self._logger.error('Lost link to the gcs heartbeats; DSS taking the CONTROLS')
-        self._in_controls = 'DSS'
-        continue
-
-      # Monitor if pilot changed flight mode
-      ######################################
-      if self._in_controls in ('APPLICATION', 'DSS'):
-        if not self._hexa.expected_flight_mode:
-          mode = self._hexa.get_flight_mode()
-          self._logger.warning('Unexpected flight mode: %s; PILOT took the CONTROLS', mode)
-          self._hexa.set_expected_flight_mode(mode)
-          self._in_controls = 'PILOT'
-          self._clearance_state = 'WAITING' if self._clearance_check else 'CLEARED'
-          continue
-
-      # PILOT is in controls
-      ######################
-      if self._in_controls == 'PILOT':
-        # Look for PILOT handover to DSS, require:
-        # 1. armable, 2. GUIDED, 3. Cleared state
-        if not self._hexa.vehicle.is_armable:
-          print('\033[K', end='\r') # clear to the end of line
-          print('[%s has the CONTROLS] Waiting for vehicle to initialise...' % self._in_controls, end='\r')
-        elif not self._hexa.is_flight_mode('GUIDED'):
-          print('\033[K', end='\r') # clear to the end of line
-          print('[%s has the CONTROLS] Waiting for GUIDED mode...' % self._in_controls, end='\r')
-        elif not self._clearance_state == 'CLEARED':
-          print('[%s has the CONTROLS] Waiting for safety pilot to give clearance...' % self._in_controls, end='\r')
-        # Pilot ready for hand over.
-        # Look for DSS ready for immidiate handover to APPLICATION, require: (DSS in controls without application triggers rtl)
-        # 1. Connected to app, 2. Gcs heartbeats if used, 3. THR to midstick if used.
-        elif not self._connected:
-          print('\033[K', end='\r') # clear to the end of line
-          print('[%s has the CONTROLS] Waiting for APPLICATION to connect...' % self._in_controls, end='\r')
-        elif self.lost_link_to_gcs():
-          print('\033[K', end='\r') # clear to the end of line
-          print('[%s has the CONTROLS] Waiting for gcs heartbeats...' % self._in_controls, end='\r')
-        elif self._hexa.get_channel(3) is None:
-          print('\033[K', end='\r') # clear to the end of line
-          print('[%s has the CONTROLS] Waiting for rc channel 3 to become available...' % self._in_controls, end='\r')
-        elif self._midstick_check and (not 1400 < self._hexa.get_channel(3) < 1600):
-          print('\033[K', end='\r') # clear to the end of line
-          print('[%s has the CONTROLS] Waiting for throttle to mid-stick...' % self._in_controls, end='\r')
-        # Handover to APPLICATION
-        else:
-          self._logger.info('APPLICATION got the the CONTROLS')
-          self._hexa.set_expected_flight_mode('GUIDED')
-          self._in_controls = 'APPLICATION'
-          self._hexa.gimbal_stow()
-          continue
-
-      # DSS is in controls
-      ####################
-      if self._in_controls == 'DSS':
-        # If DSS is in controls without connected app, DSS will trigger RTL
-
-        # Monitor DSS is in controls without connected APP
-        if self._task['fcn'] == 'rtl':
-          if self._task_event.is_set():
-            print('\033[K', end='\r') # clear to the end of line
-            print('[%s has the CONTROLS] Smart RTL, %s' % (self._in_controls, self._hexa.status_msg), end='\r')
-          else:
-            self._logger.info('RTL completed. Waiting for PILOT to take CONTROLS')
-        else:
-          if self._task_event.is_set():
-            self._hexa.abort_task = True
-            print('\033[K', end='\r') # clear to the end of line
-            print('[%s has the CONTROLS] Waiting for task to abort' % self._in_controls, end='\r')
-          else:
-            self._hexa.abort_task = False
-            self._task = {'fcn': 'rtl'}
-            self._task_event.set()
+  # ZMQ
+  def _on_request(self):
+    try:
+      (envelope, msg) = self._serv_socket.recv_request()
+    except dss.auxiliaries.exception.Again:
+      return
+    if self.from_owner(msg):
+      self._t_last_owner_msg = time.time()
 
-      # APPLICATION is in controls
-      ############################
-      if self._in_controls == 'APPLICATION':
-        if self._task_event.is_set():
-          print('\033[K', end='\r') # clear to the end of line
-          print('[%s has the CONTROLS] %s' % (self._in_controls, self._hexa.status_msg), end='\r')
-        else:
-          print('\033[K', end='\r') # clear to the end of line
-          print('[%s has the CONTROLS] idle' % self._in_controls, end='\r')
+    if not self._connected and self.from_owner(msg) and msg['id'] != 'crm':
+      self._connected = True
+      self._logger.info('Application is connected')
 
-      # ZMQ
-      #####
-      try:
-        msg = self._serv_socket.recv_json()
-        msg = json.loads(msg)
-        if self.from_owner(msg):
-          self._t_last_owner_msg = time.time()
-      except dss.auxiliaries.exception.Again:
-        _ = self._is_link_lost()
-        continue
-
-      if not self._connected and self.from_owner(msg) and msg['id'] != 'crm':
-        self._connected = True
-        self._logger.info('Application is connected')
-
-      fcn = msg['fcn'] if 'fcn' in msg else ''
-
-      if fcn != 'heart_beat':
-        self._logger.info('Received request: %s', str(msg))
-
-      if fcn in self._commands:
-        request = self._commands[fcn]['request']
-        task = self._commands[fcn]['task']
-
-        #we need to try the request prior to executing the task. All nack reasons are handled in the requests
-        start_task = False
-        if task:
-          priority = self._commands[fcn]['priority']
-          # Nack reasons for all tasks with low priority
-          if self._task_event.is_set() and (self._task_priority == MAX_PRIORITY or priority < self._task_priority):
-              answer = {'fcn': 'nack', 'call': fcn, 'description': 'Task not prioritized'}
-          # Accept task
-          else:
-            # Test request
-            answer = request(msg)
-            if dss.auxiliaries.zmq_lib.is_ack(answer):
-              start_task = True
+    fcn = msg['fcn'] if 'fcn' in msg else ''
+
+    if fcn != 'heart_beat':
+      self._logger.info('Received request: %s', str(msg))
+
+    if fcn in self._commands and self._commands[fcn].get('worker'):
+      # the worker replies through the main thread, the socket is not thread safe
+      self._workers.submit(self._on_worker_request, fcn, msg, envelope)
+      return
+
+    if fcn in self._commands:
+      request = self._commands[fcn]['request']
+      task = self._commands[fcn]['task']
+
+      #we need to try the request prior to executing the task. All nack reasons are handled in the requests
+      start_task = False
+      if task:
+        priority = self._commands[fcn]['priority']
+        # Nack reasons for all tasks with low priority
+        if self._task_event.is_set() and (self._task_priority == MAX_PRIORITY or priority < self._task_priority):
+            answer = {'fcn': 'nack', 'call': fcn, 'description': 'Task not prioritized'}
+        # Accept task
         else:
-          # simple requests are always allowed
+          # Test request
           answer = request(msg)
+          if dss.auxiliaries.zmq_lib.is_ack(answer):
+            start_task = True
       else:
-        start_task = False
-        print("request not supported")
-        print(fcn)
-        answer = {'fcn': 'nack', 'arg': msg['fcn'], 'arg2': 'request not supported'}
-
-      answer = json.dumps(answer)
-      self._serv_socket.send_json(answer)
-      if start_task:
-        if self._task_event.is_set():
-          self._hexa.abort_task = True
-          #wait until task is aborted
-          max_wait = 0
-          while self._hexa.abort_task and max_wait < 10:
-            max_wait += 1
-            time.sleep(0.01)
-        self._task = msg
-        self._task_priority = priority
-        self._task_event.set()
+        # simple requests are always allowed
+        answer = request(msg)
+    else:
+      start_task = False
+      print("request not supported")
+      print(fcn)
+      answer = {'fcn': 'nack', 'arg': msg['fcn'], 'arg2': 'request not supported'}
 
-      if fcn != 'heart_beat':
-        self._logger.info("Replied: %s", answer)
+    self._serv_socket.send(answer, envelope)
+    if start_task:
+      if self._task_event.is_set():
+        self._hexa.abort_task = True
+        #wait until task is aborted
+        max_wait = 0
+        while self._hexa.abort_task and max_wait < 10:
+          max_wait += 1
+          time.sleep(0.01)
+      self._task = msg
+      self._task_priority = priority
+      self._task_event.set()
+
+    if fcn != 'heart_beat':
+      self._logger.info("Replied: %s", answer)
+
+  def _on_worker_request(self, fcn, msg, envelope):
+    try:
+      answer = self._commands[fcn]['request'](msg)
+    except:
+      self._logger.error(f'unexpected exception\n{traceback.format_exc()}')
+      answer = dss.auxiliaries.zmq_lib.nack(fcn, 'unexpected exception')
+    self._logger.info("Replied: %s", answer)
+    self._reactor.call_soon(lambda: self._serv_socket.send(answer, envelope))
+
+  def _main(self):
+    '''Listening for new requests and gcs heartbeats'''
+    self._reactor.add_socket(self._serv_socket, self._on_request)
+    if self._gcs_heartbeat:
+      self._reactor.call_every(self._gcs_heartbeat.interval, self._check_gcs_link)
+    self._reactor.call_every(0.5, self._check_flight_mode)
+    self._reactor.call_every(0.2, self._update_controls)
+    self._reactor.call_every(1.0, self._is_link_lost)
+    self._reactor.call_every(1.0, self._print_status)
+    self._reactor.run()
+    self._workers.shutdown(wait=False)
+
+    if self._flight_recorder:
+      self._flight_recorder.close()
 
     #Unregister from CRM
     if self._crm:
@@ -0,0 +1,214 @@
+'''Flight data recorder
+
+The recorder listens to the vehicle attributes and appends each sample as
+a fixed width record to a memory-mapped file. Every stream has a ring of
+its own with a NumPy record type, the oldest samples are overwritten when
+a ring is full. Nothing is encoded or parsed, a sample is one record
+assignment and the file is readable while it is written and after a
+crash.
+
+File layout:
+  [0, HEADER_SIZE)  magic, length of the JSON index and the JSON index,
+                    {'version', 'streams': {name: {'fields', 'capacity', 'offset'}}}
+  [HEADER_SIZE, ..) number of samples written per stream, uint64
+  offset            ring of the stream, capacity records
+
+Example:
+  recorder = FlightRecorder('log/flight.fdr')
+  recorder.attach(vehicle)
+  ...
+  log = FlightLog('log/flight.fdr')
+  att = log.read('ATT', t_start, t_end)
+  plot(att['time'], att['roll'])
+'''
+
+import json
+import logging
+import math
+import mmap
+import time
+
+import numpy as np
+
+import dss.auxiliaries
+
+__author__ = 'Lennart Ochel <>, Andreas Gising <andreas.gising@ri.se>, Kristoffer Bergman <kristoffer.bergman@ri.se>, Hanna Müller <hanna.muller@ri.se>, Joel Nordahl'
+__version__ = '1.0.0'
+__copyright__ = 'Copyright (c) 2023, RISE'
+__status__ = 'development'
+
+MAGIC = b'DSSFDR01'
+HEADER_SIZE = 4096
+
+# Record fields per stream, all records start with time [s since epoch]
+STREAMS = {'ATT':     [('roll', '<f4'), ('pitch', '<f4'), ('yaw', '<f4')],
+           'LLA':     [('lat', '<f8'), ('lon', '<f8'), ('alt', '<f4'), ('heading', '<f4')],
+           'NED':     [('north', '<f4'), ('east', '<f4'), ('down', '<f4')],
+           'VEL':     [('vel_n', '<f4'), ('vel_e', '<f4'), ('vel_d', '<f4')],
+           'RC':      [('ch%d' % ch, '<u2') for ch in range(1, 17)],
+           'battery': [('voltage', '<f4'), ('current', '<f4'), ('level', '<f4')]}
+
+# Vehicle attribute of each stream
+ATTRIBUTES = {'attitude':              'ATT',
+              'location.global_frame': 'LLA',
+              'location.local_frame':  'NED',
+              'velocity':              'VEL',
+              'channels':              'RC',
+              'battery':               'battery'}
+
+_logger = logging.getLogger(__name__)
+
+def _dtype(fields) -> np.dtype:
+  return np.dtype([('time', '<f8')] + [tuple(field) for field in fields])
+
+def _nan(value) -> float:
+  return math.nan if value is None else value
+
+class _File:
+  '''Maps the index, the counters and the rings of a recorder file'''
+  def __init__(self, file, access):
+    self._mmap = mmap.mmap(file.fileno(), 0, access=access)
+    if self._mmap[:len(MAGIC)] != MAGIC:
+      self._mmap.close()
+      raise dss.auxiliaries.exception.Error('Not a flight data recorder file')
+    length = int.from_bytes(self._mmap[len(MAGIC):len(MAGIC)+4], 'little')
+    self.index = json.loads(self._mmap[len(MAGIC)+4:len(MAGIC)+4+length].decode('utf-8'))
+    names = list(self.index['streams'])
+    self.counts = np.ndarray((len(names),), dtype='<u8', buffer=self._mmap, offset=HEADER_SIZE)
+    self.slot = {name: i for (i, name) in enumerate(names)}
+    self.rings = dict()
+    for (name, stream) in self.index['streams'].items():
+      self.rings[name] = np.ndarray((stream['capacity'],), dtype=_dtype(stream['fields']), buffer=self._mmap, offset=stream['offset'])
+
+  def close(self):
+    # The arrays refer to the map, drop them first
+    self.counts = None
+    self.rings = None
+    self._mmap.close()
+
+class FlightRecorder:
+  '''Records the vehicle attributes to a memory-mapped ring file'''
+  def __init__(self, filename, capacity=2**18, streams=None):
+    streams = STREAMS if streams is None else {name: STREAMS[name] for name in streams}
+    index = {'version': 1, 'streams': dict()}
+    offset = HEADER_SIZE + mmap.PAGESIZE
+    for (name, fields) in streams.items():
+      index['streams'][name] = {'fields': fields, 'capacity': capacity, 'offset': offset}
+      offset += -(-capacity*_dtype(fields).itemsize // mmap.PAGESIZE)*mmap.PAGESIZE
+    header = json.dumps(index).encode('utf-8')
+    if len(MAGIC) + 4 + len(header) > HEADER_SIZE:
+      raise dss.auxiliaries.exception.InputError(streams, 'too many streams for the header')
+
+    try:
+      with open(filename, 'w+b') as file:
+        file.truncate(offset)
+        file.write(MAGIC + len(header).to_bytes(4, 'little') + header)
+        file.flush()
+        self._file = _File(file, mmap.ACCESS_WRITE)
+    except OSError as exc:
+      raise dss.auxiliaries.exception.Error(f'Creating the flight data file "{filename}" failed') from exc
+    self._filename = filename
+    self._vehicle = None
+    # Fixed per stream lookups, keeps the listener short
+    self._rings = self._file.rings
+    self._counts = self._file.counts
+    self._slot = self._file.slot
+    self._capacity = capacity
+    _logger.info('Flight data recorder %s, %d MB', filename, offset//2**20)
+
+  @property
+  def filename(self) -> str:
+    return self._filename
+
+  def attach(self, vehicle):
+    '''Records the vehicle attributes until detach'''
+    self._vehicle = vehicle
+    for (att_name, stream) in ATTRIBUTES.items():
+      if stream in self._rings:
+        vehicle.add_attribute_listener(att_name, self._listener)
+
+  def detach(self):
+    if self._vehicle is None:
+      return
+    for (att_name, stream) in ATTRIBUTES.items():
+      if stream in self._rings:
+        self._vehicle.remove_attribute_listener(att_name, self._listener)
+    self._vehicle = None
+
+  def close(self):
+    self.detach()
+    if self._rings is not None:
+      self._rings = None
+      self._counts = None
+      self._file.close()
+
+  def record(self, stream, sample: tuple, t=None):
+    '''Appends the sample, the record fields after time, to the ring of the stream'''
+    rings = self._rings
+    if rings is None or stream not in rings:
+      return
+    slot = self._slot[stream]
+    count = int(self._counts[slot])
+    rings[stream][count % self._capacity] = (time.time() if t is None else t,) + sample
+    # The counter is bumped after the record, a reader never sees a partial record as new
+    self._counts[slot] = count + 1
+
+  def _listener(self, vehicle, att_name, value):
+    stream = ATTRIBUTES[att_name]
+    if stream == 'ATT':
+      self.record(stream, (_nan(value.roll), _nan(value.pitch), _nan(value.yaw)))
+    elif stream == 'LLA':
+      self.record(stream, (_nan(value.lat), _nan(value.lon), _nan(value.alt), _nan(vehicle.heading)))
+    elif stream == 'NED':
+      self.record(stream, (_nan(value.north), _nan(value.east), _nan(value.down)))
+    elif stream == 'VEL':
+      self.record(stream, tuple(_nan(vel) for vel in value) if value else (math.nan,)*3)
+    elif stream == 'RC':
+      self.record(stream, tuple(value.get(str(ch)) or 0 for ch in range(1, 17)))
+    elif stream == 'battery':
+      self.record(stream, (_nan(value.voltage), _nan(value.current), _nan(value.level)))
+
+class FlightLog:
+  '''Reads a flight data recorder file, also while it is recorded'''
+  def __init__(self, filename):
+    try:
+      with open(filename, 'rb') as file:
+        self._file = _File(file, mmap.ACCESS_READ)
+    except OSError as exc:
+      raise dss.auxiliaries.exception.Error(f'Opening the flight data file "{filename}" failed') from exc
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, exc_type, exc_value, traceback):
+    self.close()
+
+  @property
+  def streams(self) -> list:
+    return list(self._file.rings)
+
+  def count(self, stream) -> int:
+    '''Number of samples recorded, including overwritten ones'''
+    return int(self._file.counts[self._file.slot[stream]])
+
+  def read(self, stream, t_start=None, t_end=None) -> np.ndarray:
+    '''Records of the stream in time order, optionally within [t_start, t_end], as a copy'''
+    if stream not in self._file.rings:
+      raise dss.auxiliaries.exception.InputError(stream, 'stream not recorded')
+    ring = self._file.rings[stream]
+    count = self.count(stream)
+    if count <= len(ring):
+      records = ring[:count].copy()
+    else:
+      # Oldest record first
+      i = count % len(ring)
+      records = np.concatenate((ring[i:], ring[:i]))
+    if t_start is not None or t_end is not None:
+      times = records['time']
+      first = 0 if t_start is None else np.searchsorted(times, t_start, side='left')
+      last = len(records) if t_end is None else np.searchsorted(times, t_end, side='right')
+      records = records[first:last]
+    return records
+
+  def close(self):
+    self._file.close()
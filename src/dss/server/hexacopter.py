@@ -10,6 +10,7 @@ import logging
 import math
 import threading
 import time
+import typing
 
 import dronekit
 import numpy as np
@@ -157,12 +158,182 @@ class Waypoint:
     self.alt = dronekit_loc.alt
 
 
+class Mission:
+  '''Mission as a struct of numpy arrays in the LLA frame
+
+  Row i is waypoint "id<i>" once validate() has accepted the mission.
+  Waypoint objects are created on access only.
+  '''
+  FRAME_NONE = 0
+  FRAME_LLA = 1
+  FRAME_NED = 2
+  FRAME_XYZ = 3
+
+  def __init__(self, id_strs=(), lat=None, lon=None, alt=None, heading=None, speed=None, actions=None):
+    self.id_strs = list(id_strs)
+    n = len(self.id_strs)
+    self.lat = np.zeros(n) if lat is None else lat
+    self.lon = np.zeros(n) if lon is None else lon
+    self.alt = np.zeros(n) if alt is None else alt
+    self.heading = np.full(n, -99.0) if heading is None else heading
+    self.speed = np.zeros(n) if speed is None else speed
+    self.actions = [''] * n if actions is None else actions
+
+  @classmethod
+  def from_json(cls, mission, init_point, default_speed) -> 'Mission':
+    '''Converts a json mission in any reference frame to LLA, the mission is not checked'''
+    n = len(mission)
+    frame = np.zeros(n, dtype=np.int8)
+    coords = np.zeros((n, 3))
+    amsl = np.zeros(n, dtype=bool)
+    heading = np.full(n, -99.0) # internal code for faulty heading is -99
+    speed = np.full(n, float(default_speed))
+    actions = [''] * n
+    # One pass to collect the fields, everything else is vectorised
+    for i, jsonWP in enumerate(mission.values()):
+      if "lat" in jsonWP and "lon" in jsonWP and "alt" in jsonWP and "alt_type" in jsonWP:
+        if jsonWP['alt_type'] in ('relative', 'amsl'):
+          frame[i] = cls.FRAME_LLA
+          coords[i] = (jsonWP['lat'], jsonWP['lon'], jsonWP['alt'])
+          amsl[i] = jsonWP['alt_type'] == 'amsl'
+      elif "north" in jsonWP and "east" in jsonWP and "down" in jsonWP:
+        frame[i] = cls.FRAME_NED
+        coords[i] = (jsonWP['north'], jsonWP['east'], jsonWP['down'])
+      elif "x" in jsonWP and "y" in jsonWP and "z" in jsonWP:
+        frame[i] = cls.FRAME_XYZ
+        coords[i] = (jsonWP['x'], jsonWP['y'], jsonWP['z'])
+      value = jsonWP.get('heading', -99)
+      if value == 'course':
+        heading[i] = -1 # internal code for 'course' is -1
+      elif isinstance(value, (int, float)) and not isinstance(value, bool) and 0 <= value < 360:
+        heading[i] = value
+      if 'speed' in jsonWP:
+        speed[i] = jsonWP['speed']
+      if 'action' in jsonWP:
+        actions[i] = jsonWP['action']
+
+    lla = frame == cls.FRAME_LLA
+    ned = frame == cls.FRAME_NED
+    xyz = frame == cls.FRAME_XYZ
+    init_lat_rad = init_point.lat/180*math.pi
+    init_heading_rad = init_point.heading/180*math.pi
+    # Rotate XYZ to NED
+    beta = -init_heading_rad
+    north = np.where(xyz, coords[:, 0]*math.cos(beta) + coords[:, 1]*math.sin(beta), coords[:, 0])
+    east = np.where(xyz, -coords[:, 0]*math.sin(beta) + coords[:, 1]*math.cos(beta), coords[:, 1])
+    # Calc lat, lon from north east and init_point, 1852 * 60 - nautical mile times 60 -> length of 1 arch in m.
+    local = ned | xyz
+    lat = np.where(lla, coords[:, 0], np.where(local, init_point.lat + north/111120, 0.0))
+    lon = np.where(lla, coords[:, 1], np.where(local, init_point.lon + east/(111120*math.cos(init_lat_rad)), 0.0))
+    # Transform AMSL to relative (used internally for control)
+    alt = np.where(lla, np.where(amsl, coords[:, 2] - (init_point.alt or 0.0), coords[:, 2]), np.where(local, -coords[:, 2], 0.0))
+    # Heading needs correction for the local reference system if positive
+    correct = xyz & (heading >= 0)
+    heading[correct] += init_point.heading
+    heading[correct & (heading > 360)] -= 360
+    return cls(mission.keys(), lat, lon, alt, heading, speed, actions)
+
+  def validate(self, init_point, geofence) -> tuple:
+    '''Returns (check_ok, descr) for the first waypoint that fails a check, in the order the checks are listed'''
+    n = len(self.id_strs)
+    if n == 0:
+      return False, "WP numbering faulty, missing id0"
+    # Check the wp numbering, the ids must be id0..id<n-1>
+    ids = np.array([self._id_number(id_str) for id_str in self.id_strs])
+    present = np.zeros(n, dtype=bool)
+    present[ids[(ids >= 0) & (ids < n)]] = True
+    # Distance to the init point, same as Waypoint.check_geofence
+    northing = (init_point.lat - self.lat)*1852*60
+    easting = (init_point.lon - self.lon)*1852*60*np.cos(self.lat/180*math.pi)
+    distance2D = np.hypot(northing, easting)
+    checks = ((np.logical_and(self.lat == 0, self.lon == 0), "WP position format faulty, {id_str}"),
+              (np.full(n, not init_point.is_init_point), "Not using init_point for reference"),
+              ((distance2D > geofence.radius) | (self.alt < geofence.height_low) | (self.alt > geofence.height_high), "Geofence violation, {id_str}"),
+              (~present, "WP numbering faulty, missing id{i}"),
+              (np.array([action != '' for action in self.actions], dtype=bool), "WP action not supported, {id_str}"),
+              (self.speed < 0.1, "Speed below 0.1, {id_str}"),
+              (self.heading == -99, "Heading faulty, {id_str}"))
+    failed = np.vstack([mask for (mask, _) in checks])
+    rows = failed.any(axis=0)
+    if rows.any():
+      i = int(np.argmax(rows))
+      descr = checks[int(np.argmax(failed[:, i]))][1]
+      return False, descr.format(id_str=self.id_strs[i], i=i)
+    # Sort the rows by id
+    order = np.argsort(ids)
+    self.id_strs = [self.id_strs[i] for i in order]
+    self.lat, self.lon, self.alt = self.lat[order], self.lon[order], self.alt[order]
+    self.heading, self.speed = self.heading[order], self.speed[order]
+    self.actions = [self.actions[i] for i in order]
+    return True, ""
+
+  @staticmethod
+  def _id_number(id_str) -> int:
+    # Only 'id%d' is a waypoint id, e.g. 'id01' is not
+    if isinstance(id_str, str) and id_str.startswith('id') and id_str[2:].isdecimal():
+      number = int(id_str[2:])
+      if id_str == 'id%d' % number:
+        return number
+    return -1
+
+  def _row(self, id_str):
+    row = self._id_number(id_str)
+    if 0 <= row < len(self.id_strs):
+      return row
+    return None
+
+  def __len__(self):
+    return len(self.id_strs)
+
+  def __iter__(self):
+    return iter(self.id_strs)
+
+  def __contains__(self, id_str):
+    return self._row(id_str) is not None
+
+  def __getitem__(self, id_str) -> Waypoint:
+    row = self._row(id_str)
+    if row is None:
+      raise KeyError(id_str)
+    wp = Waypoint(float(self.lat[row]), float(self.lon[row]), float(self.alt[row]))
+    wp.id_str = id_str
+    wp.id = row
+    wp.heading = float(self.heading[row])
+    wp.speed = float(self.speed[row])
+    wp.action = self.actions[row]
+    return wp
+
+
+class VehicleState(typing.NamedTuple):
+  '''Immutable snapshot of the vehicle state, see Hexacopter.state
+
+  A new snapshot with an incremented version replaces the previous one
+  whenever dronekit reports a change, hence readers get a consistent
+  state without touching dronekit.'''
+  version: int = 0
+  time: float = 0.0                 # time.monotonic() of the latest update
+  lat: typing.Optional[float] = None
+  lon: typing.Optional[float] = None
+  alt: typing.Optional[float] = None       # relative to home
+  alt_amsl: typing.Optional[float] = None
+  posD: float = 0.0
+  heading: typing.Optional[float] = None   # [deg] 0-360
+  roll: typing.Optional[float] = None      # [rad]
+  pitch: typing.Optional[float] = None     # [rad]
+  yaw: typing.Optional[float] = None       # [rad]
+  vel_n: typing.Optional[float] = None
+  vel_e: typing.Optional[float] = None
+  vel_d: typing.Optional[float] = None
+  armed: bool = False
+  flight_mode: typing.Optional[str] = None
+  gnss_state: int = 0
+  flight_state: str = 'ground'
 
 class Hexacopter:
   def __init__(self, connect, baud, rangefinder):
     self.logger = logging.getLogger(__name__)
 
-    self._abort_task = False
+    self._abort_event = threading.Event()
     self._rangefinder = rangefinder
     self.glana = None
     self.glana_autogain = False
@@ -173,6 +344,7 @@ class Hexacopter:
     self.active_mission = {}
 
     self.follow_stream_enabled = False
+    self._stream_tracker = None
 
     # Control parameters
     self.min_wp_speed = 0.1                             # From documentation
@@ -189,6 +361,13 @@ class Hexacopter:
     else:
       self.logger.info('Connection ok')
 
+    # State snapshot, refreshed by the attribute listeners
+    self._state = VehicleState()
+    self._state_mutex = threading.Lock()
+    for att_name in ('location.global_relative_frame', 'location.global_frame', 'location.local_frame', 'attitude', 'velocity', 'heading', 'armed', 'mode', 'gps_0'):
+      self.vehicle.add_attribute_listener(att_name, self._state_listener)
+    self._refresh_state()
+
     self.vehicle.groundspeed = 4
     self.logger.info('Ground speed set to 4m/s')
     #Internal variable for value on channel 13
@@ -261,6 +440,16 @@ class Hexacopter:
     # Max waypoint distance. Can be used to minimise risk of mistyped waypoints.
     self.max_wp_dist = config['DSS']['WP']['max_wp_distance']
 
+    # Rate of the control loops [Hz]
+    self.control_rate = config['DSS'].get('CTRL', {}).get('control_rate', 10)
+
+    # Bounded and simplified breadcrumb trail for the DSS SRTL
+    srtl = config['DSS'].get('SRTL', {})
+    self._breadcrumbs = dss.server.breadcrumbs.Breadcrumbs(capacity=srtl.get('max_crumbs', 500),
+                                                           min_dist=srtl.get('min_dist', 2.0),
+                                                           loop_dist=srtl.get('loop_dist', 5.0),
+                                                           epsilon=srtl.get('epsilon', 1.0))
+
     # Dictionary for data stream subscriptions (Flag, attribute name, enable/disable)-flag
     self.data_stream = {'new_input': False, 'attribute': '', 'enable': False}
 
@@ -271,6 +460,9 @@ class Hexacopter:
     self.active_mission_lla = {}
     self.mission_next_wp = 0
 
+    # Battery drain reference (monotonic time, level) for the remaining time estimate
+    self._battery_ref = None
+
     # Landing
     self.land_vel_limit = 0.5
     self.land_hover_t_limit = 3
@@ -285,7 +477,6 @@ class Hexacopter:
     self._mutex_mode = threading.Lock()
     self.mode = self.get_flight_mode()
     self._expected_flight_mode = True
-    self._rtl_waypoints = list()
     self.default_speed = 5
     self.flight_state = 'ground'
 
@@ -307,7 +498,7 @@ class Hexacopter:
   @property
   def abort_task(self):
     '''This attribute is used to abort a running task, e.g. if rtl is triggered'''
-    return self._abort_task
+    return self._abort_event.is_set()
 
   @property
   def default_speed(self):
@@ -320,7 +511,11 @@ class Hexacopter:
 
   @abort_task.setter
   def abort_task(self, value):
-    self._abort_task = value
+    # Control loops wait on the event, an abort wakes them up right away
+    if value:
+      self._abort_event.set()
+    else:
+      self._abort_event.clear()
 
   @property
   def flight_state(self):
@@ -334,6 +529,53 @@ class Hexacopter:
     if not value in valid_states:
       raise ValueError(f'{value} is not a valid flying state({valid_states})')
     self._flight_state = value
+    self._update_state(flight_state=value)
+
+  @property
+  def state(self) -> VehicleState:
+    '''Latest state snapshot, non-blocking'''
+    return self._state
+
+  def _update_state(self, **fields):
+    with self._state_mutex:
+      self._state = self._state._replace(version=self._state.version+1, time=time.monotonic(), **fields)
+
+  def _refresh_state(self):
+    '''Reads all snapshot attributes from dronekit, used once at connect'''
+    vehicle = self.vehicle
+    for att_name, value in (('location.global_relative_frame', vehicle.location.global_relative_frame),
+                            ('location.global_frame', vehicle.location.global_frame),
+                            ('location.local_frame', vehicle.location.local_frame),
+                            ('attitude', vehicle.attitude),
+                            ('velocity', vehicle.velocity),
+                            ('heading', vehicle.heading),
+                            ('armed', vehicle.armed),
+                            ('mode', vehicle.mode),
+                            ('gps_0', vehicle.gps_0)):
+      self._state_listener(vehicle, att_name, value)
+
+  # Attribute listener that keeps the state snapshot up to date
+  def _state_listener(self, vehicle, att_name, value):
+    if value is None:
+      return
+    if att_name == 'location.global_relative_frame':
+      self._update_state(lat=value.lat, lon=value.lon, alt=value.alt)
+    elif att_name == 'location.global_frame':
+      self._update_state(alt_amsl=value.alt)
+    elif att_name == 'location.local_frame':
+      self._update_state(posD=0.0 if value.down is None else value.down)
+    elif att_name == 'attitude':
+      self._update_state(roll=value.roll, pitch=value.pitch, yaw=value.yaw)
+    elif att_name == 'velocity':
+      self._update_state(vel_n=value[0], vel_e=value[1], vel_d=value[2])
+    elif att_name == 'heading':
+      self._update_state(heading=value)
+    elif att_name == 'armed':
+      self._update_state(armed=value)
+    elif att_name == 'mode':
+      self._update_state(flight_mode=value.name)
+    elif att_name == 'gps_0':
+      self._update_state(gnss_state=value.fix_type)
 
   @property
   def gnss_state(self):
@@ -356,6 +598,7 @@ class Hexacopter:
   def raise_if_aborted(self):
     if self.abort_task:
       self._status_msg = 'the task was aborted'
+      self.logger.warning('The task was aborted')
       raise dss.auxiliaries.exception.AbortTask()
 
   def get_channel(self, rc):
@@ -485,54 +728,9 @@ class Hexacopter:
 
   # Function converts any mission to LLA, and checks for all nack-reasons like geofence and such
   def upload_mission(self, mission)->tuple:
-    print("Upload mission", mission)
-    temp_mission = {}
-    i = -1
-    for id_str in mission:
-      # Create a Waypoint object from the jsonWP
-      new_wp = self.json_to_LLA(mission[id_str], id_str)
-
-      if new_wp.lat == 0 and new_wp.lon == 0 :
-        check_ok = False
-        descr = "WP position format faulty, " + id_str
-        break
-
-      # Check geofence
-      (check_ok, descr) = new_wp.check_geofence(self.init_point_wp, self.geofence.radius, self.geofence.height_low, self.geofence.height_high)
-      if not check_ok:
-        break
-
-      # Set and check the wp numbering
-      # Note: Waypoints will not be listed in numerical order in the for loop, this works anyways
-      i += 1
-      ghost_id_string = "id" + str(i)
-      if ghost_id_string not in mission:
-        # WP id not in mission
-        check_ok = False
-        descr = "WP numbering faulty, missing " + ghost_id_string
-        break
-
-      # Check nack action
-      if 'action' in mission[id_str]:
-        # No actions supported yet. TODO
-        check_ok = False
-        descr = "WP action not supported, " + id_str
-        break
-
-      # Check for low speed
-      if new_wp.speed < 0.1:
-        check_ok = False
-        descr = "Speed below 0.1, " + id_str
-        break
-
-      # Check heading
-      if new_wp.heading == -99:
-        check_ok = False
-        descr = "Heading faulty, " + id_str
-        break
-
-      # Add to temp_mission
-      temp_mission[id_str] = new_wp
+    self.logger.info('Upload mission, %d waypoints', len(mission))
+    temp_mission = Mission.from_json(mission, self.init_point_wp, self.default_speed)
+    (check_ok, descr) = temp_mission.validate(self.init_point_wp, self.geofence)
 
     # If all waypoint passed checks, accept mission as pending mission
     if check_ok:
@@ -545,8 +743,11 @@ class Hexacopter:
       mission_dict[id_str].pretty_print()
 
   def log_pending_mission(self):
-    for id_str in self.pending_mission:
-      self.logger.info(json.dumps(self.pending_mission[id_str].as_dict()))
+    self.logger.info('Pending mission, %d waypoints', len(self.pending_mission))
+    # Large missions are only listed in debug
+    if self.logger.isEnabledFor(logging.DEBUG):
+      for id_str in self.pending_mission:
+        self.logger.debug(json.dumps(self.pending_mission[id_str].as_dict()))
 
 
   def set_gimbal(self, roll, pitch, yaw):
@@ -593,13 +794,16 @@ class Hexacopter:
       flight_mode = self.get_flight_mode()
       self._expected_flight_mode = (flight_mode == self.mode)
 
+  def update_expected_flight_mode(self):
+    '''Re-evaluates expected_flight_mode right away, e.g. from a mode listener'''
+    with self._mutex_mode:
+      mode = self.get_flight_mode()
+      self._expected_flight_mode = (mode == self.mode)
+
   # Monitor flight mode thread
   def _main_flight_mode(self):
     while True:
-      with self._mutex_mode:
-        mode = self.get_flight_mode()
-        self._expected_flight_mode = (mode == self.mode)
-
+      self.update_expected_flight_mode()
       time.sleep(0.5)
 
   # Monitor flying state implements state machine: ground -> flying <-> landed
@@ -651,7 +855,6 @@ class Hexacopter:
       self.logger.info('Vehicle armed')
 
   def reset_dss_srtl(self):
-    self._rtl_waypoints.clear()
     wp = Waypoint()
     curr_location = self.get_position_lla()
     wp.lat = curr_location.lat
@@ -659,7 +862,7 @@ class Hexacopter:
     wp.alt = max(2.0, curr_location.alt)
     wp.speed = self.default_speed
     wp.heading = self.vehicle.heading # Same as current heading
-    self._rtl_waypoints.append(wp)
+    self._breadcrumbs.reset(wp.lat, wp.lon, wp.alt, wp.speed, wp.heading)
     self.logger.info(f"New DSS SRTL Home Position: lat: {wp.lat}, lon: {wp.lon}, alt: {wp.alt}, heading: {wp.heading}")
 
   @staticmethod
@@ -734,6 +937,7 @@ class Hexacopter:
       raise dss.auxiliaries.exception.Error('Sending goto command requires flight mode GUIDED. Current flight mode is: %s' % self.get_flight_mode())
     # Set heading according to what is specified in the waypoint
     self.send_condition_yaw(next_wp)
+    loop = dss.auxiliaries.RateLoop(self.control_rate, self._abort_event, label='goto_waypoint')
     waypoint_reached = False
     while not waypoint_reached :
       # While waypopint not reached- steer towards next wp based on current location
@@ -756,15 +960,21 @@ class Hexacopter:
         # USE ARDUPILOT POSITION CONTROLLER
         self.send_goto_lla(lookahead_wp)
         self.send_cmd_speed(next_wp.speed)
-        time.sleep(0.1)
-        self.raise_if_aborted()
+        try:
+          loop.sleep()
+        except dss.auxiliaries.exception.AbortTask:
+          # The abort interrupted the wait, exit like the other tasks do
+          loop.log_stats(self.logger)
+          self.raise_if_aborted()
+          raise
+    loop.log_stats(self.logger)
 
   def task_gogo(self, next_wp):
     self._status_msg = 'gogo'
     self.logger.info('task: gogo start')
     self.raise_if_aborted()
 
-    self.mission_next_wp = next_wp
+    self._set_next_wp(next_wp)
     self.mission_previous_wp = None
 
     # Check next wp id, statement only true once each time gogo_lla is switched to
@@ -773,7 +983,7 @@ class Hexacopter:
 
     # Test if there is a wp with the requested id
     if next_wp_str not in self.active_mission:
-      self.mission_next_wp = -1
+      self._set_next_wp(-1)
       raise dss.auxiliaries.exception.Error('There is no waypoint with %s - engage rtl' % next_wp_str)
     while self.mission_next_wp != -1:
       self._status_msg = 'gogo : next wp: %s' % next_wp_str
@@ -788,22 +998,41 @@ class Hexacopter:
       # 1. TODO Implement what to do when action is associated with waypoint
       if next_wp.action :
         self.logger.warning("Action not supported yet...")
-      # 2. Add waypoint to SRTL list
-      self._rtl_waypoints.insert(0, next_wp)
+      # 2. Add waypoint to SRTL trail
+      self._breadcrumbs.add(next_wp.lat, next_wp.lon, next_wp.alt, next_wp.speed, next_wp.heading)
       # 3. Update wp to the next in the list (if any exists)
       next_wp_cand = "id%d" % (self.mission_next_wp + 1)
       if next_wp_cand not in self.active_mission:
         #Final WP, send goto command and set mission next wp to -1
         self.logger.info('task: gogo - final wp reached...')
         self.send_goto_lla(next_wp)
-        self.mission_next_wp = -1
+        self._set_next_wp(-1)
       else:
         self.mission_previous_wp = self.mission_next_wp
-        self.mission_next_wp += 1
+        self._set_next_wp(self.mission_next_wp + 1)
         next_wp_str = next_wp_cand
 
         self.logger.info(f'task: gogo - Moving towards waypoint {next_wp_str}')
 
+  # Mission progress is pushed to 'currentWP' attribute listeners as (currentWP, finalWP)
+  def _set_next_wp(self, next_wp):
+    self.mission_next_wp = next_wp
+    self.vehicle.notify_attribute_listeners('currentWP', (next_wp, len(self.active_mission)-1))
+
+  # Estimated remaining flight time [s] from the drain rate of the battery level, -1 if unknown
+  def battery_remaining_time(self, level) -> float:
+    if level is None:
+      return -1
+    now = time.monotonic()
+    # Restart the estimate at the first sample and when the battery is swapped or charged
+    if self._battery_ref is None or level > self._battery_ref[1]:
+      self._battery_ref = (now, level)
+      return -1
+    (t_ref, level_ref) = self._battery_ref
+    if level_ref == level:
+      return -1
+    return level*(now - t_ref)/(level_ref - level)
+
   # Lat long pos and alt relative to start
   def get_position_lla(self):
     return self.vehicle.location.global_relative_frame
@@ -1293,6 +1522,8 @@ class Hexacopter:
     start_time = time.time()
     #Maximum time for takeoff is 2*takeoff_height
     max_time = max(10.0, height-self.get_position_lla().alt)
+    # Take-off is not abortable, the loop gets an event of its own
+    loop = dss.auxiliaries.RateLoop(self.control_rate, label='take-off')
     while self.is_flight_mode('GUIDED'):
       self._status_msg = 'altitude: %5.1f m' % self.vehicle.location.global_relative_frame.alt
       if time.time() >= start_time + max_time:
@@ -1307,7 +1538,7 @@ class Hexacopter:
         self.logger.info('Drone is not armed. Check pre-arm checks')
         self._status_msg = ''
         break
-      time.sleep(0.1)
+      loop.sleep()
     #self.reset_dss_srtl()
 
   def task_ardupilot_rtl(self):
@@ -1348,8 +1579,11 @@ class Hexacopter:
       # Stow gimbal
       self.gimbal_stow()
       prev_wp = self.get_position_lla()
-      #Visit all SRTL waypoints
-      for wp in self._rtl_waypoints :
+      #Visit the SRTL trail backwards
+      for crumb in self._breadcrumbs.path():
+        wp = Waypoint(crumb['lat'], crumb['lon'], crumb['alt'])
+        wp.speed = crumb['speed']
+        wp.heading = crumb['heading']
         self.goto_waypoint(wp, prev_wp)
         self.raise_if_aborted()
         prev_wp = wp
@@ -1364,15 +1598,15 @@ class Hexacopter:
     # If application disconnected during flight in mode GUIDED, invoke RTL.
     if self.is_flying() and self.is_flight_mode('GUIDED'):
       # Can we perform a SRTL?
-      if len(self._rtl_waypoints) > 0 :
+      if len(self._breadcrumbs) > 0 :
         self.task_dss_srtl(2.0)
       else:
         # Perform Ardupilot RTL
         self.task_ardupilot_rtl()
 
   def filter_reset_needed(self):
-    # Dummy function for future Kalman implementation
-    return False
+    # The stream does not update, the tracker resets its filter
+    return self._stream_tracker is not None and self._stream_tracker.stalled
 
   def stop(self):
   # Stop vehicle
@@ -1388,24 +1622,17 @@ class Hexacopter:
       angle2 += 360
     return angle2
 
-  def follow_stream(self):
+  def follow_stream(self, tracker):
     # Follow stream
     self.logger.info("Fcn follow stream")
 
-    # Hardcode stream location for test. Use drone pos plus offset
-    # TODO, subscribe to stream and filter in Kalman.
-    stream_loc = self.vehicle.location.global_relative_frame
+    # The tracker filters the stream in a thread of its own, the position is predicted each loop
+    self._stream_tracker = tracker
     stream_wp = Waypoint()
-    stream_wp.lat = stream_loc.lat + 0.0005
-    stream_wp.lon = stream_loc.lon - 0.0005
-    stream_wp.alt = stream_loc.alt
 
     # Create a waypoint object to carry dss location
     me_wp = Waypoint()
 
-    # Future use if filter on lla stream shall show if initialized or not
-    filter_initialized = True
-
     i = 0
     # Hardcode pattern info
     pattern = "circle"
@@ -1442,34 +1669,38 @@ class Hexacopter:
     heading_range_limit = 4 # For pattern above, at a greater distance than heading_range_limit, heading = bearing
 
     # Use i < 700 for development only, cannot stop thread right now.. TODO
-    while self.follow_stream_enabled:
+    # The loop has an event of its own to always stop the drone below, abort is checked once per period
+    loop = dss.auxiliaries.RateLoop(self.control_rate, label='follow_stream')
+    while self.follow_stream_enabled and not self.abort_task:
       # Read the vehicle heading
       heading = round(self.vehicle.attitude.yaw/math.pi*180, 2)
-      me_wp.update(self.vehicle.location.global_relative_frame)
-
-      # Filter the stream: The receiving thread of positions (stream) updates the filter each time a measurement arrives, prior to calculating control signals, estimate the latest pos.
-      # TODO Kalman implementation
-      # If the filter is not yet initialized, the first measurement has not arrived, send vel = 0 and try again.
-      if not filter_initialized:
-        self.send_body_velocity(0, 0, 0)
-        self.send_yaw_rate(0)
-        time.sleep(0.1)
-        continue
-
-      # Safety check, look for non initialized stream
-      if (stream_wp.lat == 0) or (stream_wp.lon == 0):
-        time.sleep(0.1)
-        continue
+      # The stream is AMSL, compare it to the AMSL position of the dss
+      me_wp.update(self.vehicle.location.global_frame)
+      # Drop a crumb, the trail is pruned to the positions that matter for the SRTL, the SRTL is relative to home
+      pos = self.vehicle.location.global_relative_frame
+      self._breadcrumbs.add(pos.lat, pos.lon, pos.alt, self.default_speed, -1)
 
       # If a Kalman reset is needed the stream does not update, stop
       if self.filter_reset_needed():
         print('Stream does not update, stopping')
+        # Samples after the gap start a new filter
+        tracker.reset()
         self.send_body_velocity(0, 0, 0)
         self.send_yaw_rate(0)
-        time.sleep(0.1)
+        loop.sleep()
         continue
 
-      # Estimate current stream location
+      # Estimate current stream location. The receiving thread of positions (stream) updates the filter each time a measurement arrives.
+      target = tracker.predict()
+      # If the filter is not yet initialized, the first measurement has not arrived, send vel = 0 and try again.
+      if target is None:
+        self.send_body_velocity(0, 0, 0)
+        self.send_yaw_rate(0)
+        loop.sleep()
+        continue
+      stream_wp.lat = target['lat']
+      stream_wp.lon = target['lon']
+      stream_wp.alt = target['alt']
 
       # Check if max time following is reached
       # TODO, if max time reached, stop. define maxtime in seconds
@@ -1731,11 +1962,13 @@ class Hexacopter:
       self.send_body_velocity(ref_velX_filt, ref_velY_filt, ref_velZ_filt)
       #self.send_yaw_rate(ref_yaw_rate)
       self.condition_yaw(ref_yaw)
-      # TODO, how to control loop time?
-      time.sleep(0.1)
+      loop.sleep()
       # Last line of while loop
 
     # While loop exited
     self.send_body_velocity(0, 0, 0)
     self.send_yaw_rate(0)
+    self._stream_tracker = None
+    loop.log_stats(self.logger)
+    self.raise_if_aborted()
     return
@@ -16,10 +16,15 @@ Server replies: {'fcn': 'ack', 'arg': 'take_picture'}
 
 Client sends:   {'fcn': 'disconnect'}
 Server replies: {'fcn': 'ack', 'arg': 'disconnect'}
+
+Client sends:   {'fcn': 'files'}
+Server replies: {'fcn': 'ack', 'arg': 'files', 'port': 5557, 'files': [{'file': 'img_00001.jpg', 'size': 4915200}]}
+
+The images are downloaded in full resolution from the file port using
+dss.auxiliaries.zmq_lib.FileClient.
 '''
 
 import datetime
-import json
 import logging
 import os
 import threading
@@ -39,12 +44,13 @@ __copyright__ = 'Copyright (c) 2020-2021, RISE'
 __status__ = 'development'
 
 class Server:
-  def __init__(self, storage_dir: str, address: str, data_stream_addr:str, context=None):
+  def __init__(self, storage_dir: str, address: str, data_stream_addr:str, context=None, file_port=None):
     # create all objects that are used in the destructor
     self._alive = False
     self._att_data = None
     self._camera = None
     self._data_stream_addr = data_stream_addr
+    self._file_server = None
     self._gps_data = None # file handle
     self._last_timestamp = time.time()
     self._lgf_data = None
@@ -78,9 +84,14 @@ class Server:
     self._serv_socket.RCVTIMEO = 1000 #ms
     self._logger.info('Starting photo service on %s... done', address)
 
+    # chunked download of the stored images
+    self._file_server = dss.auxiliaries.zmq_lib.FileServer(self._zmq_context, self._storage_dir, port=file_port, label='photo files')
+    self._logger.info('Starting photo file service on %d... done', self._file_server.port)
+
     self._commands = {'autogain':     {'request': self._request_autogain,     'task': None},
                       'connect':      {'request': self._request_connect,      'task': self._task_connect},
                       'disconnect':   {'request': self._request_disconnect,   'task': None},
+                      'files':        {'request': self._request_files,        'task': None},
                       'heartbeat':    {'request': self._request_heartbeat,    'task': None},
                       'rec_ok':       {'request': self._request_rec_ok,       'task': None},
                       'start_rec':    {'request': self._request_start_rec,    'task': self._task_start_rec},
@@ -107,6 +118,9 @@ class Server:
     if self._serv_socket:
       dss.auxiliaries.zmq_lib.close_socket_gracefully(self._serv_socket)
 
+    if self._file_server:
+      self._file_server.close()
+
     if self._camera:
       gphoto2.check_result(gphoto2.gp_camera_exit(self._camera))
 
@@ -126,27 +140,30 @@ class Server:
     self._alive = value
 
   def _gps_main(self):
-    socket = self._zmq_context.socket(zmq.SUB)
-    socket.connect(self._data_stream_addr)
+    ip, port = self._data_stream_addr.rsplit(':', 1)
+    _, ip = ip.rsplit('/', 1)
+    socket = dss.auxiliaries.zmq_lib.Sub(self._zmq_context, ip, int(port), label='photo', timeout=1000, conflate=True)
     self._logger.info('Subscribing to dss data stream on %s... done', self._data_stream_addr)
-    socket.setsockopt_string(zmq.SUBSCRIBE, '')
-    socket.RCVTIMEO = 1000 # in milliseconds
 
     while self.alive:
       try:
-        message = str(socket.recv(), 'utf-8')
-      except zmq.error.Again:
+        (topic, data) = socket.recv(lazy=True)
+      except dss.auxiliaries.exception.Again:
         pass
       else:
-        (topic, data) = dss.auxiliaries.zmq_lib.demogrify(message)
+        # only decode the topics of interest
         if topic == 'LGF':
           with self._mutex:
-            self._lgf_data = data
+            self._lgf_data = dict(data)
         elif topic == 'ATT':
           with self._mutex:
-            self._att_data = data
+            self._att_data = dict(data)
+        else:
+          continue
         print((topic, data))
 
+    socket.close()
+
   def run(self):
     self.alive = True
 
@@ -156,14 +173,18 @@ class Server:
     self._thread = threading.Thread(target=self._gps_main)
     self._thread.start()
 
+    self._file_server.start()
+
     try:
       while self.alive:
         try:
-          msg = self._serv_socket.recv_json()
+          data = self._serv_socket.recv()
         except zmq.error.Again:
           continue
 
-        msg = json.loads(msg)
+        # reply with the codec of the request
+        codec = dss.auxiliaries.zmq_lib.sniff_codec(data)
+        msg = codec.decode(data)
         fcn = msg['fcn'] if 'fcn' in msg else ''
 
         self._logger.info('Message received: %s', msg)
@@ -180,8 +201,7 @@ class Server:
 
         self._logger.info('Answer: %s', answer)
 
-        answer = json.dumps(answer)
-        self._serv_socket.send_json(answer)
+        self._serv_socket.send(codec.encode(answer))
     except KeyboardInterrupt:
       self.alive = False
 
@@ -210,6 +230,11 @@ class Server:
     self.alive = False
     return {'fcn': 'ack', 'arg': msg['fcn']}
 
+  def _request_files(self, msg):
+    # the images, not their metadata files
+    files = [entry for entry in self._file_server.list_files() if entry['file'].startswith('img_') and not entry['file'].endswith('.csv')]
+    return {'fcn': 'ack', 'arg': msg['fcn'], 'port': self._file_server.port, 'files': files}
+
   def _request_heartbeat(self, msg):
     return {'fcn': 'ack', 'arg': msg['fcn']}
 
@@ -350,6 +375,10 @@ class Client:
     answer = self.request({'fcn': 'disconnect'})
     return dss.auxiliaries.zmq_lib.is_ack(answer, 'disconnect')
 
+  def files(self) -> dict:
+    '''Returns the file port and the list of stored images'''
+    return self.request({'fcn': 'files'})
+
   def heartbeat(self) -> bool:
     answer = self.request({'fcn': 'heartbeat'})
     return dss.auxiliaries.zmq_lib.is_ack(answer, 'heartbeat')
@@ -0,0 +1,151 @@
+'''Target tracker for follow stream
+
+A receiver thread reads the LLA stream of the target and feeds a
+constant velocity Kalman filter in a local NED frame, the origin is the
+first sample. Each sample is filtered at the time it was published, if
+the publisher adds the key 'time' [s since epoch], else at the time it
+was received. predict() extrapolates the estimate to the time of the
+control loop, which compensates the latency of the link and irregular
+sample spacing.
+
+If no sample arrives for stall_time seconds the filter is reset and
+predict() returns None until the target is heard again.
+'''
+
+import logging
+import math
+import threading
+import time
+
+import numpy as np
+
+import dss.auxiliaries
+
+__author__ = 'Lennart Ochel <>, Andreas Gising <andreas.gising@ri.se>, Kristoffer Bergman <kristoffer.bergman@ri.se>, Hanna Müller <hanna.muller@ri.se>, Joel Nordahl'
+__version__ = '1.0.0'
+__copyright__ = 'Copyright (c) 2023, RISE'
+__status__ = 'development'
+
+MAX_LATENCY = 1.5 # [s] latency compensation is capped, protects against clock offsets
+
+_logger = logging.getLogger(__name__)
+
+class StreamTracker:
+  '''Kalman filtered tracking of a target LLA stream'''
+  def __init__(self, socket, topic='LLA', stall_time=2.0, acc_std=1.0, pos_std=3.0, vel_std=5.0):
+    self._acc_var = acc_std**2
+    self._alive = False
+    self._filter = None
+    self._mutex = threading.Lock()
+    self._origin = None
+    self._pos_var = pos_std**2
+    self._socket = socket
+    self._stall_time = stall_time
+    self._t_filter = None  # monotonic time of the filter state
+    self._t_received = None
+    self._thread = None
+    self._topic = topic
+    self._vel_var = vel_std**2
+
+  @property
+  def initialized(self) -> bool:
+    '''True once a sample has been filtered'''
+    with self._mutex:
+      return self._filter is not None
+
+  @property
+  def stalled(self) -> bool:
+    '''True if the stream has not updated for stall_time seconds'''
+    with self._mutex:
+      return self._t_received is not None and time.monotonic() - self._t_received > self._stall_time
+
+  def start(self):
+    self._alive = True
+    self._thread = threading.Thread(target=self._main, daemon=True)
+    self._thread.start()
+
+  def stop(self):
+    '''Stops the receiver thread and closes the socket'''
+    self._alive = False
+    if self._thread:
+      self._thread.join()
+      self._thread = None
+    self._socket.close()
+
+  def reset(self):
+    with self._mutex:
+      self._filter = None
+      self._t_filter = None
+
+  def predict(self, t=None) -> dict:
+    '''Estimated target position {lat, lon, alt, vel_n, vel_e, vel_d} at monotonic time t, default now'''
+    if self.stalled:
+      if self.initialized:
+        _logger.warning('Target stream stalled, filter reset')
+      self.reset()
+      return None
+    with self._mutex:
+      if self._filter is None:
+        return None
+      x = self._filter.get_state()[:, 0]
+      dt = (time.monotonic() if t is None else t) - self._t_filter
+      origin = self._origin
+    ned = x[0:3] + x[3:6]*dt
+    lat = origin['lat'] + ned[0]/(1852*60)
+    lon = origin['lon'] + ned[1]/(1852*60*math.cos(origin['lat']/180*math.pi))
+    return {'lat': lat, 'lon': lon, 'alt': -ned[2], 'vel_n': x[3], 'vel_e': x[4], 'vel_d': x[5]}
+
+  def _main(self):
+    while self._alive:
+      try:
+        (topic, msg) = self._socket.recv()
+      except dss.auxiliaries.exception.Again:
+        continue
+      if topic != self._topic:
+        continue
+      t_now = time.monotonic()
+      # Filter at the publish time if known
+      latency = 0.0
+      if 'time' in msg:
+        latency = min(max(0.0, time.time() - msg['time']), MAX_LATENCY)
+      self._add_sample(msg, t_now - latency, t_now)
+
+  def _add_sample(self, msg, t_sample, t_now):
+    with self._mutex:
+      if self._origin is None:
+        self._origin = {'lat': msg['lat'], 'lon': msg['lon'], 'alt': 0.0}
+      z = dss.auxiliaries.math_lib.lla_to_ned(msg, self._origin).reshape((3, 1))
+      self._t_received = t_now
+
+      if self._filter is None:
+        x0 = np.vstack((z, np.zeros((3, 1))))
+        P = np.diag([self._pos_var]*3 + [self._vel_var]*3)
+        H = np.hstack((np.eye(3), np.zeros((3, 3))))
+        self._filter = dss.auxiliaries.kalman.KalmanFilter(F=np.eye(6), H=H, R=self._pos_var*np.eye(3), P=P, x0=x0)
+        self._t_filter = t_sample
+        return
+
+      dt = t_sample - self._t_filter
+      if dt < 0:
+        # Older than the filter state, out of order
+        return
+      self._filter.F = self._transition(dt)
+      self._filter.Q = self._process_noise(dt)
+      self._filter.predict()
+      self._filter.update(z)
+      self._t_filter = t_sample
+
+  @staticmethod
+  def _transition(dt):
+    F = np.eye(6)
+    F[0:3, 3:6] = dt*np.eye(3)
+    return F
+
+  def _process_noise(self, dt):
+    # White noise acceleration
+    Q = np.zeros((6, 6))
+    Q[0:3, 0:3] = dt**3/3*np.eye(3)
+    Q[0:3, 3:6] = dt**2/2*np.eye(3)
+    Q[3:6, 0:3] = dt**2/2*np.eye(3)
+    Q[3:6, 3:6] = dt*np.eye(3)
+    return self._acc_var*Q